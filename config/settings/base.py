@@ -291,8 +291,36 @@ DJANGO_TABLES2_TEMPLATE = "django_tables2/bootstrap.html"
 IMPORT_EXPORT_USE_TRANSACTIONS = True
 IMPORT_EXPORT_IMPORT_PERMISSION_CODE = "add"
 IMPORT_EXPORT_EXPORT_PERMISSION_CODE = "view"
+# Save imported rows with bulk queries, this many at a time.
+IMPORT_USE_BULK = env.bool("IMPORT_USE_BULK", False)
+IMPORT_BATCH_SIZE = env.int("IMPORT_BATCH_SIZE", 500)
+# Confirmed imports are read and committed this many rows at a time.
+IMPORT_CHUNK_SIZE = env.int("IMPORT_CHUNK_SIZE", 5000)
+# Imports from the admin are validated and saved by the import worker.
+IMPORT_IN_BACKGROUND = env.bool("IMPORT_IN_BACKGROUND", True)
+# Exported rows are fetched from the database this many at a time.
+EXPORT_CHUNK_SIZE = env.int("EXPORT_CHUNK_SIZE", 2000)
 
 HISTOMX_SERVICE_URL = env("HISTOMX_SERVICE_URL", None)
+# Several histomx nodes can share the renders, each report going to the
+# node which probably has it cached. Defaults to HISTOMX_SERVICE_URL.
+HISTOMX_SERVICE_URLS = env.list(
+    "HISTOMX_SERVICE_URLS",
+    default=[HISTOMX_SERVICE_URL] if HISTOMX_SERVICE_URL else [],
+)
+# Seconds between checks that the histomx nodes are up.
+HISTOMX_HEALTH_CHECK_INTERVAL = env.float("HISTOMX_HEALTH_CHECK_INTERVAL", 10)
+# Reports must be back before gunicorn's 90s timeout kills the worker.
+HISTOMX_CONNECT_TIMEOUT = env.float("HISTOMX_CONNECT_TIMEOUT", 3)
+HISTOMX_READ_TIMEOUT = env.float("HISTOMX_READ_TIMEOUT", 80)
+HISTOMX_RETRIES = env.int("HISTOMX_RETRIES", 2)
+# Consecutive failures after which histomx is not called for a while.
+HISTOMX_BREAKER_THRESHOLD = env.int("HISTOMX_BREAKER_THRESHOLD", 5)
+HISTOMX_BREAKER_RESET_AFTER = env.float("HISTOMX_BREAKER_RESET_AFTER", 30)
+# Render the default report in the background as soon as sequencing data
+# gets its RCC file, a few at a time so that uploads do not flood histomx.
+HISTOMX_PRERENDER = env.bool("HISTOMX_PRERENDER", False)
+HISTOMX_PRERENDER_CONCURRENCY = env.int("HISTOMX_PRERENDER_CONCURRENCY", 1)
 
 # Monkey-patching django to have saner(?) defaults on time based inputs.
 # See https://code.djangoproject.com/ticket/16630#comment:12 as to why
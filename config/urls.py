@@ -14,6 +14,7 @@ urlpatterns = [
     path("users/", include("icdot.users.urls", namespace="users")),
     path("accounts/", include("allauth.urls")),
     path("histomx/", include("icdot.histomx.urls", namespace="histomx")),
+    path("transplants/", include("icdot.transplants.urls", namespace="transplants")),
     # Your stuff: custom urls includes go here
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
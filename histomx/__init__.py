@@ -1,19 +1,81 @@
-import functools
+import contextvars
+import hashlib
 import json
-import subprocess
+import os
 import tempfile
+import time
 import typing
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import Enum
 from pathlib import Path
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse, Response
-from pydantic import BaseModel, BaseSettings
-
-# TODO: import base64  # for rcc_file encoding.
-
-
-app = FastAPI()
+from fastapi import Depends, FastAPI, File, Form, Header, HTTPException, UploadFile
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from pydantic import BaseModel, BaseSettings, Json
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+from histomx.cache import ReportCache, analysis_digest, report_digest
+from histomx.jobs import JobQueue, JobStatus, QueueFull
+from histomx.metrics import (
+    ANALYSIS_SECONDS,
+    CACHE_LOOKUPS,
+    IO_SECONDS,
+    PDF_SECONDS,
+    QUEUE_SECONDS,
+    R_WORKER_EXITS,
+    R_WORKERS,
+    RENDER_SECONDS,
+    RENDERS_IN_FLIGHT,
+    REQUEST_SECONDS,
+    Timings,
+    observe,
+    timed,
+    timings,
+)
+from histomx.pdf import PdfConversionError, PdfEngine
+from histomx.scheduler import FairScheduler, Priority, Requester, Saturated, requester
+from histomx.singleflight import SingleFlight
+from histomx.workers import RenderError, RenderLimits, RWorkerDied, RWorkerPool
+
+
+async def identify_requester(
+    request: Request,
+    x_histomx_caller: typing.Optional[str] = Header(None),
+    x_histomx_priority: typing.Optional[str] = Header(None),
+):
+    """Remember who this request is for, renders are shared fairly among callers.
+
+    Requests with `X-Histomx-Priority: batch` wait behind interactive ones.
+    """
+    priority = Priority.BATCH if x_histomx_priority == "batch" else Priority.INTERACTIVE
+    requester.set(
+        Requester(caller=x_histomx_caller or request.client.host, priority=priority)
+    )
+
+
+app = FastAPI(dependencies=[Depends(identify_requester)])
+
+
+@app.middleware("http")
+async def time_request(request: Request, call_next):
+    """Measure requests, and tell clients where the time went."""
+    record = Timings()
+    timings.set(record)
+    start = time.perf_counter()
+    response = await call_next(request)
+    total = time.perf_counter() - start
+
+    endpoint = request.scope.get("endpoint")
+    REQUEST_SECONDS.labels(
+        handler=endpoint.__name__ if endpoint else "none",
+        template=record.template,
+    ).observe(total)
+    record.add("total", total)
+    response.headers["Server-Timing"] = record.header()
+    return response
 
 
 class Settings(BaseSettings):
@@ -21,109 +83,537 @@ class Settings(BaseSettings):
         env_prefix = "HISTOMX_"
 
     templates: dict[str, str]
+    # Optional R script per template, computing what only depends on the
+    # RCC file. Its value is cached and handed to the template as an RDS
+    # file, so reports only differing by their metadata don't redo it.
+    analyses: dict[str, str] = {}
+
+    # Number of long-lived R processes, and how many reports each of them
+    # renders before being replaced by a fresh one.
+    workers: int = os.cpu_count() or 1
+    worker_max_jobs: int = 50
+    # Limits of a single render, a worker going over them is killed.
+    render_timeout: float = 80
+    render_cpu_seconds: typing.Optional[int] = 300
+    render_memory_bytes: typing.Optional[int] = None
+    # Requests waiting for a worker, beyond which we answer 429.
+    max_waiting_renders: int = 20
+    # Packages attached once per worker instead of once per report.
+    worker_packages: list[str] = [
+        "jsonlite",
+        "knitr",
+        "rmarkdown",
+        "prettydoc",
+        "kableExtra",
+        "NormqPCR",
+        "RCRnorm",
+        "RUVSeq",
+    ]
+
+    # Rendered reports are kept here, shared by all the service's processes.
+    cache_dir: Path = Path(tempfile.gettempdir()) / "histomx-cache"
+    cache_max_bytes: int = 2 * 1024**3
+
+    # wkhtmltopdf conversions, limited separately from R renders.
+    pdf_concurrency: int = os.cpu_count() or 1
+    pdf_timeout: float = 60
+    # Also convert every HTML report to pdf as soon as it is rendered.
+    pdf_with_html: bool = False
+
+    # Reports requested through the job API, at most `job_concurrency` of
+    # them rendering and `job_max_queued` waiting at any given time.
+    job_concurrency: int = os.cpu_count() or 1
+    job_max_queued: int = 100
+    job_keep_seconds: int = 3600
+
+    batch_max_reports: int = 100
 
 
 settings = Settings()
 
+cache = ReportCache(settings.cache_dir, max_bytes=settings.cache_max_bytes)
+
+pool = RWorkerPool(
+    size=settings.workers,
+    max_jobs=settings.worker_max_jobs,
+    packages=settings.worker_packages,
+    limits=RenderLimits(
+        timeout=settings.render_timeout,
+        cpu_seconds=settings.render_cpu_seconds,
+        memory_bytes=settings.render_memory_bytes,
+    ),
+)
+R_WORKERS.set_function(lambda: pool.size)
+
+scheduler = FairScheduler(
+    slots=settings.workers,
+    max_waiting=settings.max_waiting_renders,
+)
+
+pdf_engine = PdfEngine(
+    concurrency=settings.pdf_concurrency,
+    timeout=settings.pdf_timeout,
+)
+
+# Identical requests arriving together share a single render.
+renders = SingleFlight()
+
+jobs = JobQueue(
+    max_queued=settings.job_max_queued,
+    concurrency=settings.job_concurrency,
+    keep_for=settings.job_keep_seconds,
+)
+
+
+@app.exception_handler(Saturated)
+def saturated_handler(request: Request, exc: Saturated):
+    return JSONResponse(
+        status_code=429,
+        content=dict(detail="Too many reports are being generated, try again later."),
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+# Answered from the event loop, so that renders keeping every thread
+# busy do not make a loaded node look down to its clients.
+@app.get("/health")
+async def get_health():
+    return dict(status="ok", workers=pool.size)
+
+
+@app.on_event("startup")
+async def start_workers():
+    pool.start()
+    jobs.start()
+
+
+@app.on_event("shutdown")
+async def close_workers():
+    await jobs.close()
+    pool.close()
+
+
 Templates = Enum("Templates", {k: k for k in settings.templates})
 
 
-class HashableBaseModel(BaseModel):
-    def __hash__(self):
-        return hash((type(self), self.json()))
+class ReportStyle(str, Enum):
+    HTML = "html"
+    PDF = "pdf"
 
 
-class ReportParameters(HashableBaseModel):
-    rccdata: bytes
+class ReportMetadata(BaseModel):
     template: Templates
     rna_metadata: dict[str, typing.Any]
     patient_metadata: dict[str, typing.Any]
 
+    def analysis_path(self) -> typing.Optional[str]:
+        return settings.analyses.get(self.template.value)
+
+    def digest(self):
+        return report_digest(
+            template=self.template.value,
+            template_path=settings.templates[self.template.value],
+            rcc_digest=self.rcc_digest(),
+            rna_metadata=self.rna_metadata,
+            patient_metadata=self.patient_metadata,
+            analysis_path=self.analysis_path(),
+        )
 
-@functools.lru_cache(maxsize=32)
-def get_histomx_html(params: ReportParameters):
-    rmdfilepath = settings.templates[params.template.value]
+    def analysis_digest(self):
+        return analysis_digest(self.analysis_path(), self.rcc_digest())
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmpdirpath = Path(tmpdir)
 
-        htmloutpath = tmpdirpath / "output_file.html"
-        rccfilepath = tmpdirpath / "input_file.rcc"
-        rnajsonpath = tmpdirpath / "rna_file.json"
-        patientjsonpath = tmpdirpath / "patient_file.json"
+class ReportParameters(ReportMetadata):
+    rccdata: bytes
+
+    def rcc_digest(self):
+        return hashlib.sha256(self.rccdata).hexdigest()
 
+    def rcc_file(self, workdir: Path) -> Path:
+        rccfilepath = workdir / "input_file.rcc"
         with rccfilepath.open(mode="wb") as rccfile:
-            rccfile.write(params.rccdata)
-
-        for jsonpath, jsondata in [
-            (rnajsonpath, params.rna_metadata),
-            (patientjsonpath, params.patient_metadata),
-        ]:
-            with jsonpath.open(mode="w") as jsonfile:
-                json.dump(jsondata, jsonfile)
-
-        p = subprocess.run(
-            [
-                "R",
-                "-e",
-                f"""
-        rmarkdown::render("{rmdfilepath}",
-            output_file="{htmloutpath}",
-            params=list(
-                rcc_file="{rccfilepath}",
-                rna_file="{rnajsonpath}",
-                patient_file="{patientjsonpath}"
-            )
-        )
-        """,
-            ]
-        )
+            rccfile.write(self.rccdata)
+        return rccfilepath
 
-        if p.returncode != 0:
-            raise HTTPException(
-                status_code=500,
-                detail="We had a problem generating the HTML report.",
-            )
 
-        with htmloutpath.open(mode="rb") as htmlfile:
-            return htmlfile.read()
+class UploadedReportParameters(ReportMetadata):
+    """Parameters of a multipart request, the RCC file is already on disk."""
 
+    rccfilepath: Path
+    rccdigest: str
 
-@app.post("/histomx_report/html")
-@functools.lru_cache(maxsize=32)
-def generate_histomx_html_report(params: ReportParameters):
-    html = get_histomx_html(params)
-    return HTMLResponse(content=html)
+    def rcc_digest(self):
+        return self.rccdigest
 
+    def rcc_file(self, workdir: Path) -> Path:
+        return self.rccfilepath
 
-@app.post("/histomx_report/pdf")
-@functools.lru_cache(maxsize=32)
-def generate_histomx_pdf_report(params: ReportParameters):
-    html = get_histomx_html(params)
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmpdirpath = Path(tmpdir)
+def lookup(params: ReportMetadata, key: str, kind: str) -> typing.Optional[Path]:
+    """Look up a report in the cache, counting hits and misses."""
+    template = params.template.value
+    record = timings.get()
+    if record is not None:
+        record.template = template
+
+    cached = cache.get(key, kind)
+    result = "miss" if cached is None else "hit"
+    CACHE_LOOKUPS.labels(template=template, kind=kind, result=result).inc()
+    return cached
+
+
+def run_in_r(template: str, stage: str, histogram, scriptpath, **kwargs):
+    """Run a render on an R worker, once the scheduler lets us."""
+    with scheduler.slot(requester.get()) as waited:
+        observe(QUEUE_SECONDS, "queue", template, waited)
+        with RENDERS_IN_FLIGHT.labels(template=template).track_inprogress(), timed(
+            histogram, stage, template
+        ):
+            try:
+                pool.render(scriptpath, **kwargs)
+            except RWorkerDied as e:
+                code = str(e.returncode)
+                R_WORKER_EXITS.labels(template=template, code=code).inc()
+                raise
+
+
+def get_histomx_analysis(params: ReportMetadata, key: str) -> Path:
+    cached = lookup(params, key, "rds")
+    if cached is not None:
+        return cached
+    return renders.do((key, "rds"), run_histomx_analysis, params, key)
 
-        htmloutpath = tmpdirpath / "output_file.html"
-        pdfoutpath = tmpdirpath / "output_file.pdf"
 
-        with htmloutpath.open(mode="wb") as htmlfile:
-            htmlfile.write(html)
+def run_histomx_analysis(params: ReportMetadata, key: str) -> Path:
+    cached = cache.get(key, "rds")
+    if cached is not None:
+        return cached
 
-        p = subprocess.run(["wkhtmltopdf", htmloutpath, pdfoutpath])
-        if p.returncode != 0:
+    template = params.template.value
+
+    with tempfile.TemporaryDirectory() as tmpdir, cache.writing(
+        key, "rds"
+    ) as rdsoutpath:
+        tmpdirpath = Path(tmpdir)
+
+        with timed(IO_SECONDS, "io", template):
+            rccfilepath = params.rcc_file(tmpdirpath)
+
+        try:
+            run_in_r(
+                template,
+                "analysis",
+                ANALYSIS_SECONDS,
+                params.analysis_path(),
+                output_file=rdsoutpath,
+                workdir=tmpdirpath,
+                params=dict(rcc_file=rccfilepath),
+                kind="analysis",
+            )
+        except RenderError:
             raise HTTPException(
                 status_code=500,
-                detail="We had a problem converting the HTML report to pdf.",
+                detail="We had a problem analysing the RCC file.",
             )
 
+    return cache.path(key, "rds")
+
+
+def get_histomx_html(params: ReportMetadata, key: str) -> Path:
+    cached = lookup(params, key, "html")
+    if cached is not None:
+        return cached
+    htmlpath = renders.do((key, "html"), render_histomx_html, params, key)
+
+    if settings.pdf_with_html:
+        # Convert it right away, so the pdf is cached by the time it's asked for.
         try:
-            with pdfoutpath.open(mode="rb") as pdffile:
-                pdf = pdffile.read()
-        except FileNotFoundError:
+            convert_histomx_pdf(params, key, htmlpath)
+        except HTTPException:
+            pass  # The HTML report is fine, the pdf will be retried on demand.
+
+    return htmlpath
+
+
+def render_histomx_html(params: ReportMetadata, key: str) -> Path:
+    # Someone else might have rendered it since we last looked.
+    cached = cache.get(key, "html")
+    if cached is not None:
+        return cached
+
+    template = params.template.value
+    rmdfilepath = settings.templates[template]
+
+    renderparams = {}
+    if params.analysis_path() is not None:
+        # The expensive part, shared by all reports on the same RCC file.
+        renderparams["analysis_file"] = get_histomx_analysis(
+            params, params.analysis_digest()
+        )
+
+    with tempfile.TemporaryDirectory() as tmpdir, cache.writing(
+        key, "html"
+    ) as htmloutpath:
+        tmpdirpath = Path(tmpdir)
+
+        with timed(IO_SECONDS, "io", template):
+            rccfilepath = params.rcc_file(tmpdirpath)
+            rnajsonpath = tmpdirpath / "rna_file.json"
+            patientjsonpath = tmpdirpath / "patient_file.json"
+
+            for jsonpath, jsondata in [
+                (rnajsonpath, params.rna_metadata),
+                (patientjsonpath, params.patient_metadata),
+            ]:
+                with jsonpath.open(mode="w") as jsonfile:
+                    json.dump(jsondata, jsonfile)
+
+        renderparams.update(
+            rcc_file=rccfilepath,
+            rna_file=rnajsonpath,
+            patient_file=patientjsonpath,
+        )
+        try:
+            run_in_r(
+                template,
+                "render",
+                RENDER_SECONDS,
+                rmdfilepath,
+                output_file=htmloutpath,
+                workdir=tmpdirpath,
+                params=renderparams,
+            )
+        except RenderError:
             raise HTTPException(
                 status_code=500,
-                detail="We had a problem generating the report :-(",
+                detail="We had a problem generating the HTML report.",
             )
 
-    return Response(content=pdf, media_type="application/pdf")
+    return cache.path(key, "html")
+
+
+def get_histomx_pdf(params: ReportMetadata, key: str) -> Path:
+    cached = lookup(params, key, "pdf")
+    if cached is not None:
+        return cached
+    # This waits for, rather than duplicates, an HTML render in progress.
+    htmlpath = get_histomx_html(params, key)
+    return convert_histomx_pdf(params, key, htmlpath)
+
+
+def convert_histomx_pdf(params: ReportMetadata, key: str, htmlpath: Path) -> Path:
+    # Only ever called with the HTML report at hand: a flight waiting for
+    # another one, itself waiting for the first, would never land.
+    return renders.do((key, "pdf"), render_histomx_pdf, params, key, htmlpath)
+
+
+def render_histomx_pdf(params: ReportMetadata, key: str, htmlpath: Path) -> Path:
+    cached = cache.get(key, "pdf")
+    if cached is not None:
+        return cached
+
+    try:
+        with cache.writing(key, "pdf") as pdfoutpath, timed(
+            PDF_SECONDS, "pdf", params.template.value
+        ):
+            pdf_engine.convert(htmlpath, pdfoutpath)
+    except PdfConversionError:
+        raise HTTPException(
+            status_code=500,
+            detail="We had a problem converting the HTML report to pdf.",
+        )
+
+    return cache.path(key, "pdf")
+
+
+def admit_request():
+    """Batch work is only admitted up front, see FairScheduler.slot."""
+    who = requester.get()
+    if who.priority == Priority.BATCH:
+        scheduler.admit(who.priority)
+
+
+# Reports are served straight from the cache, without loading them in memory.
+@app.post("/histomx_report/html", dependencies=[Depends(admit_request)])
+def generate_histomx_html_report(params: ReportParameters):
+    return FileResponse(
+        get_histomx_html(params, params.digest()), media_type="text/html"
+    )
+
+
+@app.post("/histomx_report/pdf", dependencies=[Depends(admit_request)])
+def generate_histomx_pdf_report(params: ReportParameters):
+    return FileResponse(
+        get_histomx_pdf(params, params.digest()), media_type="application/pdf"
+    )
+
+
+REPORT_GETTERS = {
+    ReportStyle.HTML: get_histomx_html,
+    ReportStyle.PDF: get_histomx_pdf,
+}
+
+
+@app.post("/histomx_report/upload/{style}", dependencies=[Depends(admit_request)])
+def generate_histomx_report_from_upload(
+    style: ReportStyle,
+    rcc_file: UploadFile = File(...),
+    template: Templates = Form(...),
+    rna_metadata: Json[dict[str, typing.Any]] = Form({}),
+    patient_metadata: Json[dict[str, typing.Any]] = Form({}),
+):
+    """Same as the JSON endpoints, with the RCC file sent as multipart data."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rccfilepath = Path(tmpdir) / "input_file.rcc"
+        rccdigest = hashlib.sha256()
+        with rccfilepath.open(mode="wb") as rccfile, timed(
+            IO_SECONDS, "io", template.value
+        ):
+            for chunk in iter(lambda: rcc_file.file.read(1 << 16), b""):
+                rccdigest.update(chunk)
+                rccfile.write(chunk)
+
+        params = UploadedReportParameters(
+            template=template,
+            rna_metadata=rna_metadata,
+            patient_metadata=patient_metadata,
+            rccfilepath=rccfilepath,
+            rccdigest=rccdigest.hexdigest(),
+        )
+        path = REPORT_GETTERS[style](params, params.digest())
+
+    # The media type is guessed from the file extension.
+    return FileResponse(path)
+
+
+# On the event loop, which owns the job queue.
+@app.post("/histomx_report/jobs/{style}", status_code=202)
+async def submit_histomx_report_job(style: ReportStyle, params: ReportParameters):
+    # Jobs wait for their turn behind interactive requests.
+    requester.set(Requester(caller=requester.get().caller, priority=Priority.BATCH))
+    # This reads the template, maybe for the first time.
+    key = await run_in_threadpool(params.digest)
+    try:
+        job = jobs.submit(REPORT_GETTERS[style], params, key)
+    except QueueFull:
+        raise Saturated(retry_after=scheduler.retry_after(Priority.BATCH))
+    return dict(id=job.id, status=job.status)
+
+
+def get_job(job_id: str):
+    try:
+        return jobs.jobs[job_id]
+    except KeyError:
+        raise HTTPException(status_code=404, detail="No such job.")
+
+
+@app.get("/histomx_report/jobs/{job_id}")
+def get_histomx_report_job(job_id: str):
+    job = get_job(job_id)
+    return dict(id=job.id, status=job.status, detail=job.detail)
+
+
+@app.get("/histomx_report/jobs/{job_id}/result")
+def get_histomx_report_job_result(job_id: str):
+    job = get_job(job_id)
+    if job.status != JobStatus.DONE:
+        raise HTTPException(status_code=409, detail=f"This job is {job.status}.")
+    if not job.result.exists():
+        raise HTTPException(status_code=410, detail="This report has expired.")
+    # The media type is guessed from the file extension.
+    return FileResponse(job.result)
+
+
+class BatchParameters(BaseModel):
+    style: ReportStyle = ReportStyle.HTML
+    reports: list[ReportParameters]
+
+
+class ZipStream:
+    """Write-only file object buffering what zipfile writes until it's read.
+
+    Without `seek`, zipfile writes data descriptors after each member
+    instead of going back to update their headers, which lets us send
+    each member as soon as it is written.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def run_as(who: Requester, func, *args):
+    """Call `func` in a new context, on behalf of `who`."""
+    context = contextvars.copy_context()
+    context.run(requester.set, who)
+    return context.run(func, *args)
+
+
+def generate_histomx_batch_zip(batch: BatchParameters, who: Requester):
+    get_report = REPORT_GETTERS[batch.style]
+    manifest = []
+    stream = ZipStream()
+
+    with ThreadPoolExecutor(max_workers=pool.size) as executor, zipfile.ZipFile(
+        stream, mode="w", compression=zipfile.ZIP_DEFLATED
+    ) as archive:
+        futures = {
+            executor.submit(run_as, who, get_report, params, params.digest()): index
+            for index, params in enumerate(batch.reports)
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                path = future.result()
+            except HTTPException as e:
+                manifest.append(dict(index=index, error=e.detail))
+            except Exception:
+                manifest.append(dict(index=index, error="Unexpected error."))
+            else:
+                filename = f"report-{index:03d}.{batch.style.value}"
+                archive.write(path, arcname=filename)
+                manifest.append(dict(index=index, file=filename))
+                yield stream.pop()
+
+        manifest.sort(key=lambda entry: entry["index"])
+        archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+
+    yield stream.pop()
+
+
+@app.post("/histomx_report/batch")
+def generate_histomx_batch_report(batch: BatchParameters):
+    if len(batch.reports) > settings.batch_max_reports:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {settings.batch_max_reports} reports per batch.",
+        )
+    scheduler.admit(Priority.BATCH)
+
+    who = Requester(caller=requester.get().caller, priority=Priority.BATCH)
+    return StreamingResponse(
+        generate_histomx_batch_zip(batch, who),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="histomx.zip"'},
+    )
@@ -0,0 +1,141 @@
+import functools
+import hashlib
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+
+@functools.lru_cache(maxsize=None)
+def _file_digest(path, mtime_ns, size):
+    digest = hashlib.sha256()
+    with open(path, mode="rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    """Return the sha256 of a file, only re-reading it when it changed."""
+    stat = os.stat(path)
+    return _file_digest(str(path), stat.st_mtime_ns, stat.st_size)
+
+
+def canonical_json(data):
+    return json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
+
+
+def _digest(parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def report_digest(
+    template,
+    template_path,
+    rcc_digest,
+    rna_metadata,
+    patient_metadata,
+    analysis_path=None,
+):
+    """Digest of everything that goes into a report.
+
+    Changing the template file changes the digest, so there is no need
+    to clear the cache when deploying a new version of a template.
+    """
+    parts = [
+        template,
+        file_digest(template_path),
+        rcc_digest,
+        canonical_json(rna_metadata),
+        canonical_json(patient_metadata),
+    ]
+    if analysis_path is not None:
+        parts.append(analysis_digest(analysis_path, rcc_digest))
+    return _digest(parts)
+
+
+def analysis_digest(analysis_path, rcc_digest):
+    """Digest of an analysis, which only depends on the script and the RCC file."""
+    return _digest(["analysis", file_digest(analysis_path), rcc_digest])
+
+
+class ReportCache:
+    """Content addressed artifacts on disk, evicted in LRU order.
+
+    Files are written atomically and lookups only touch the filesystem,
+    so any number of processes can share the same directory.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        # What we think the cache weighs, the directory is only scanned
+        # when this goes over the limit. What other processes wrote since
+        # the last scan is only seen by the next one.
+        self._size = None
+        self._size_lock = threading.Lock()
+
+    def path(self, key, kind):
+        return self.directory / key[:2] / f"{key}.{kind}"
+
+    def get(self, key, kind):
+        """Return the path of a cached artifact or None."""
+        path = self.path(key, kind)
+        try:
+            # The modification time is used as "last used" for eviction.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    @contextmanager
+    def writing(self, key, kind):
+        """Yield a temporary path to write an artifact to.
+
+        The artifact is published to the cache, atomically, only if the
+        block exits without an exception.
+        """
+        path = self.path(key, kind)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Keep the extension, some tools insist on adding it otherwise.
+        tmppath = path.parent / f".{uuid.uuid4()}.{kind}"
+        try:
+            yield tmppath
+            size = tmppath.stat().st_size
+            os.replace(tmppath, path)
+        finally:
+            tmppath.unlink(missing_ok=True)
+        self._added(size)
+
+    def _added(self, size):
+        with self._size_lock:
+            if self._size is not None:
+                self._size += size
+            if self._size is None or self._size > self.max_bytes:
+                self._size = self.evict()
+
+    def evict(self):
+        """Remove the least recently used artifacts, return the size left."""
+        entries = []
+        for path in self.directory.glob("*/*"):
+            if path.name.startswith("."):
+                continue  # Still being written.
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue  # Evicted by another process.
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+        return total
@@ -0,0 +1,95 @@
+import asyncio
+import contextvars
+import time
+import typing
+import uuid
+from dataclasses import dataclass, field
+from enum import Enum
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+@dataclass
+class Job:
+    func: typing.Callable
+    args: tuple
+    # Jobs run in the context they were submitted from.
+    context: contextvars.Context = field(default_factory=contextvars.copy_context)
+    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    status: JobStatus = JobStatus.QUEUED
+    detail: typing.Optional[str] = None
+    result: typing.Any = None
+    finished_at: typing.Optional[float] = None
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    """A bounded queue of blocking calls, run `concurrency` at a time.
+
+    Finished jobs are forgotten `keep_for` seconds after they are done.
+    """
+
+    def __init__(self, max_queued, concurrency, keep_for):
+        self.max_queued = max_queued
+        self.concurrency = concurrency
+        self.keep_for = keep_for
+        self.jobs: dict[str, Job] = {}
+        self._queue: typing.Optional[asyncio.Queue] = None
+        self._runners: list[asyncio.Task] = []
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._runners = [
+            asyncio.create_task(self._run()) for _ in range(self.concurrency)
+        ]
+
+    async def close(self):
+        for runner in self._runners:
+            runner.cancel()
+        await asyncio.gather(*self._runners, return_exceptions=True)
+
+    def submit(self, func, *args):
+        """Queue a call to `func(*args)`, from the event loop the queue runs on."""
+        self._forget_old_jobs()
+        job = Job(func=func, args=args)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFull()
+        self.jobs[job.id] = job
+        return job
+
+    def _forget_old_jobs(self):
+        too_old = time.monotonic() - self.keep_for
+        for job_id, job in list(self.jobs.items()):
+            if job.finished_at is not None and job.finished_at < too_old:
+                del self.jobs[job_id]
+
+    async def _run(self):
+        while True:
+            job = await self._queue.get()
+            job.status = JobStatus.RUNNING
+            try:
+                job.result = await run_in_threadpool(
+                    job.context.run, job.func, *job.args
+                )
+            except HTTPException as e:
+                job.status, job.detail = JobStatus.FAILED, e.detail
+            except Exception:
+                job.status, job.detail = JobStatus.FAILED, "Unexpected error."
+            else:
+                job.status = JobStatus.DONE
+            finally:
+                job.finished_at = time.monotonic()
+                self._queue.task_done()
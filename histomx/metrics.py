@@ -0,0 +1,101 @@
+import contextvars
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Renders take from seconds to minutes, the default buckets stop at 10s.
+SLOW_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 320)
+
+REQUEST_SECONDS = Histogram(
+    "histomx_request_seconds",
+    "Time spent answering requests, until the response starts.",
+    ["handler", "template"],
+    buckets=SLOW_BUCKETS,
+)
+QUEUE_SECONDS = Histogram(
+    "histomx_queue_seconds",
+    "Time spent waiting for an R worker.",
+    ["template"],
+    buckets=SLOW_BUCKETS,
+)
+RENDER_SECONDS = Histogram(
+    "histomx_render_seconds",
+    "Time spent rendering reports in R.",
+    ["template"],
+    buckets=SLOW_BUCKETS,
+)
+ANALYSIS_SECONDS = Histogram(
+    "histomx_analysis_seconds",
+    "Time spent analysing RCC files in R, before rendering reports.",
+    ["template"],
+    buckets=SLOW_BUCKETS,
+)
+PDF_SECONDS = Histogram(
+    "histomx_pdf_seconds",
+    "Time spent converting reports to pdf.",
+    ["template"],
+    buckets=SLOW_BUCKETS,
+)
+IO_SECONDS = Histogram(
+    "histomx_io_seconds",
+    "Time spent writing the inputs of a render to disk.",
+    ["template"],
+)
+
+CACHE_LOOKUPS = Counter(
+    "histomx_cache_lookups",
+    "Reports looked up in the cache.",
+    ["template", "kind", "result"],
+)
+RENDERS_IN_FLIGHT = Gauge(
+    "histomx_renders_in_flight",
+    "Reports being rendered in R.",
+    ["template"],
+)
+R_WORKERS = Gauge(
+    "histomx_r_workers",
+    "R processes in the worker pool.",
+)
+R_WORKER_EXITS = Counter(
+    "histomx_r_worker_exits",
+    "R processes which died while rendering, by exit code.",
+    ["template", "code"],
+)
+
+
+class Timings:
+    """How long the stages of a request took, for its Server-Timing header."""
+
+    def __init__(self):
+        self.template = ""
+        self.durations: dict[str, float] = {}
+
+    def add(self, name, seconds):
+        self.durations[name] = self.durations.get(name, 0) + seconds
+
+    def header(self):
+        return ", ".join(
+            f"{name};dur={seconds * 1000:.1f}"
+            for name, seconds in self.durations.items()
+        )
+
+
+# Set per request, threads started by the request share its Timings.
+timings: contextvars.ContextVar = contextvars.ContextVar("timings", default=None)
+
+
+def observe(histogram, name, template, seconds):
+    histogram.labels(template=template).observe(seconds)
+    record = timings.get()
+    if record is not None:
+        record.add(name, seconds)
+
+
+@contextmanager
+def timed(histogram, name, template):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(histogram, name, template, time.perf_counter() - start)
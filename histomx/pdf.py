@@ -0,0 +1,34 @@
+import subprocess
+import threading
+
+
+class PdfConversionError(Exception):
+    pass
+
+
+class PdfEngine:
+    """Convert HTML files to PDF, at most `concurrency` at a time.
+
+    Conversions taking longer than `timeout` seconds are killed. Each of
+    them starts its own wkhtmltopdf, which has no way to convert several
+    documents from one long-lived process.
+    """
+
+    def __init__(self, concurrency, timeout):
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(concurrency)
+
+    def convert(self, htmlpath, pdfpath):
+        with self._slots:
+            try:
+                p = subprocess.run(
+                    ["wkhtmltopdf", "--quiet", str(htmlpath), str(pdfpath)],
+                    timeout=self.timeout,
+                )
+            except subprocess.TimeoutExpired:
+                raise PdfConversionError("wkhtmltopdf timed out.")
+
+        if p.returncode != 0:
+            raise PdfConversionError(f"wkhtmltopdf exited with {p.returncode}.")
+        if not pdfpath.exists():
+            raise PdfConversionError("wkhtmltopdf did not produce a pdf.")
@@ -0,0 +1,115 @@
+import contextvars
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from enum import IntEnum
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BATCH = 1
+
+
+@dataclass(frozen=True)
+class Requester:
+    caller: str
+    priority: Priority = Priority.INTERACTIVE
+
+
+# Who the current render is for, set per request and inherited by the
+# threads and jobs started on its behalf.
+requester = contextvars.ContextVar("requester", default=Requester(caller="anonymous"))
+
+
+class Saturated(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Saturated, retry after {retry_after}s.")
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    granted = False
+
+
+class FairScheduler:
+    """Hand out a fixed number of slots to callers waiting for them.
+
+    Interactive requests are always served before batch ones. Within a
+    priority, callers are served round-robin so that one caller with
+    many requests can not starve the others.
+    """
+
+    def __init__(self, slots, max_waiting):
+        self.slots = slots
+        self.max_waiting = max_waiting
+        self._free = slots
+        self._cond = threading.Condition()
+        self._waiting = {priority: OrderedDict() for priority in Priority}
+        # Moving average of how long a slot is held, for Retry-After.
+        self._average_hold = 10.0
+
+    def waiting(self, priority):
+        """Number of tickets waiting with the same or a higher priority."""
+        return sum(
+            len(tickets)
+            for p, callers in self._waiting.items()
+            if p <= priority
+            for tickets in callers.values()
+        )
+
+    def retry_after(self, priority):
+        ahead = self.waiting(priority)
+        return max(1, math.ceil(self._average_hold * (ahead / self.slots + 1)))
+
+    def admit(self, priority):
+        """Raise Saturated if too many requests are waiting already."""
+        with self._cond:
+            if self._free == 0 and self.waiting(priority) >= self.max_waiting:
+                raise Saturated(retry_after=self.retry_after(priority))
+
+    @contextmanager
+    def slot(self, who: Requester):
+        """Wait for a free slot and hold it, yield how long we waited."""
+        requested = time.monotonic()
+        # Batch work is admitted up front, by the endpoints accepting it.
+        if who.priority == Priority.INTERACTIVE:
+            self.admit(who.priority)
+
+        ticket = _Ticket()
+        with self._cond:
+            callers = self._waiting[who.priority]
+            callers.setdefault(who.caller, deque()).append(ticket)
+            self._dispatch()
+            while not ticket.granted:
+                self._cond.wait()
+
+        start = time.monotonic()
+        try:
+            yield start - requested
+        finally:
+            held = time.monotonic() - start
+            with self._cond:
+                self._average_hold = 0.8 * self._average_hold + 0.2 * held
+                self._free += 1
+                self._dispatch()
+
+    def _dispatch(self):
+        while self._free:
+            for callers in self._waiting.values():
+                if callers:
+                    break
+            else:
+                return
+
+            # The caller served next goes to the back of the line.
+            caller, tickets = callers.popitem(last=False)
+            ticket = tickets.popleft()
+            if tickets:
+                callers[caller] = tickets
+
+            ticket.granted = True
+            self._free -= 1
+            self._cond.notify_all()
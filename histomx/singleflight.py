@@ -0,0 +1,36 @@
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """Run a function only once for concurrent calls sharing the same key.
+
+    The first caller runs it, the others wait for, and get, its result
+    or exception. This only deduplicates calls within one process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[object, Future] = {}
+
+    def do(self, key, func, *args):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
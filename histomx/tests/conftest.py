@@ -0,0 +1,9 @@
+import json
+import os
+from pathlib import Path
+
+# Importing anything from histomx configures the service, which needs templates.
+os.environ.setdefault(
+    "HISTOMX_TEMPLATES",
+    json.dumps({"DEFAULT": str(Path(__file__).parents[1] / "example.Rmd")}),
+)
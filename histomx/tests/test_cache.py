@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from histomx.cache import ReportCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ReportCache(tmp_path, max_bytes=10)
+
+
+def write(cache, key, data=b"1234", kind="html"):
+    with cache.writing(key, kind) as path:
+        path.write_bytes(data)
+    return cache.path(key, kind)
+
+
+def test_hit_and_miss(cache):
+    assert cache.get("ab12", "html") is None
+    path = write(cache, "ab12")
+    assert cache.get("ab12", "html") == path
+    assert path.read_bytes() == b"1234"
+    assert cache.get("ab12", "pdf") is None
+
+
+def test_failed_write_is_not_published(cache):
+    with pytest.raises(ValueError):
+        with cache.writing("ab12", "html") as path:
+            path.write_bytes(b"half a rep")
+            raise ValueError()
+    assert cache.get("ab12", "html") is None
+    assert not list(cache.directory.glob("*/*"))
+
+
+def test_least_recently_used_is_evicted(cache):
+    first, second = write(cache, "aa01"), write(cache, "bb01")
+    os.utime(first, (1, 1))
+    os.utime(second, (2, 2))
+    # Using it makes it the most recently used one.
+    cache.get("aa01", "html")
+
+    third = write(cache, "cc01")
+    assert first.exists()
+    assert not second.exists()
+    assert third.exists()
+
+
+def test_directory_is_only_scanned_over_the_limit(cache, monkeypatch):
+    scans = []
+    evict = cache.evict
+    monkeypatch.setattr(cache, "evict", lambda: scans.append(None) or evict())
+
+    # Once, to know where we start from.
+    write(cache, "aa01")
+    write(cache, "bb01")
+    assert len(scans) == 1
+
+    write(cache, "cc01")
+    assert len(scans) == 2
+    assert cache._size <= cache.max_bytes
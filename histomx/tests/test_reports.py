@@ -0,0 +1,105 @@
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import histomx
+from histomx.cache import ReportCache
+
+
+class FakeRenders:
+    """Stand in for R and wkhtmltopdf, recording what they are asked to do."""
+
+    def __init__(self):
+        self.done = []
+        self.started = threading.Event()
+        # Cleared to hold renders until it's set again.
+        self.release = threading.Event()
+        self.release.set()
+
+    def run_in_r(self, template, stage, histogram, scriptpath, output_file, **kwargs):
+        self.started.set()
+        assert self.release.wait(timeout=5)
+        output_file.write_text("<html></html>")
+        self.done.append("html")
+
+    def convert(self, htmlpath, pdfpath):
+        pdfpath.write_bytes(b"%PDF")
+        self.done.append("pdf")
+
+
+@pytest.fixture
+def renders(tmp_path, monkeypatch):
+    renders = FakeRenders()
+    monkeypatch.setattr(histomx, "cache", ReportCache(tmp_path, max_bytes=1 << 20))
+    monkeypatch.setattr(histomx, "run_in_r", renders.run_in_r)
+    monkeypatch.setattr(histomx.pdf_engine, "convert", renders.convert)
+    monkeypatch.setattr(histomx.settings, "pdf_with_html", True)
+    return renders
+
+
+def parameters():
+    params = histomx.ReportParameters(
+        template="DEFAULT", rna_metadata={}, patient_metadata={}, rccdata=b"rcc"
+    )
+    return params, params.digest()
+
+
+def test_pdf_with_html(renders):
+    params, key = parameters()
+    assert histomx.get_histomx_html(params, key).suffix == ".html"
+    assert renders.done == ["html", "pdf"]
+    assert histomx.get_histomx_pdf(params, key).suffix == ".pdf"
+    assert renders.done == ["html", "pdf"]
+
+
+def test_pdf_requested_during_html_render(renders):
+    params, key = parameters()
+    renders.release.clear()
+    results = {}
+
+    def get(kind, getter):
+        results[kind] = getter(params, key)
+
+    html = threading.Thread(
+        target=get, args=("html", histomx.get_histomx_html), daemon=True
+    )
+    pdf = threading.Thread(
+        target=get, args=("pdf", histomx.get_histomx_pdf), daemon=True
+    )
+    html.start()
+    assert renders.started.wait(timeout=5)
+    # The pdf waits for the HTML rendering, which converts it once done.
+    pdf.start()
+    pdf.join(timeout=0.2)
+    renders.release.set()
+    html.join(timeout=5)
+    pdf.join(timeout=5)
+
+    assert not html.is_alive() and not pdf.is_alive()
+    assert results["html"].suffix == ".html"
+    assert results["pdf"].suffix == ".pdf"
+    assert renders.done == ["html", "pdf"]
+
+
+def test_job(renders, monkeypatch):
+    monkeypatch.setattr(histomx.pool, "start", lambda: None)
+    params, key = parameters()
+
+    with TestClient(histomx.app) as client:
+        response = client.post(
+            "/histomx_report/jobs/pdf",
+            data=params.json(),
+            headers={"X-Histomx-Caller": "tests"},
+        )
+        assert response.status_code == 202
+        url = f"/histomx_report/jobs/{response.json()['id']}"
+
+        for _ in range(100):
+            if client.get(url).json()["status"] == "done":
+                break
+            time.sleep(0.05)
+        response = client.get(f"{url}/result")
+        assert response.status_code == 200
+        assert response.content == b"%PDF"
@@ -0,0 +1,76 @@
+import threading
+
+import pytest
+
+from histomx.scheduler import FairScheduler, Priority, Requester, Saturated
+
+ALICE = Requester(caller="alice")
+BOB = Requester(caller="bob")
+BATCH = Requester(caller="alice", priority=Priority.BATCH)
+
+
+def served_order(scheduler, requesters):
+    """Queue `requesters` in order behind a held slot, return the order they're served in."""
+    served = []
+
+    def wait_for_slot(who):
+        with scheduler.slot(who):
+            served.append(who)
+
+    threads = []
+    with scheduler.slot(BOB):
+        for who in requesters:
+            thread = threading.Thread(target=wait_for_slot, args=(who,))
+            thread.start()
+            threads.append(thread)
+            # Queued one after the other.
+            while scheduler.waiting(Priority.BATCH) != len(threads):
+                thread.join(timeout=0.01)
+    for thread in threads:
+        thread.join(timeout=5)
+    return served
+
+
+def test_callers_are_served_round_robin():
+    scheduler = FairScheduler(slots=1, max_waiting=10)
+    assert served_order(scheduler, [ALICE, ALICE, ALICE, BOB]) == [
+        ALICE,
+        BOB,
+        ALICE,
+        ALICE,
+    ]
+
+
+def test_interactive_requests_go_first():
+    scheduler = FairScheduler(slots=1, max_waiting=10)
+    assert served_order(scheduler, [BATCH, ALICE, BATCH, BOB]) == [
+        ALICE,
+        BOB,
+        BATCH,
+        BATCH,
+    ]
+
+
+def test_saturated():
+    scheduler = FairScheduler(slots=1, max_waiting=1)
+    scheduler.admit(Priority.INTERACTIVE)
+
+    def wait_for_slot(who):
+        with scheduler.slot(who):
+            pass
+
+    with scheduler.slot(BOB):
+        waiting = threading.Thread(target=wait_for_slot, args=(BATCH,))
+        waiting.start()
+        while not scheduler.waiting(Priority.BATCH):
+            waiting.join(timeout=0.01)
+
+        # Batch requests waiting don't hold back interactive ones.
+        scheduler.admit(Priority.INTERACTIVE)
+        with pytest.raises(Saturated) as excinfo:
+            scheduler.admit(Priority.BATCH)
+        assert excinfo.value.retry_after >= 1
+
+    waiting.join(timeout=5)
+    assert not scheduler.waiting(Priority.BATCH)
+    scheduler.admit(Priority.BATCH)
@@ -0,0 +1,89 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+from histomx import singleflight
+from histomx.singleflight import SingleFlight
+
+
+class WaitedFuture(Future):
+    """Counts the callers waiting for it."""
+
+    def __init__(self):
+        super().__init__()
+        self.waiting = 0
+        self._waiting_lock = threading.Lock()
+
+    def result(self, timeout=None):
+        with self._waiting_lock:
+            self.waiting += 1
+        return super().result(timeout)
+
+
+@pytest.fixture(autouse=True)
+def waited_future(monkeypatch):
+    monkeypatch.setattr(singleflight, "Future", WaitedFuture)
+
+
+def call_together(flight, func, callers=4):
+    """Call `func` from several threads, while the first call is blocked."""
+    started, release = threading.Event(), threading.Event()
+
+    def blocking():
+        started.set()
+        release.wait(timeout=5)
+        return func()
+
+    with ThreadPoolExecutor(max_workers=callers) as executor:
+        leader = executor.submit(flight.do, "key", blocking)
+        assert started.wait(timeout=5)
+        followers = [
+            executor.submit(flight.do, "key", blocking) for _ in range(callers - 1)
+        ]
+        # Let the followers get to waiting on the leader.
+        (future,) = flight._calls.values()
+        while future.waiting != len(followers):
+            release.wait(timeout=0.01)
+        release.set()
+    return [leader, *followers]
+
+
+def test_concurrent_calls_share_the_result():
+    flight = SingleFlight()
+    calls = []
+
+    def func():
+        calls.append(None)
+        return object()
+
+    futures = call_together(flight, func)
+    results = {id(future.result()) for future in futures}
+    assert len(calls) == 1
+    assert len(results) == 1
+
+    # Only concurrent calls are shared.
+    assert flight.do("key", func) is not futures[0].result()
+    assert len(calls) == 2
+    assert not flight._calls
+
+
+def test_concurrent_calls_share_the_exception():
+    flight = SingleFlight()
+    calls = []
+
+    def func():
+        calls.append(None)
+        raise ValueError("Nope.")
+
+    for future in call_together(flight, func):
+        with pytest.raises(ValueError, match="Nope."):
+            future.result()
+    assert len(calls) == 1
+    assert not flight._calls
+
+
+def test_keys_are_independent():
+    flight = SingleFlight()
+    assert flight.do("a", lambda: 1) == 1
+    assert flight.do("b", lambda: 2) == 2
@@ -0,0 +1,63 @@
+import queue
+
+import pytest
+
+from histomx import workers
+from histomx.workers import RWorkerDied, RWorkerPool
+
+
+class FakeWorker:
+    fail_to_start = False
+
+    def __init__(self, packages, limits):
+        if FakeWorker.fail_to_start:
+            raise FileNotFoundError("Rscript")
+        self.jobs_done = 0
+        self.closed = False
+
+    def render(self, rmdfilepath, output_file, workdir, params, kind):
+        self.jobs_done += 1
+        if rmdfilepath == "crash":
+            raise RWorkerDied("Crashed.", returncode=-9)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(workers, "RWorker", FakeWorker)
+    monkeypatch.setattr(FakeWorker, "fail_to_start", False)
+    pool = RWorkerPool(size=1, max_jobs=10, packages=[])
+    pool.start()
+    yield pool
+    pool.close()
+
+
+def render(pool, rmdfilepath="report.Rmd"):
+    pool.render(rmdfilepath, "report.html", "/tmp", {})
+
+
+def test_worker_is_recycled(pool):
+    pool.max_jobs = 2
+    render(pool)
+    first = pool._idle.queue[0]
+    render(pool)
+    assert first.closed
+    assert pool._idle.queue[0] is not first
+
+
+def test_replacement_failing_to_start(pool):
+    FakeWorker.fail_to_start = True
+    with pytest.raises(RWorkerDied):
+        render(pool, "crash")
+    # The slot is kept, renders fail instead of waiting forever.
+    with pytest.raises(RWorkerDied, match="start"):
+        render(pool)
+    assert pool._idle.qsize() == 1
+
+    FakeWorker.fail_to_start = False
+    render(pool)
+    assert isinstance(pool._idle.get_nowait(), FakeWorker)
+    with pytest.raises(queue.Empty):
+        pool._idle.get_nowait()
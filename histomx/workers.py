@@ -0,0 +1,203 @@
+import json
+import os
+import queue
+import resource
+import select
+import signal
+import subprocess
+import typing
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+
+WORKER_SCRIPT = Path(__file__).parent / "worker.R"
+
+
+class RenderError(Exception):
+    pass
+
+
+class RWorkerDied(RenderError):
+    def __init__(self, message, returncode=None):
+        super().__init__(message)
+        self.returncode = returncode
+
+
+class RenderTimeout(RWorkerDied):
+    pass
+
+
+@dataclass
+class RenderLimits:
+    # Wall clock and CPU time allowed for a single render.
+    timeout: typing.Optional[float] = None
+    cpu_seconds: typing.Optional[int] = None
+    # Address space of a worker, inherited by the processes it starts.
+    memory_bytes: typing.Optional[int] = None
+
+
+class RWorker:
+    """A long-lived R process, with packages preloaded, rendering Rmd files.
+
+    The worker leads its own process group, so that killing it also
+    kills what it started (eg: pandoc.)
+    """
+
+    def __init__(self, packages, limits=RenderLimits()):
+        self.limits = limits
+        reply_fd, child_reply_fd = os.pipe()
+        try:
+            self.process = subprocess.Popen(
+                ["Rscript", str(WORKER_SCRIPT), str(child_reply_fd), *packages],
+                stdin=subprocess.PIPE,
+                pass_fds=(child_reply_fd,),
+                start_new_session=True,
+                text=True,
+            )
+        finally:
+            os.close(child_reply_fd)
+        self.replies = os.fdopen(reply_fd, mode="r")
+        self.jobs_done = 0
+
+        if limits.memory_bytes:
+            memory = (limits.memory_bytes, limits.memory_bytes)
+            resource.prlimit(self.process.pid, resource.RLIMIT_AS, memory)
+
+    def _cpu_seconds_used(self):
+        with open(f"/proc/{self.process.pid}/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        utime, stime = int(fields[11]), int(fields[12])
+        return (utime + stime) / os.sysconf("SC_CLK_TCK")
+
+    def _limit_cpu(self, seconds):
+        # RLIMIT_CPU counts since the process started, so move it forward.
+        soft = int(self._cpu_seconds_used() + seconds) + 1
+        limit = (soft, resource.RLIM_INFINITY)
+        resource.prlimit(self.process.pid, resource.RLIMIT_CPU, limit)
+
+    def render(self, rmdfilepath, output_file, workdir, params, kind="report"):
+        """Render an Rmd file, or save the value of an R script with `kind="analysis"`."""
+        job = dict(
+            id=str(uuid.uuid4()),
+            kind=kind,
+            template=str(rmdfilepath),
+            output_file=str(output_file),
+            workdir=str(workdir),
+            params={k: str(v) for k, v in params.items()},
+        )
+        try:
+            if self.limits.cpu_seconds:
+                self._limit_cpu(self.limits.cpu_seconds)
+            self.process.stdin.write(json.dumps(job) + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, ProcessLookupError, FileNotFoundError):
+            raise self._died("The R worker went away before rendering.")
+
+        ready, _, _ = select.select([self.replies], [], [], self.limits.timeout)
+        if not ready:
+            self.kill()
+            raise self._died("The R worker took too long to render.", RenderTimeout)
+
+        reply = self.replies.readline()
+        if not reply:
+            raise self._died("The R worker went away while rendering.")
+        self.jobs_done += 1
+
+        reply = json.loads(reply)
+        if reply["id"] != job["id"]:
+            raise self._died("The R worker replied to another job.")
+        if reply["status"] != "ok":
+            raise RenderError(reply["status"])
+
+    def _died(self, message, error_class=RWorkerDied):
+        # Make sure it is gone, to know its exit code.
+        try:
+            self.process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            self.kill()
+        return error_class(message, returncode=self.process.returncode)
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass  # Already gone.
+        self.process.wait()
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+        self.replies.close()
+
+
+class RWorkerPool:
+    """A fixed number of R workers, each recycled after `max_jobs` renders.
+
+    Workers that crash or reply garbage are thrown away and replaced.
+    """
+
+    def __init__(self, size, max_jobs, packages, limits=RenderLimits()):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.packages = packages
+        self.limits = limits
+        self._idle = queue.Queue()
+        self._closed = False
+
+    def start(self):
+        for _ in range(self.size):
+            self._idle.put(RWorker(self.packages, self.limits))
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker is not None:
+                worker.close()
+
+    def _replace(self):
+        """Start a new worker, or return None to try again on the next render.
+
+        Whatever happens, the slot goes back to the pool: losing it would
+        eventually leave renders waiting forever for an idle worker.
+        """
+        try:
+            return RWorker(self.packages, self.limits)
+        except OSError:
+            return None
+
+    def _acquire(self):
+        worker = self._idle.get()
+        if worker is None:
+            worker = self._replace()
+        if worker is None:
+            self._idle.put(None)
+            raise RWorkerDied("Could not start an R worker.")
+        return worker
+
+    def _release(self, worker, broken):
+        if self._closed:
+            worker.close()
+            return
+        if broken or worker.jobs_done >= self.max_jobs:
+            worker.close()
+            worker = self._replace()
+        self._idle.put(worker)
+
+    def render(self, rmdfilepath, output_file, workdir, params, kind="report"):
+        worker = self._acquire()
+        broken = True
+        try:
+            worker.render(rmdfilepath, output_file, workdir, params, kind)
+            broken = False
+        except RenderError as e:
+            broken = isinstance(e, RWorkerDied)
+            raise
+        finally:
+            self._release(worker, broken)
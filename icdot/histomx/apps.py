@@ -10,3 +10,4 @@ class HistomxConfig(AppConfig):
 
     def ready(self):
         ensure_group_creation(self)
+        import icdot.histomx.signals  # noqa F401
@@ -0,0 +1,266 @@
+import bisect
+import hashlib
+import threading
+import time
+from urllib.parse import urljoin
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HistomxUnavailable(requests.exceptions.ConnectionError):
+    """Histomx failed too often lately, it was not even tried."""
+
+
+class CircuitBreaker:
+    """Stop calling a service after `threshold` consecutive failures.
+
+    Once `reset_after` seconds have passed, one call is let through to
+    find out whether the service is back, others keep failing fast
+    until it returns.
+    """
+
+    def __init__(self, threshold, reset_after):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def before_call(self, request):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_after:
+                raise HistomxUnavailable(
+                    "Histomx is unavailable, not trying again yet.", request=request
+                )
+            # Let this call through, and wait for it before another one.
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self.reset()
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class HistomxNode:
+    """One histomx service, with its own breaker."""
+
+    def __init__(self, base_url, breaker):
+        self.base_url = base_url
+        self.breaker = breaker
+        # Updated by the health checks.
+        self.healthy = True
+
+    def __repr__(self):
+        return f"<HistomxNode {self.base_url}>"
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.sha256(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing of keys to nodes.
+
+    Each node is placed at `replicas` points of the ring and owns the keys
+    hashed right before them, so adding or removing a node only moves the
+    keys it owns.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        points = sorted(
+            (_hash(f"{node.base_url}#{replica}"), index)
+            for index, node in enumerate(nodes)
+            for replica in range(replicas)
+        )
+        self.nodes = nodes
+        self._hashes = [point for point, _ in points]
+        self._owners = [nodes[index] for _, index in points]
+
+    def nodes_for(self, key):
+        """All the nodes, starting with the one owning `key`, in ring order."""
+        start = bisect.bisect(self._hashes, _hash(key))
+        found = []
+        for i in range(len(self._owners)):
+            node = self._owners[(start + i) % len(self._owners)]
+            if node not in found:
+                found.append(node)
+                if len(found) == len(self.nodes):
+                    break
+        return found
+
+
+class HistomxClient:
+    """Keep-alive connections to histomx, with timeouts, retries and breakers.
+
+    Requests are spread over several histomx nodes by consistent hashing
+    of their content, so that identical reports go to the node which has
+    them cached. When that node fails, or is found down by the health
+    checks, the next one in the ring takes over.
+    """
+
+    # Histomx is saturated or down, but it was not rendering our report.
+    RETRY_STATUSES = (429, 503)
+    # A failure of the service rather than of a single report.
+    FAILURE_STATUSES = (502, 503, 504)
+    # Another node might render the report.
+    FAILOVER_STATUSES = (429, *FAILURE_STATUSES)
+
+    def __init__(
+        self,
+        base_urls,
+        connect_timeout,
+        read_timeout,
+        retries,
+        breaker_threshold,
+        breaker_reset_after,
+        health_check_interval,
+    ):
+        self.nodes = [
+            HistomxNode(url, CircuitBreaker(breaker_threshold, breaker_reset_after))
+            for url in base_urls
+        ]
+        self.ring = HashRing(self.nodes)
+        self.timeout = (connect_timeout, read_timeout)
+        self.health_check_interval = health_check_interval
+        self._health_checks = None
+        self._lock = threading.Lock()
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            # A render that timed out would probably time out again.
+            read=0,
+            status=retries,
+            status_forcelist=self.RETRY_STATUSES,
+            # Rendering a report has no side effect, it's fine to retry.
+            allowed_methods=frozenset(["GET", "POST"]),
+            backoff_factor=0.5,
+            # Histomx might ask for longer than a web request can wait.
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(max_retries=retry))
+        self.session.mount("https://", HTTPAdapter(max_retries=retry))
+        # Health checks are not retried, the next one will tell.
+        self.health_session = requests.Session()
+
+    def reset(self):
+        """Forget what we know about the nodes, consider them all healthy."""
+        for node in self.nodes:
+            node.breaker.reset()
+            node.healthy = True
+
+    def check_health(self):
+        for node in self.nodes:
+            try:
+                response = self.health_session.get(
+                    urljoin(node.base_url, "health"), timeout=self.timeout[0]
+                )
+            except requests.exceptions.RequestException:
+                node.healthy = False
+            else:
+                node.healthy = response.ok
+
+    def _check_health_forever(self):
+        while True:
+            self.check_health()
+            time.sleep(self.health_check_interval)
+
+    def _start_health_checks(self):
+        # Started by the first request rather than on import, so that it
+        # runs in the processes forked by gunicorn.
+        if len(self.nodes) < 2 or not self.health_check_interval:
+            return
+        with self._lock:
+            if self._health_checks is None:
+                self._health_checks = threading.Thread(
+                    target=self._check_health_forever,
+                    name="histomx-health-checks",
+                    daemon=True,
+                )
+                self._health_checks.start()
+
+    def _post(self, node, path, **kwargs):
+        url = urljoin(node.base_url, path)
+        node.breaker.before_call(requests.Request("POST", url))
+        try:
+            response = self.session.post(url, timeout=self.timeout, **kwargs)
+        except requests.exceptions.ReadTimeout:
+            # The node is up, only slow to render.
+            raise
+        except requests.exceptions.RequestException:
+            node.breaker.record_failure()
+            raise
+
+        if response.status_code in self.FAILURE_STATUSES:
+            node.breaker.record_failure()
+        else:
+            node.breaker.record_success()
+        return response
+
+    def post(self, path, key="", **kwargs):
+        """POST to the node owning `key`, or to the next ones if it fails.
+
+        Nodes found down by the health checks are only tried once all the
+        others failed. The last response is returned when every node
+        failed, or the last exception raised if none answered.
+
+        Only connection errors and FAILOVER_STATUSES fail over. Other errors,
+        read timeouts notably, are raised at once: the node might still be
+        rendering the report, another one should not render it too.
+        """
+        if not self.nodes:
+            raise HistomxUnavailable("No histomx service is configured.")
+        self._start_health_checks()
+        nodes = self.ring.nodes_for(key)
+        nodes.sort(key=lambda node: not node.healthy)
+        # Each node is sent the files from where they were when we were called.
+        files = [
+            (file, file.tell())
+            for file in (kwargs.get("files") or {}).values()
+            if hasattr(file, "seek")
+        ]
+
+        response = error = None
+        for node in nodes:
+            for file, position in files:
+                file.seek(position)
+            try:
+                response = self._post(node, path, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                error = e
+                continue
+            if response.status_code not in self.FAILOVER_STATUSES:
+                return response
+        if response is not None:
+            return response
+        raise error
+
+
+client = HistomxClient(
+    base_urls=settings.HISTOMX_SERVICE_URLS,
+    connect_timeout=settings.HISTOMX_CONNECT_TIMEOUT,
+    read_timeout=settings.HISTOMX_READ_TIMEOUT,
+    retries=settings.HISTOMX_RETRIES,
+    breaker_threshold=settings.HISTOMX_BREAKER_THRESHOLD,
+    breaker_reset_after=settings.HISTOMX_BREAKER_RESET_AFTER,
+    health_check_interval=settings.HISTOMX_HEALTH_CHECK_INTERVAL,
+)
@@ -0,0 +1,45 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from icdot.histomx.models import HistomxReportJob
+
+
+class Command(BaseCommand):
+    help = "Generate the histomx reports requested from the web interface."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once there are no more reports waiting.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=1.0,
+            help="Seconds to wait before looking for reports again.",
+        )
+        parser.add_argument(
+            "--stale-after",
+            type=float,
+            default=600.0,
+            help="Seconds after which a running report is assumed to be lost.",
+        )
+
+    def handle(self, *args, once, poll_interval, stale_after, **options):
+        stale_after = datetime.timedelta(seconds=stale_after)
+        while True:
+            job = HistomxReportJob.claim(stale_after=stale_after)
+            if job is None:
+                if once:
+                    return
+                time.sleep(poll_interval)
+                # This runs for ever, unlike the requests Django usually serves.
+                close_old_connections()
+                continue
+
+            job.run()
+            self.stdout.write(f"Histomx report {job.id}: {job.status}")
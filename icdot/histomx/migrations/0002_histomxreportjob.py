@@ -0,0 +1,87 @@
+# Generated by Django 3.2.10 on 2026-10-18 15:46
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("histomx", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="HistomxReportJob",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("queued", "Queued"),
+                            ("running", "Running"),
+                            ("done", "Done"),
+                            ("failed", "Failed"),
+                        ],
+                        default="queued",
+                        max_length=10,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("started_at", models.DateTimeField(blank=True, null=True)),
+                ("finished_at", models.DateTimeField(blank=True, null=True)),
+                ("render_pdf", models.BooleanField(default=True)),
+                (
+                    "template",
+                    models.CharField(
+                        choices=[("DEFAULT", "Default template")], max_length=100
+                    ),
+                ),
+                ("rna_metadata", models.JSONField(blank=True, null=True)),
+                ("patient_metadata", models.JSONField(blank=True, null=True)),
+                ("RCC_filename", models.CharField(max_length=256)),
+                ("RCC_data", models.BinaryField()),
+                ("report", models.BinaryField(blank=True, null=True)),
+                ("report_content_type", models.CharField(blank=True, max_length=100)),
+                ("error", models.TextField(blank=True)),
+                (
+                    "created_by",
+                    models.ForeignKey(
+                        editable=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="histomxreportjob_created",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "modified_by",
+                    models.ForeignKey(
+                        editable=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="histomxreportjob_modified",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="histomxreportjob",
+            index=models.Index(
+                fields=["status", "created_at"], name="histomx_his_status_f1f36e_idx"
+            ),
+        ),
+    ]
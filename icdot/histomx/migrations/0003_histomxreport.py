@@ -0,0 +1,35 @@
+# Generated by Django 3.2.10 on 2026-10-18 15:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+import icdot.transplants.models.file_upload
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transplants', '0004_auto_20230713_1554'),
+        ('histomx', '0002_histomxreportjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistomxReport',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('template', models.CharField(choices=[('DEFAULT', 'Default template')], max_length=100)),
+                ('render_pdf', models.BooleanField()),
+                ('rcc_digest', models.CharField(max_length=64)),
+                ('metadata_digest', models.CharField(max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('file', models.FileField(upload_to=icdot.transplants.models.file_upload.RandomFileName('histomx'))),
+                ('content_type', models.CharField(max_length=100)),
+                ('sequencing_data', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='histomx_reports', to='transplants.sequencingdata')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='histomxreport',
+            constraint=models.UniqueConstraint(fields=('sequencing_data', 'template', 'render_pdf', 'rcc_digest', 'metadata_digest'), name='unique_histomx_report_inputs'),
+        ),
+    ]
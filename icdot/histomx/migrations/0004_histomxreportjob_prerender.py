@@ -0,0 +1,43 @@
+# Generated by Django 3.2.10 on 2026-10-18 15:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transplants', '0004_auto_20230713_1554'),
+        ('histomx', '0003_histomxreport'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='histomxreportjob',
+            name='histomx_his_status_f1f36e_idx',
+        ),
+        migrations.AddField(
+            model_name='histomxreportjob',
+            name='priority',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Interactive'), (1, 'Pre-render')], default=0),
+        ),
+        migrations.AddField(
+            model_name='histomxreportjob',
+            name='sequencing_data',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='histomx_report_jobs', to='transplants.sequencingdata'),
+        ),
+        migrations.AlterField(
+            model_name='histomxreportjob',
+            name='RCC_data',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='histomxreportjob',
+            name='RCC_filename',
+            field=models.CharField(blank=True, max_length=256),
+        ),
+        migrations.AddIndex(
+            model_name='histomxreportjob',
+            index=models.Index(fields=['status', 'priority', 'created_at'], name='histomx_his_status_02a3f7_idx'),
+        ),
+    ]
@@ -1,14 +1,29 @@
-from urllib.parse import urljoin
+import datetime
+import hashlib
+import json
+import logging
+import os
+import uuid
 
 import requests
 from django.conf import settings
-from django.db import models
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django_jsonform.models.fields import JSONField
+from django_scopes import scopes_disabled
+
+from icdot.histomx.client import client
+from icdot.transplants.models.file_upload import RandomFileName
+from icdot.users.models import UserScopedModel
+from icdot.utils.threadlocal import current_user, get_current_user
+
+logger = logging.getLogger(__name__)
 
 
 class HistomxReportRequest(models.Model):
-    PROBABLY_NOT_AVAILABLE = settings.HISTOMX_SERVICE_URL is None
+    PROBABLY_NOT_AVAILABLE = not settings.HISTOMX_SERVICE_URLS
 
     class Meta:
         managed = False  # No database table creation or deletion
@@ -69,22 +84,478 @@ class HistomxReportRequest(models.Model):
         null=True,
     )
 
-    def get_report(self):
+    def routing_key(self):
+        """Digest of what the report is made of, whatever its style.
+
+        Histomx nodes are picked by this key, identical reports go to
+        the node which has them cached.
+        """
+        digest = hashlib.sha256()
+        for chunk in self.RCC_file.chunks():
+            digest.update(chunk)
+        self.RCC_file.seek(0)
+        metadata = [self.template, self.rna_metadata, self.patient_metadata]
+        digest.update(json.dumps(metadata, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def get_report(self, background=False):
+        """Ask histomx for the report, `background` ones wait for the others."""
         style = "pdf" if self.render_pdf else "html"
 
-        url = urljoin(settings.HISTOMX_SERVICE_URL, f"histomx_report/{style}")
-        response = requests.post(
-            url,
-            json=dict(
-                rccdata=self.RCC_file.read().decode("utf8"),
+        headers = {}
+        user = get_current_user()
+        if user and user.is_authenticated:
+            # Lets the service share its R workers fairly between users.
+            headers["X-Histomx-Caller"] = user.get_username()
+        if background:
+            headers["X-Histomx-Priority"] = "batch"
+        response = client.post(
+            f"histomx_report/upload/{style}",
+            key=self.routing_key(),
+            headers=headers,
+            files=dict(rcc_file=self.RCC_file),
+            data=dict(
                 template=self.template,
-                rna_metadata=self.rna_metadata or {},
-                patient_metadata=self.patient_metadata or {},
+                rna_metadata=json.dumps(self.rna_metadata or {}),
+                patient_metadata=json.dumps(self.patient_metadata or {}),
             ),
         )
 
+        # Where the service spent its time, eg: "queue;dur=0.1, render;dur=4100.2".
+        logger.info(
+            "Histomx %s report timings: %s",
+            style,
+            response.headers.get("Server-Timing", "unknown"),
+        )
+
+        if response.status_code == 429 or response.status_code >= 502:
+            # The service is saturated or down, this is not the RCC file's fault.
+            response.raise_for_status()
         if response.status_code != 200:
             print(response.content)
             raise ValueError("Probably not a valid RCC file.")
 
         return response.content, response.headers["content-type"]
+
+
+class HistomxReportJob(UserScopedModel):
+    """A report requested from the web interface, generated in the background.
+
+    The RCC file and the report are kept in the database rather than as
+    media files, so the worker does not need to share storage with the
+    web server.
+
+    Jobs of sequencing data instead generate its stored HistomxReport,
+    when someone asks for it or, as pre-renders, ahead of anyone asking.
+    Pre-renders are claimed after the jobs of users, and only a few of
+    them run at once.
+    """
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "priority", "created_at"])]
+
+    class Priority(models.IntegerChoices):
+        INTERACTIVE = 0, _("Interactive")
+        PRERENDER = 1, _("Pre-render")
+
+    class Status(models.TextChoices):
+        QUEUED = "queued", _("Queued")
+        RUNNING = "running", _("Running")
+        DONE = "done", _("Done")
+        FAILED = "failed", _("Failed")
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(
+        max_length=10, choices=Status.choices, default=Status.QUEUED
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    priority = models.PositiveSmallIntegerField(
+        choices=Priority.choices, default=Priority.INTERACTIVE
+    )
+
+    render_pdf = models.BooleanField(default=True)
+    template = models.CharField(
+        max_length=100, choices=HistomxReportRequest.ReportTemplate.choices
+    )
+    rna_metadata = models.JSONField(null=True, blank=True)
+    patient_metadata = models.JSONField(null=True, blank=True)
+    RCC_filename = models.CharField(max_length=256, blank=True)
+    RCC_data = models.BinaryField(null=True, blank=True)
+    # Set instead of the RCC file for stored reports.
+    sequencing_data = models.ForeignKey(
+        "transplants.SequencingData",
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+        related_name="histomx_report_jobs",
+    )
+
+    report = models.BinaryField(null=True, blank=True)
+    report_content_type = models.CharField(max_length=100, blank=True)
+    error = models.TextField(blank=True)
+
+    @property
+    def is_finished(self):
+        return self.status in (self.Status.DONE, self.Status.FAILED)
+
+    @property
+    def report_filename(self):
+        extension = "pdf" if self.render_pdf else "html"
+        return f"{os.path.splitext(self.RCC_filename)[0]}.{extension}"
+
+    @classmethod
+    def enqueue(cls, report_request: HistomxReportRequest):
+        report_request.RCC_file.seek(0)
+        return cls.objects.create(
+            render_pdf=report_request.render_pdf,
+            template=report_request.template,
+            rna_metadata=report_request.rna_metadata,
+            patient_metadata=report_request.patient_metadata,
+            RCC_filename=os.path.basename(report_request.RCC_file.name),
+            RCC_data=report_request.RCC_file.read(),
+        )
+
+    @classmethod
+    def prerender(cls, sequencing_data_queryset):
+        """Queue the default report of sequencing data, unless already queued."""
+        queued = cls.objects.filter(
+            status=cls.Status.QUEUED,
+            priority=cls.Priority.PRERENDER,
+            sequencing_data__in=sequencing_data_queryset,
+        ).values("sequencing_data")
+        return [
+            cls.objects.create(
+                priority=cls.Priority.PRERENDER,
+                sequencing_data=sequencing_data,
+                template=HistomxReportRequest.ReportTemplate.DEFAULT,
+            )
+            for sequencing_data in sequencing_data_queryset.exclude(pk__in=queued)
+        ]
+
+    @classmethod
+    def generate(
+        cls,
+        sequencing_data_queryset,
+        template=HistomxReportRequest.ReportTemplate.DEFAULT,
+        render_pdf=True,
+    ):
+        """Queue the stored reports of sequencing data, return their jobs.
+
+        Jobs already waiting for the same report are returned rather than
+        queued again.
+        """
+        waiting = {
+            job.sequencing_data_id: job
+            for job in cls.objects.filter(
+                status__in=[cls.Status.QUEUED, cls.Status.RUNNING],
+                priority=cls.Priority.INTERACTIVE,
+                sequencing_data__in=sequencing_data_queryset,
+                template=template,
+                render_pdf=render_pdf,
+            )
+        }
+        return [
+            waiting.get(sequencing_data.pk)
+            or cls.objects.create(
+                sequencing_data=sequencing_data,
+                template=template,
+                render_pdf=render_pdf,
+            )
+            for sequencing_data in sequencing_data_queryset
+        ]
+
+    @classmethod
+    def claim(cls, stale_after: datetime.timedelta):
+        """Mark the oldest waiting job as running and return it, or None.
+
+        Jobs claimed more than `stale_after` ago are claimed again, their
+        worker probably died. Workers skip the rows locked by others, so
+        any number of them can claim jobs concurrently.
+
+        Users' jobs come first, pre-renders are only claimed while less than
+        HISTOMX_PRERENDER_CONCURRENCY of them are running. Workers claiming
+        at the same time might both start one, it is a throttle, not a lock.
+        """
+        now = timezone.now()
+        with transaction.atomic(), scopes_disabled():
+            waiting = cls.objects.filter(
+                models.Q(status=cls.Status.QUEUED)
+                | models.Q(status=cls.Status.RUNNING, started_at__lt=now - stale_after)
+            )
+            prerendering = cls.objects.filter(
+                status=cls.Status.RUNNING,
+                priority=cls.Priority.PRERENDER,
+                started_at__gte=now - stale_after,
+            ).count()
+            if prerendering >= settings.HISTOMX_PRERENDER_CONCURRENCY:
+                waiting = waiting.filter(priority=cls.Priority.INTERACTIVE)
+            job = (
+                waiting.select_for_update(skip_locked=True)
+                .order_by("priority", "created_at")
+                .first()
+            )
+            if job is not None:
+                job.status = cls.Status.RUNNING
+                job.started_at = now
+                job.save(update_fields=["status", "started_at"])
+        return job
+
+    def run(self):
+        if self.sequencing_data_id is not None:
+            return self._generate_stored()
+
+        report_request = HistomxReportRequest(
+            RCC_file=ContentFile(bytes(self.RCC_data), name=self.RCC_filename),
+            render_pdf=self.render_pdf,
+            template=self.template,
+            rna_metadata=self.rna_metadata,
+            patient_metadata=self.patient_metadata,
+        )
+        # Histomx shares its workers fairly between the users asking.
+        with current_user(self.created_by):
+            try:
+                content, content_type = report_request.get_report()
+            except requests.exceptions.RequestException:
+                self.status = self.Status.FAILED
+                self.error = _("Histomx is not available at the moment.")
+            except ValueError:
+                self.status = self.Status.FAILED
+                self.error = _(
+                    "We're having trouble generating a report. Was that a valid RCC file?"
+                )
+            except Exception as e:
+                # Anything else, keep the worker going.
+                logger.exception("Histomx report job %s failed.", self.pk)
+                self.status = self.Status.FAILED
+                self.error = str(e)
+            else:
+                self.status = self.Status.DONE
+                self.report = content
+                self.report_content_type = content_type
+            self.finished_at = timezone.now()
+            self.save(
+                update_fields=[
+                    "status",
+                    "finished_at",
+                    "report",
+                    "report_content_type",
+                    "error",
+                    "modified_by",
+                ]
+            )
+
+    def _generate_stored(self):
+        with current_user(self.created_by):
+            try:
+                HistomxReport.get_or_generate(
+                    self.sequencing_data,
+                    template=self.template,
+                    render_pdf=self.render_pdf,
+                    background=self.priority == self.Priority.PRERENDER,
+                )
+            except requests.exceptions.RequestException:
+                # The report will be generated when someone asks for it.
+                self.status = self.Status.FAILED
+                self.error = _("Histomx is not available at the moment.")
+            except ValueError as e:
+                self.status = self.Status.FAILED
+                self.error = str(e)
+            except Exception as e:
+                # Anything else, keep the worker going.
+                logger.exception("Histomx report job %s failed.", self.pk)
+                self.status = self.Status.FAILED
+                self.error = str(e)
+            else:
+                self.status = self.Status.DONE
+            self.finished_at = timezone.now()
+            self.save(update_fields=["status", "finished_at", "error", "modified_by"])
+
+
+# What the reports show about the patient, as (related object, field names.)
+PATIENT_METADATA_FIELDS = [
+    (
+        "biopsy__transplant",
+        [
+            "recipient_ref",
+            "donor_ref",
+            "transplant_date",
+            "recipient_age",
+            "recipient_sex",
+            "donor_age",
+            "donor_type",
+        ],
+    ),
+    ("biopsy", ["biopsy_date", "biopsy_egfr", "biopsy_proteinuria"]),
+]
+
+
+def _related(instance, path):
+    for attr in path.split("__"):
+        instance = getattr(instance, attr, None)
+    return instance
+
+
+class HistomxReport(models.Model):
+    """A report generated for some sequencing data, kept in media storage.
+
+    Reports are keyed by the digests of their inputs, so a report whose
+    RCC file or metadata changed is never served, it is replaced by the
+    next one generated. The metadata includes what the report shows of the
+    biopsy and transplant, so changes to those are noticed the same way.
+    """
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=[
+                    "sequencing_data",
+                    "template",
+                    "render_pdf",
+                    "rcc_digest",
+                    "metadata_digest",
+                ],
+                name="unique_histomx_report_inputs",
+            )
+        ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    sequencing_data = models.ForeignKey(
+        "transplants.SequencingData",
+        on_delete=models.CASCADE,
+        related_name="histomx_reports",
+    )
+    template = models.CharField(
+        max_length=100, choices=HistomxReportRequest.ReportTemplate.choices
+    )
+    render_pdf = models.BooleanField()
+    rcc_digest = models.CharField(max_length=64)
+    metadata_digest = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    file = models.FileField(upload_to=RandomFileName("histomx"))
+    content_type = models.CharField(max_length=100)
+
+    @staticmethod
+    def build_request(
+        sequencing_data,
+        template=HistomxReportRequest.ReportTemplate.DEFAULT,
+        render_pdf=True,
+    ):
+        """The report request for sequencing data, from what we know about it."""
+        rna_metadata = {
+            "platform id": sequencing_data.machine_type,
+            "concentration": sequencing_data.rna_concentration,
+            "units": "ng/ul",
+            "RNA integrity number": sequencing_data.rna_integrity,
+        }
+        patient_metadata = {}
+        for path, fieldnames in PATIENT_METADATA_FIELDS:
+            related = _related(sequencing_data, path)
+            if related is None:
+                continue
+            for fieldname in fieldnames:
+                value = getattr(related, fieldname)
+                verbose_name = related._meta.get_field(fieldname).verbose_name
+                patient_metadata[verbose_name] = value
+
+        return HistomxReportRequest(
+            RCC_file=sequencing_data.file_path,
+            render_pdf=render_pdf,
+            template=template,
+            rna_metadata={k: v for k, v in rna_metadata.items() if v not in (None, "")},
+            patient_metadata={
+                k: str(v) for k, v in patient_metadata.items() if v not in (None, "")
+            },
+        )
+
+    @staticmethod
+    def digests(report_request: HistomxReportRequest):
+        rcc_digest = hashlib.sha256()
+        with report_request.RCC_file.open(mode="rb") as rcc_file:
+            for chunk in rcc_file.chunks():
+                rcc_digest.update(chunk)
+        metadata = [report_request.rna_metadata, report_request.patient_metadata]
+        metadata_digest = hashlib.sha256(
+            json.dumps(metadata, sort_keys=True, default=str).encode()
+        )
+        return dict(
+            rcc_digest=rcc_digest.hexdigest(),
+            metadata_digest=metadata_digest.hexdigest(),
+        )
+
+    @classmethod
+    def _report_request(cls, sequencing_data, template, render_pdf):
+        if not sequencing_data.file_path:
+            raise ValueError("This sequencing data has no RCC file.")
+
+        report_request = cls.build_request(sequencing_data, template, render_pdf)
+        key = dict(
+            sequencing_data=sequencing_data,
+            template=template,
+            render_pdf=render_pdf,
+            **cls.digests(report_request),
+        )
+        return report_request, key
+
+    @staticmethod
+    def _fetch(report_request: HistomxReportRequest, background=False):
+        # The RCC file is streamed from storage to histomx.
+        with report_request.RCC_file.open(mode="rb"):
+            return report_request.get_report(background=background)
+
+    @classmethod
+    def _store(cls, key, content, content_type):
+        report = cls(content_type=content_type, **key)
+        extension = "pdf" if key["render_pdf"] else "html"
+        report.file.save(f"report.{extension}", ContentFile(content), save=False)
+        try:
+            with transaction.atomic():
+                report.save()
+        except IntegrityError:
+            # Someone else stored the same report meanwhile.
+            report.file.delete(save=False)
+            return cls.objects.get(**key)
+
+        # Whatever was stored before was generated from outdated inputs.
+        cls.objects.filter(
+            sequencing_data=key["sequencing_data"],
+            template=key["template"],
+            render_pdf=key["render_pdf"],
+        ).exclude(pk=report.pk).delete()
+        return report
+
+    @classmethod
+    def get_stored(
+        cls,
+        sequencing_data,
+        template=HistomxReportRequest.ReportTemplate.DEFAULT,
+        render_pdf=True,
+    ):
+        """Return the stored report if it is up to date, or None."""
+        _report_request, key = cls._report_request(
+            sequencing_data, template, render_pdf
+        )
+        return cls.objects.filter(**key).first()
+
+    @classmethod
+    def get_or_generate(
+        cls,
+        sequencing_data,
+        template=HistomxReportRequest.ReportTemplate.DEFAULT,
+        render_pdf=True,
+        background=False,
+    ):
+        """Return the stored report, asking histomx for it only if necessary.
+
+        Raises the same exceptions as HistomxReportRequest.get_report.
+        """
+        report_request, key = cls._report_request(sequencing_data, template, render_pdf)
+        try:
+            return cls.objects.get(**key)
+        except cls.DoesNotExist:
+            pass
+
+        content, content_type = cls._fetch(report_request, background)
+        return cls._store(key, content, content_type)
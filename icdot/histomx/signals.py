@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django_scopes import scopes_disabled
+
+from icdot.histomx.models import HistomxReport, HistomxReportJob
+from icdot.transplants.models import SequencingData
+from icdot.transplants.models.file_upload import file_path_attached
+
+
+@receiver(post_delete, sender=HistomxReport)
+def delete_histomx_report_file(sender, instance, **kwargs):
+    # Only once the report is gone for good, the deletion could be rolled back.
+    transaction.on_commit(lambda: instance.file.delete(save=False))
+
+
+@receiver(file_path_attached, sender=SequencingData)
+def prerender_histomx_reports(sender, queryset, **kwargs):
+    if settings.HISTOMX_PRERENDER:
+        with scopes_disabled():
+            HistomxReportJob.prerender(queryset)
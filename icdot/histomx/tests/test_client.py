@@ -0,0 +1,119 @@
+import io
+
+import pytest
+import requests
+
+from icdot.histomx import client
+from icdot.histomx.client import (
+    CircuitBreaker,
+    HashRing,
+    HistomxClient,
+    HistomxNode,
+    HistomxUnavailable,
+)
+
+
+@pytest.fixture
+def two_nodes():
+    return HistomxClient(
+        base_urls=["http://histomx-1/", "http://histomx-2/"],
+        connect_timeout=1,
+        read_timeout=1,
+        retries=0,
+        breaker_threshold=5,
+        breaker_reset_after=30,
+        health_check_interval=0,
+    )
+
+
+def test_circuit_breaker(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(client.time, "monotonic", lambda: now)
+    breaker = CircuitBreaker(threshold=2, reset_after=30)
+
+    breaker.record_failure()
+    breaker.before_call(None)
+    breaker.record_success()
+    breaker.record_failure()
+    assert not breaker.is_open
+
+    breaker.record_failure()
+    assert breaker.is_open
+    with pytest.raises(HistomxUnavailable):
+        breaker.before_call(None)
+
+    # After a while a single call goes through, to see if it's back.
+    now += 31
+    breaker.before_call(None)
+    with pytest.raises(HistomxUnavailable):
+        breaker.before_call(None)
+
+    breaker.record_success()
+    assert not breaker.is_open
+    breaker.before_call(None)
+
+
+def test_hash_ring():
+    nodes = [HistomxNode(f"http://histomx-{i}/", None) for i in range(4)]
+    keys = [str(key) for key in range(1000)]
+    before = {key: HashRing(nodes[:3]).nodes_for(key)[0] for key in keys}
+    after = {key: HashRing(nodes).nodes_for(key)[0] for key in keys}
+
+    # Keys are spread over the nodes, and a new node only takes keys over.
+    assert set(before.values()) == set(nodes[:3])
+    moved = [key for key in keys if before[key] != after[key]]
+    assert 0 < len(moved) < len(keys) / 2
+    assert all(after[key] == nodes[3] for key in moved)
+
+    assert sorted(HashRing(nodes).nodes_for("key"), key=id) == sorted(nodes, key=id)
+
+
+def test_failover(two_nodes, requests_mock):
+    first, second = two_nodes.ring.nodes_for("report")
+    requests_mock.post(
+        first.base_url + "render", exc=requests.exceptions.ConnectTimeout
+    )
+    requests_mock.post(second.base_url + "render", text="report")
+
+    assert two_nodes.post("render", key="report").text == "report"
+    assert requests_mock.call_count == 2
+
+    # Once found down, it is not tried first anymore.
+    requests_mock.get(first.base_url + "health", status_code=502)
+    requests_mock.get(second.base_url + "health", json={"status": "ok"})
+    two_nodes.check_health()
+    assert not first.healthy and second.healthy
+    requests_mock.reset_mock()
+    assert two_nodes.post("render", key="report").text == "report"
+    assert [request.url for request in requests_mock.request_history] == [
+        second.base_url + "render"
+    ]
+
+
+def test_no_failover_on_read_timeout(two_nodes, requests_mock):
+    first, second = two_nodes.ring.nodes_for("report")
+    requests_mock.post(first.base_url + "render", exc=requests.exceptions.ReadTimeout)
+    requests_mock.post(second.base_url + "render", text="report")
+
+    for _ in range(5):
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            two_nodes.post("render", key="report")
+    assert [request.url for request in requests_mock.request_history] == [
+        first.base_url + "render"
+    ] * 5
+    # Slow is not down.
+    assert not first.breaker.is_open
+
+
+def test_failover_sends_files_again(two_nodes, requests_mock):
+    first, second = two_nodes.ring.nodes_for("report")
+    requests_mock.post(first.base_url + "render", status_code=503)
+    requests_mock.post(second.base_url + "render", text="report")
+
+    rcc_file = io.BytesIO(b"RCC data")
+    response = two_nodes.post("render", key="report", files=dict(rcc_file=rcc_file))
+    assert response.text == "report"
+    assert [b"RCC data" in r.body for r in requests_mock.request_history] == [
+        True,
+        True,
+    ]
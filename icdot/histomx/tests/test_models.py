@@ -0,0 +1,231 @@
+import datetime
+
+import pytest
+from django.conf import settings
+from django.contrib.auth.models import Permission
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import transaction
+from model_bakery import baker
+
+from icdot.histomx.models import HistomxReport, HistomxReportJob
+from icdot.histomx.views import sequencing_data_report_view
+from icdot.transplants.models import Biopsy, FileUpload, SequencingData, Transplant
+from icdot.utils.middleware import current_user_and_scope
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def sequencing_data(user):
+    with current_user_and_scope(user=user):
+        file_upload = baker.make(FileUpload, file_ref="ref-one")
+        file_upload.file_path.save("sample.RCC", ContentFile(b"rcc data"))
+        transplant = baker.make(Transplant, recipient_ref="recipient-one")
+        biopsy = baker.make(Biopsy, transplant=transplant)
+        return baker.make(
+            SequencingData, biopsy=biopsy, file_ref="ref-one", rna_concentration=12.5
+        )
+
+
+@pytest.fixture
+def histomx_pdf(requests_mock):
+    return requests_mock.post(
+        settings.HISTOMX_SERVICE_URL + "histomx_report/upload/pdf",
+        content=b"%PDF report",
+        headers={"content-type": "application/pdf"},
+    )
+
+
+def test_report_parameters(sequencing_data):
+    report_request = HistomxReport.build_request(sequencing_data)
+    assert report_request.rna_metadata["concentration"] == 12.5
+    assert "recipient-one" in report_request.patient_metadata.values()
+
+
+def test_report_is_stored(user, sequencing_data, histomx_pdf):
+    report = HistomxReport.get_or_generate(sequencing_data)
+    assert report.file.read() == b"%PDF report"
+    assert report.content_type == "application/pdf"
+    assert histomx_pdf.call_count == 1
+
+    # Served from storage the second time.
+    assert HistomxReport.get_or_generate(sequencing_data) == report
+    assert histomx_pdf.call_count == 1
+
+
+def test_report_is_replaced(
+    user, sequencing_data, histomx_pdf, django_capture_on_commit_callbacks
+):
+    report = HistomxReport.get_or_generate(sequencing_data)
+    path = report.file.path
+
+    with current_user_and_scope(user=user):
+        sequencing_data.rna_integrity = 7
+        sequencing_data.save()
+
+    with django_capture_on_commit_callbacks(execute=True):
+        new_report = HistomxReport.get_or_generate(sequencing_data)
+    assert new_report != report
+    assert histomx_pdf.call_count == 2
+    assert list(HistomxReport.objects.all()) == [new_report]
+    assert not report.file.storage.exists(path)
+
+
+@pytest.mark.parametrize("changed", ["biopsy", "transplant"])
+def test_report_is_outdated(user, sequencing_data, histomx_pdf, changed):
+    report = HistomxReport.get_or_generate(sequencing_data)
+
+    instance = {
+        "biopsy": sequencing_data.biopsy,
+        "transplant": sequencing_data.biopsy.transplant,
+    }[changed]
+    with current_user_and_scope(user=user):
+        instance.save()
+    # Saving alone changes nothing the report shows.
+    assert HistomxReport.get_or_generate(sequencing_data) == report
+    assert histomx_pdf.call_count == 1
+
+    with current_user_and_scope(user=user):
+        instance.biopsy_egfr = 42
+        instance.recipient_age = 42
+        instance.save()
+    assert HistomxReport.get_or_generate(sequencing_data) != report
+    assert histomx_pdf.call_count == 2
+
+
+def test_report_is_outdated_by_new_upload(user, sequencing_data, histomx_pdf):
+    report = HistomxReport.get_or_generate(sequencing_data)
+
+    with current_user_and_scope(user=user):
+        file_upload = baker.make(FileUpload, file_ref="ref-one")
+        file_upload.file_path.save("other.RCC", ContentFile(b"other rcc data"))
+
+    sequencing_data.refresh_from_db()
+    new_report = HistomxReport.get_or_generate(sequencing_data)
+    assert new_report != report
+    assert histomx_pdf.call_count == 2
+    assert b"other rcc data" in histomx_pdf.last_request.body
+    assert new_report.rcc_digest != report.rcc_digest
+
+
+def test_report_file_is_deleted_on_commit(
+    user, sequencing_data, histomx_pdf, django_capture_on_commit_callbacks
+):
+    report = HistomxReport.get_or_generate(sequencing_data)
+    path = report.file.path
+
+    with pytest.raises(ValueError):
+        with transaction.atomic():
+            HistomxReport.objects.all().delete()
+            raise ValueError("Rolled back.")
+    assert report.file.storage.exists(path)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        HistomxReport.objects.all().delete()
+    assert not report.file.storage.exists(path)
+
+
+def test_report_without_rcc_file(user):
+    with current_user_and_scope(user=user):
+        sequencing_data = baker.make(SequencingData)
+    with pytest.raises(ValueError):
+        HistomxReport.get_or_generate(sequencing_data)
+
+
+def test_report_view(user, sequencing_data, histomx_pdf, rf):
+    user.user_permissions.add(Permission.objects.get(codename="view_sequencingdata"))
+    request = rf.get("/")
+    request.user = user
+    with current_user_and_scope(user=user):
+        response = sequencing_data_report_view(request, pk=sequencing_data.pk)
+        # Asking again waits for the same job.
+        assert sequencing_data_report_view(request, pk=sequencing_data.pk).url == (
+            response.url
+        )
+
+    # Queued for the worker, the request does not wait for histomx.
+    assert response.status_code == 302
+    assert histomx_pdf.call_count == 0
+    with current_user_and_scope(user=user):
+        (job,) = HistomxReportJob.objects.all()
+    assert str(job.pk) in response.url
+    assert job.priority == HistomxReportJob.Priority.INTERACTIVE
+
+    call_command("histomx_worker", "--once")
+    with current_user_and_scope(user=user):
+        response = sequencing_data_report_view(request, pk=sequencing_data.pk)
+    assert histomx_pdf.call_count == 1
+    assert response.status_code == 200
+    assert response["Content-Type"] == "application/pdf"
+    assert b"".join(response.streaming_content) == b"%PDF report"
+
+
+def test_worker_survives_failed_jobs(user, requests_mock):
+    requests_mock.post(
+        settings.HISTOMX_SERVICE_URL + "histomx_report/upload/pdf",
+        [
+            # No content-type.
+            dict(content=b"%PDF report", headers={}),
+            dict(content=b"%PDF report", headers={"content-type": "application/pdf"}),
+        ],
+    )
+    with current_user_and_scope(user=user):
+        jobs = [
+            HistomxReportJob.objects.create(
+                template="DEFAULT", RCC_filename="file.RCC", RCC_data=b"data"
+            )
+            for _ in range(2)
+        ]
+
+    call_command("histomx_worker", "--once")
+    with current_user_and_scope(user=user):
+        for job in jobs:
+            job.refresh_from_db()
+    assert jobs[0].status == HistomxReportJob.Status.FAILED
+    assert "content-type" in jobs[0].error
+    assert jobs[1].status == HistomxReportJob.Status.DONE
+    assert bytes(jobs[1].report) == b"%PDF report"
+
+
+def test_report_is_prerendered(user, settings, histomx_pdf):
+    settings.HISTOMX_PRERENDER = True
+    with current_user_and_scope(user=user):
+        sequencing_data = baker.make(SequencingData, file_ref="ref-one")
+        assert not HistomxReportJob.objects.exists()
+
+        file_upload = baker.make(FileUpload, file_ref="ref-one")
+        file_upload.file_path.save("sample.RCC", ContentFile(b"rcc data"))
+        # Saved twice, but only queued once.
+        file_upload.save()
+        (job,) = HistomxReportJob.objects.all()
+
+    assert job.sequencing_data == sequencing_data
+    assert job.priority == HistomxReportJob.Priority.PRERENDER
+
+    claimed = HistomxReportJob.claim(stale_after=datetime.timedelta(minutes=10))
+    claimed.run()
+    assert claimed.status == HistomxReportJob.Status.DONE
+    assert histomx_pdf.last_request.headers["X-Histomx-Priority"] == "batch"
+    assert HistomxReport.objects.get().sequencing_data == sequencing_data
+
+
+def test_prerenders_are_throttled(user, settings):
+    settings.HISTOMX_PRERENDER = True
+    settings.HISTOMX_PRERENDER_CONCURRENCY = 1
+    with current_user_and_scope(user=user):
+        for ref in ["ref-one", "ref-two"]:
+            baker.make(FileUpload, file_ref=ref, file_path=f"{ref}.RCC")
+            baker.make(SequencingData, file_ref=ref)
+        interactive = HistomxReportJob.objects.create(
+            template="DEFAULT", RCC_filename="file.RCC", RCC_data=b"data"
+        )
+        assert HistomxReportJob.objects.count() == 3
+
+    stale_after = datetime.timedelta(minutes=10)
+    # Users come first, even when they asked last.
+    assert HistomxReportJob.claim(stale_after) == interactive
+    prerender = HistomxReportJob.claim(stale_after)
+    assert prerender.priority == HistomxReportJob.Priority.PRERENDER
+    # The other pre-render waits for this one.
+    assert HistomxReportJob.claim(stale_after) is None
@@ -1,3 +1,4 @@
+import datetime
 import json
 
 import pytest
@@ -6,15 +7,31 @@ from django.conf import settings
 from django.contrib.auth.models import Permission
 from django.core.exceptions import PermissionDenied
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.http import HttpResponse
+from django.core.management import call_command
+from django.http import Http404
 from django.test import RequestFactory
+from django_scopes import scope
 
-from icdot.histomx.views import histomx_report_request_view
+from icdot.histomx.client import client
+from icdot.histomx.models import HistomxReportJob
+from icdot.histomx.views import (
+    histomx_report_job_download_view,
+    histomx_report_job_view,
+    histomx_report_request_view,
+)
 from icdot.users.models import User
+from icdot.utils import threadlocal
 
 pytestmark = pytest.mark.django_db
 
 
+@pytest.fixture(autouse=True)
+def reset_client():
+    client.reset()
+    yield
+    client.reset()
+
+
 def _build_json_for_schema(schema):
     # This could probably be achieved by something like
     # hypothesis-jsonschema, feel free to integrate that but it might
@@ -38,23 +55,13 @@ def _build_json_for_schema(schema):
     return result
 
 
-def test_histomx_request(requests_mock, user: User, rf: RequestFactory):
-    permission = Permission.objects.get(codename="add_histomxreportrequest")
-    user.user_permissions.add(permission)
-
-    # This is mocking the request to the actual histomx server.
-    expected_response = {"foo": "bar"}
-    requests_mock.post(
-        settings.HISTOMX_SERVICE_URL + "histomx_report/html",
-        json=expected_response,
-        headers={"content-type": "application/json"},
-    )
-
-    # This is the request to django, which should in turn trigger the above.
+def _request_report(rf: RequestFactory, user: User):
+    """Request a report through the form, return the job it was queued as."""
     request = rf.post(
         "/histomx/",
         data={
-            "RCC_file": SimpleUploadedFile("file", b"data"),
+            "RCC_file": SimpleUploadedFile("file.RCC", b"data"),
+            "render_pdf": False,
             "template": "DEFAULT",
             "rna_metadata": json.dumps(
                 _build_json_for_schema(
@@ -70,15 +77,64 @@ def test_histomx_request(requests_mock, user: User, rf: RequestFactory):
         format="multipart",
     )
     request.user = user
-    response = histomx_report_request_view(request)
+    with threadlocal.current_user(user):
+        response = histomx_report_request_view(request)
 
-    assert response.status_code == 200
-    # Without the next line, we won't notice until trying to parse HTML as JSON.
-    # This is because Django returns a 200 on POSTs with invalid forms...
-    assert (
-        isinstance(response, HttpResponse) or not response.context_data["form"].errors
+    # Without the next line, we won't notice the form was invalid,
+    # because Django returns a 200 on POSTs with invalid forms...
+    assert response.status_code == 302
+    with scope(user=user):
+        job = HistomxReportJob.objects.get()
+    assert response.url == f"/histomx/jobs/{job.pk}/"
+    return job
+
+
+def _get_job_page(rf: RequestFactory, user: User, job, view=histomx_report_job_view):
+    request = rf.get("/")
+    request.user = user
+    with scope(user=user):
+        response = view(request, pk=job.pk)
+        if hasattr(response, "render"):
+            response.render()
+    return response
+
+
+def test_histomx_request(requests_mock, user: User, rf: RequestFactory, caplog):
+    permission = Permission.objects.get(codename="add_histomxreportrequest")
+    user.user_permissions.add(permission)
+
+    # This is mocking the request to the actual histomx server.
+    expected_response = {"foo": "bar"}
+    requests_mock.post(
+        settings.HISTOMX_SERVICE_URL + "histomx_report/upload/html",
+        json=expected_response,
+        headers={
+            "content-type": "application/json",
+            "Server-Timing": "render;dur=4100.2, total;dur=4102.5",
+        },
     )
+
+    # The web request does not wait for histomx.
+    job = _request_report(rf, user)
+    assert not requests_mock.called
+    assert job.status == HistomxReportJob.Status.QUEUED
+    assert "reload" in _get_job_page(rf, user, job).content.decode()
+
+    call_command("histomx_worker", "--once")
+
+    job.refresh_from_db()
+    assert job.status == HistomxReportJob.Status.DONE
+    assert "file.html" in _get_job_page(rf, user, job).content.decode()
+
+    response = _get_job_page(rf, user, job, view=histomx_report_job_download_view)
+    assert response.status_code == 200
     assert json.loads(response.content) == expected_response
+    # The RCC file is uploaded as is, not embedded in a JSON body.
+    assert requests_mock.last_request.headers["Content-Type"].startswith(
+        "multipart/form-data"
+    )
+    assert requests_mock.last_request.headers["X-Histomx-Caller"] == user.username
+    assert "render;dur=4100.2" in caplog.text
 
 
 def test_histomx_request_exception(requests_mock, user: User, rf: RequestFactory):
@@ -87,33 +143,107 @@ def test_histomx_request_exception(requests_mock, user: User, rf: RequestFactory
 
     # This is mocking the request to the actual histomx server.
     requests_mock.post(
-        settings.HISTOMX_SERVICE_URL + "histomx_report/html",
+        settings.HISTOMX_SERVICE_URL + "histomx_report/upload/html",
         exc=requests.exceptions.ConnectTimeout,
     )
 
-    # This is the request to django, which should in turn trigger the above.
-    request = rf.post(
-        "/histomx/",
-        data={
-            "RCC_file": SimpleUploadedFile("file", b"data"),
-            "template": "DEFAULT",
-            "rna_metadata": json.dumps(
-                _build_json_for_schema(
-                    histomx_report_request_view.view_class.model.rna_metadata.field.schema
-                )
-            ),
-            "patient_metadata": json.dumps(
-                _build_json_for_schema(
-                    histomx_report_request_view.view_class.model.patient_metadata.field.schema
-                )
-            ),
-        },
-        format="multipart",
+    job = _request_report(rf, user)
+    call_command("histomx_worker", "--once")
+
+    job.refresh_from_db()
+    assert job.status == HistomxReportJob.Status.FAILED
+    assert "not available" in _get_job_page(rf, user, job).content.decode()
+    with pytest.raises(Http404):
+        _get_job_page(rf, user, job, view=histomx_report_job_download_view)
+
+
+def test_histomx_request_invalid_rcc(requests_mock, user: User, rf: RequestFactory):
+    permission = Permission.objects.get(codename="add_histomxreportrequest")
+    user.user_permissions.add(permission)
+
+    requests_mock.post(
+        settings.HISTOMX_SERVICE_URL + "histomx_report/upload/html",
+        status_code=500,
     )
-    request.user = user
-    response = histomx_report_request_view(request)
 
-    assert response.status_code == 500
+    job = _request_report(rf, user)
+    call_command("histomx_worker", "--once")
+
+    job.refresh_from_db()
+    assert job.status == HistomxReportJob.Status.FAILED
+    assert "valid RCC file" in job.error
+
+
+def test_histomx_request_saturated(requests_mock, user: User, rf: RequestFactory):
+    permission = Permission.objects.get(codename="add_histomxreportrequest")
+    user.user_permissions.add(permission)
+
+    # The service is busy, this should not be blamed on the RCC file.
+    requests_mock.post(
+        settings.HISTOMX_SERVICE_URL + "histomx_report/upload/html",
+        status_code=429,
+        headers={"Retry-After": "10"},
+    )
+
+    job = _request_report(rf, user)
+    call_command("histomx_worker", "--once")
+
+    job.refresh_from_db()
+    assert job.status == HistomxReportJob.Status.FAILED
+    assert "not available" in job.error
+
+
+def test_histomx_request_fails_fast(requests_mock, user: User, rf: RequestFactory):
+    permission = Permission.objects.get(codename="add_histomxreportrequest")
+    user.user_permissions.add(permission)
+
+    requests_mock.post(
+        settings.HISTOMX_SERVICE_URL + "histomx_report/upload/html",
+        exc=requests.exceptions.ConnectTimeout,
+    )
+
+    for _ in range(settings.HISTOMX_BREAKER_THRESHOLD):
+        with pytest.raises(requests.exceptions.ConnectTimeout):
+            client.post("histomx_report/upload/html")
+    assert requests_mock.call_count == settings.HISTOMX_BREAKER_THRESHOLD
+
+    # Histomx is not even tried anymore.
+    job = _request_report(rf, user)
+    call_command("histomx_worker", "--once")
+
+    job.refresh_from_db()
+    assert job.status == HistomxReportJob.Status.FAILED
+    assert requests_mock.call_count == settings.HISTOMX_BREAKER_THRESHOLD
+
+
+def test_histomx_job_stale(user: User):
+    with threadlocal.current_user(user), scope(user=user):
+        job = HistomxReportJob.objects.create(
+            template="DEFAULT", RCC_filename="file.RCC", RCC_data=b"data"
+        )
+
+    claimed = HistomxReportJob.claim(stale_after=datetime.timedelta(minutes=10))
+    assert claimed == job
+    assert claimed.status == HistomxReportJob.Status.RUNNING
+    assert HistomxReportJob.claim(stale_after=datetime.timedelta(minutes=10)) is None
+
+    # Its worker probably died, someone else should take it.
+    assert HistomxReportJob.claim(stale_after=datetime.timedelta(0)) == job
+
+
+def test_histomx_job_other_user(user: User, rf: RequestFactory):
+    permission = Permission.objects.get(codename="add_histomxreportrequest")
+    user.user_permissions.add(permission)
+    other = User.objects.create(username="other")
+    other.user_permissions.add(permission)
+
+    with threadlocal.current_user(user), scope(user=user):
+        job = HistomxReportJob.objects.create(
+            template="DEFAULT", RCC_filename="file.RCC", RCC_data=b"data"
+        )
+
+    with pytest.raises(Http404):
+        _get_job_page(rf, other, job)
 
 
 def test_histomx_request_permission(requests_mock, user: User, rf: RequestFactory):
@@ -1,9 +1,32 @@
 from django.urls import path
 
-from icdot.histomx.views import histomx_report_request_view, histomx_timeout_view
+from icdot.histomx.views import (
+    histomx_report_job_download_view,
+    histomx_report_job_view,
+    histomx_report_request_view,
+    histomx_timeout_view,
+    sequencing_data_report_jobs_view,
+    sequencing_data_report_view,
+)
 
 app_name = "histomx"
 urlpatterns = [
     path("", histomx_report_request_view, name="histomx_report_view"),
+    path("jobs/<uuid:pk>/", histomx_report_job_view, name="histomx_report_job_view"),
+    path(
+        "jobs/<uuid:pk>/report/",
+        histomx_report_job_download_view,
+        name="histomx_report_job_download_view",
+    ),
+    path(
+        "sequencing-data/<uuid:pk>/report/",
+        sequencing_data_report_view,
+        name="sequencing_data_report_view",
+    ),
+    path(
+        "sequencing-data/reports/jobs/",
+        sequencing_data_report_jobs_view,
+        name="sequencing_data_report_jobs_view",
+    ),
     path("timeout/<int:timeout>/", histomx_timeout_view, name="histomx_timeout_view"),
 ]
@@ -1,15 +1,18 @@
 import time
 from datetime import datetime
+from urllib.parse import urlencode
 
-import requests
 from django.contrib.auth.mixins import PermissionRequiredMixin
-from django.http import HttpResponse
-from django.shortcuts import render
-from django.utils.translation import gettext_lazy as _
-from django.views.generic import TemplateView
+from django.core.exceptions import ValidationError
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest
+from django.shortcuts import redirect
+from django.urls import reverse
+from django.views.generic import DetailView, ListView, TemplateView, View
+from django.views.generic.detail import SingleObjectMixin
 from django.views.generic.edit import CreateView
 
-from icdot.histomx.models import HistomxReportRequest
+from icdot.histomx.models import HistomxReport, HistomxReportJob, HistomxReportRequest
+from icdot.transplants.models import SequencingData
 
 
 class HistomxReportRequestFormView(PermissionRequiredMixin, CreateView):
@@ -19,33 +22,95 @@ class HistomxReportRequestFormView(PermissionRequiredMixin, CreateView):
     fields = ["RCC_file", "render_pdf", "template", "rna_metadata", "patient_metadata"]
 
     def form_valid(self, form):
-        """Overwrite default database behavior and render the result."""
+        """Queue the report for the worker, rather than waiting for it here."""
 
         # This model should not be saved to the database,
         # because we don't need to remember it and because it is not managed.
         histomx_report_request = form.save(commit=False)
+        job = HistomxReportJob.enqueue(histomx_report_request)
+        return redirect("histomx:histomx_report_job_view", pk=job.pk)
 
+
+class HistomxReportJobView(PermissionRequiredMixin, DetailView):
+    permission_required = "histomx.add_histomxreportrequest"
+    template_name = "histomx/histomx_report_job.html"
+    model = HistomxReportJob
+    context_object_name = "job"
+
+
+class HistomxReportJobDownloadView(HistomxReportJobView):
+    def get_queryset(self):
+        return super().get_queryset().filter(status=HistomxReportJob.Status.DONE)
+
+    def render_to_response(self, context, **response_kwargs):
+        job = self.object
+        response = HttpResponse(job.report, content_type=job.report_content_type)
+        response["Content-Disposition"] = f'inline; filename="{job.report_filename}"'
+        return response
+
+
+class SequencingDataReportView(PermissionRequiredMixin, SingleObjectMixin, View):
+    """Serve the stored report of some sequencing data.
+
+    Reports not generated yet are queued for the worker, and one is sent
+    to their job's page to wait for them.
+    """
+
+    permission_required = "transplants.view_sequencingdata"
+    model = SequencingData
+
+    def get(self, request, *args, **kwargs):
+        sequencing_data = self.get_object()
+        render_pdf = request.GET.get("style") != "html"
         try:
-            content, content_type = histomx_report_request.get_report()
-        except requests.exceptions.RequestException as e:
-            return render(
-                self.request,
-                "histomx/histomx_not_available.html",
-                dict(
-                    attempted_url=e.request.url if e.request else None,
-                ),
-                status=500,
+            report = HistomxReport.get_stored(sequencing_data, render_pdf=render_pdf)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        if report is None:
+            jobs = HistomxReportJob.generate(
+                SequencingData.objects.filter(pk=sequencing_data.pk),
+                render_pdf=render_pdf,
             )
-        except ValueError:
-            form.add_error(
-                "RCC_file",
-                _(
-                    "We're having trouble generating a report. Was that a valid RCC file?"
-                ),
+            return redirect(sequencing_data_report_jobs_url(jobs))
+
+        return FileResponse(
+            report.file.open(mode="rb"), content_type=report.content_type
+        )
+
+
+def sequencing_data_report_jobs_url(jobs):
+    query = urlencode([("job", job.pk) for job in jobs])
+    return f"{reverse('histomx:sequencing_data_report_jobs_view')}?{query}"
+
+
+class SequencingDataReportJobsView(PermissionRequiredMixin, ListView):
+    """Follow the jobs generating stored reports, given as `job` parameters."""
+
+    permission_required = "transplants.view_sequencingdata"
+    template_name = "histomx/sequencing_data_report_jobs.html"
+    model = HistomxReportJob
+    context_object_name = "jobs"
+
+    def get_queryset(self):
+        try:
+            return (
+                super()
+                .get_queryset()
+                .filter(
+                    pk__in=self.request.GET.getlist("job"),
+                    sequencing_data__isnull=False,
+                )
+                .select_related("sequencing_data")
+                .order_by("created_at")
             )
-            return super().form_invalid(form)
+        except ValidationError:
+            raise Http404()
 
-        return HttpResponse(content, content_type=content_type)
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["all_finished"] = all(job.is_finished for job in context["jobs"])
+        return context
 
 
 if HistomxReportRequest.PROBABLY_NOT_AVAILABLE:
@@ -55,6 +120,11 @@ if HistomxReportRequest.PROBABLY_NOT_AVAILABLE:
 else:
     histomx_report_request_view = HistomxReportRequestFormView.as_view()
 
+histomx_report_job_view = HistomxReportJobView.as_view()
+histomx_report_job_download_view = HistomxReportJobDownloadView.as_view()
+sequencing_data_report_view = SequencingDataReportView.as_view()
+sequencing_data_report_jobs_view = SequencingDataReportJobsView.as_view()
+
 
 def histomx_timeout_view(request, timeout):
     start = datetime.now()
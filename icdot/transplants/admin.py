@@ -1,26 +1,204 @@
 # coding: utf-8
 
-from django.contrib import admin
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.auth import get_permission_codename
+from django.core.exceptions import PermissionDenied
+from django.db.models import Q
+from django.http import HttpResponseRedirect
+from django.shortcuts import get_object_or_404
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils.html import format_html
+from django.utils.translation import gettext_lazy as _
+from django.utils.translation import ngettext
 from import_export.admin import ImportExportModelAdmin
+from import_export.formats.base_formats import XLSX
 from nonrelated_inlines.admin import NonrelatedStackedInline
 
+from icdot.histomx.models import HistomxReportJob, HistomxReportRequest
+from icdot.histomx.views import sequencing_data_report_jobs_url
 from icdot.transplants import fieldsets, forms, models, resources
+from icdot.utils.import_export import ChunkedImportMixin, StreamingExportMixin
+
+
+class BackgroundImportMixin(ChunkedImportMixin):
+    """Validate then save imports in the background, see ImportJob.
+
+    Uploading a file queues it to be validated, the page of the job shows
+    its progress and lets one confirm the import once valid. Without
+    IMPORT_IN_BACKGROUND, imports are validated and saved in the request.
+    """
+
+    import_job_template_name = "admin/transplants/import_job.html"
+
+    def get_urls(self):
+        info = self.get_model_info()
+        urls = [
+            path(
+                "import/<uuid:job_id>/",
+                self.admin_site.admin_view(self.import_job_view),
+                name="%s_%s_import_job" % info,
+            ),
+        ]
+        return urls + super().get_urls()
+
+    def import_action(self, request, *args, **kwargs):
+        if not settings.IMPORT_IN_BACKGROUND or request.method != "POST":
+            return super().import_action(request, *args, **kwargs)
+        if not self.has_import_permission(request):
+            raise PermissionDenied
+
+        import_form = self.create_import_form(request)
+        if not import_form.is_valid():
+            return super().import_action(request, *args, **kwargs)
+
+        input_format = self.get_import_formats()[
+            int(import_form.cleaned_data["input_format"])
+        ]
+        import_file = import_form.cleaned_data["import_file"]
+        job = models.ImportJob.objects.create(
+            resource=self.choose_import_resource_class(import_form).__name__,
+            input_format=input_format.__name__,
+            encoding=self.from_encoding,
+            file_name=import_file.name,
+        )
+        job.save_file(import_file)
+        return HttpResponseRedirect(self.get_import_job_url(job))
+
+    def get_import_job_url(self, job):
+        return reverse(
+            "admin:%s_%s_import_job" % self.get_model_info(),
+            kwargs=dict(job_id=job.pk),
+            current_app=self.admin_site.name,
+        )
+
+    def get_import_job_resources(self):
+        """The resources of the jobs shown by this admin."""
+        return [
+            resource_class.__name__
+            for resource_class in self.get_import_resource_classes()
+        ]
+
+    def import_job_view(self, request, job_id):
+        if not self.has_import_permission(request):
+            raise PermissionDenied
+        job = get_object_or_404(
+            models.ImportJob,
+            pk=job_id,
+            resource__in=self.get_import_job_resources(),
+        )
+
+        if request.method == "POST":
+            if job.confirm():
+                self.message_user(request, _("The import will start shortly."))
+            return HttpResponseRedirect(self.get_import_job_url(job))
+
+        context = dict(
+            self.admin_site.each_context(request),
+            title=_("Import"),
+            opts=self.model._meta,
+            job=job,
+        )
+        request.current_app = self.admin_site.name
+        return TemplateResponse(request, [self.import_job_template_name], context)
+
+
+class SubmissionImportMixin(BackgroundImportMixin):
+    """Import a workbook with a sheet per model, see SUBMISSION_SHEETS.
+
+    Submissions are always validated and saved by the import worker.
+    """
+
+    import_export_change_list_template = (
+        "admin/transplants/change_list_import_submission.html"
+    )
+    import_submission_template_name = "admin/transplants/import_submission.html"
+
+    def get_urls(self):
+        info = self.get_model_info()
+        urls = [
+            path(
+                "import/submission/",
+                self.admin_site.admin_view(self.import_submission_view),
+                name="%s_%s_import_submission" % info,
+            ),
+        ]
+        return urls + super().get_urls()
+
+    def get_import_job_resources(self):
+        return super().get_import_job_resources() + [models.ImportJob.SUBMISSION]
+
+    def has_submission_import_permission(self, request):
+        return all(
+            request.user.has_perm(
+                "%s.%s"
+                % (
+                    resource_class._meta.model._meta.app_label,
+                    get_permission_codename(
+                        settings.IMPORT_EXPORT_IMPORT_PERMISSION_CODE,
+                        resource_class._meta.model._meta,
+                    ),
+                )
+            )
+            for resource_class in resources.SUBMISSION_SHEETS.values()
+        )
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = dict(
+            extra_context or {},
+            has_submission_import_permission=self.has_submission_import_permission(
+                request
+            ),
+        )
+        return super().changelist_view(request, extra_context)
+
+    def import_submission_view(self, request):
+        if not self.has_submission_import_permission(request):
+            raise PermissionDenied
+
+        form = forms.SubmissionImportForm(request.POST or None, request.FILES or None)
+        if request.method == "POST" and form.is_valid():
+            import_file = form.cleaned_data["import_file"]
+            job = models.ImportJob.objects.create(
+                resource=models.ImportJob.SUBMISSION,
+                input_format=XLSX.__name__,
+                file_name=import_file.name,
+            )
+            job.save_file(import_file)
+            return HttpResponseRedirect(self.get_import_job_url(job))
+
+        context = dict(
+            self.admin_site.each_context(request),
+            title=_("Import a submission"),
+            opts=self.model._meta,
+            form=form,
+            sheets=resources.SUBMISSION_SHEETS,
+        )
+        request.current_app = self.admin_site.name
+        return TemplateResponse(
+            request, [self.import_submission_template_name], context
+        )
 
 
 @admin.register(models.Transplant)
-class TransplantAdmin(ImportExportModelAdmin):
+class TransplantAdmin(
+    SubmissionImportMixin, StreamingExportMixin, ImportExportModelAdmin
+):
     resource_class = resources.TransplantResource
     fieldsets = fieldsets.transplant.DEFAULT
 
 
 @admin.register(models.Biopsy)
-class BiopsyAdmin(ImportExportModelAdmin):
+class BiopsyAdmin(BackgroundImportMixin, StreamingExportMixin, ImportExportModelAdmin):
     resource_class = resources.BiopsyResource
     fieldsets = fieldsets.biopsy.DEFAULT
 
 
 @admin.register(models.Histology)
-class HistologyAdmin(ImportExportModelAdmin):
+class HistologyAdmin(
+    BackgroundImportMixin, StreamingExportMixin, ImportExportModelAdmin
+):
     resource_class = resources.HistologyResource
     fieldsets = fieldsets.histology.DEFAULT
 
@@ -42,10 +220,48 @@ class StackedFileUploadInline(NonrelatedStackedInline):
 
 
 @admin.register(models.SequencingData)
-class SequencingDataAdmin(ImportExportModelAdmin):
+class SequencingDataAdmin(
+    BackgroundImportMixin, StreamingExportMixin, ImportExportModelAdmin
+):
     resource_class = resources.SequencingDataResource
     readonly_fields = ("file_path",)
     inlines = [StackedFileUploadInline]
+    list_display = ("__str__", "histomx_report")
+    actions = ["generate_histomx_reports"]
+
+    @admin.display(description=_("Histomx report"))
+    def histomx_report(self, obj):
+        if not obj.file_path or HistomxReportRequest.PROBABLY_NOT_AVAILABLE:
+            return "-"
+        url = reverse("histomx:sequencing_data_report_view", kwargs=dict(pk=obj.pk))
+        return format_html('<a href="{}">{}</a>', url, _("View report"))
+
+    @admin.action(description=_("Generate Histomx reports"), permissions=["change"])
+    def generate_histomx_reports(self, request, queryset):
+        if HistomxReportRequest.PROBABLY_NOT_AVAILABLE:
+            self.message_user(
+                request, _("Histomx is not available."), level=messages.ERROR
+            )
+            return None
+
+        # Generated by the worker, rather than keeping the request waiting.
+        without_rcc = Q(file_path__isnull=True) | Q(file_path="")
+        jobs = HistomxReportJob.generate(queryset.exclude(without_rcc))
+        skipped = queryset.filter(without_rcc).count()
+        if skipped:
+            self.message_user(
+                request,
+                ngettext(
+                    "%d sequencing data has no RCC file.",
+                    "%d sequencing data have no RCC file.",
+                    skipped,
+                )
+                % skipped,
+                level=messages.WARNING,
+            )
+        if not jobs:
+            return None
+        return HttpResponseRedirect(sequencing_data_report_jobs_url(jobs))
 
 
 # Single file-upload is disabled because it is confusing to users.
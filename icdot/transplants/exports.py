@@ -0,0 +1,165 @@
+"""A flat export of the registry, for analysis.
+
+There is a row per histology or sequencing event, with the columns of its
+biopsy and transplant, prefixed by their model name. Rows come from one
+joined query per kind of event, rather than from four exports to re-join.
+"""
+import io
+import itertools
+import tempfile
+
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+from django.conf import settings
+
+from icdot.transplants.models import Biopsy, Histology, SequencingData, Transplant
+from icdot.utils.import_export import STREAM_BUFFER_SIZE, stream_csv
+
+# Prefix of the columns of each kind of event.
+EVENTS = {
+    "histology": Histology,
+    "sequencing": SequencingData,
+}
+# Prefix of the columns of each parent, with the lookup to it from events.
+PARENTS = {
+    "biopsy": (Biopsy, "biopsy__"),
+    "transplant": (Transplant, "biopsy__transplant__"),
+}
+
+FORMATS = ["csv", "parquet", "arrow"]
+CONTENT_TYPES = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+def _exported_fields(model):
+    # Like the resources, except relations which are flattened instead.
+    return [
+        field
+        for field in model._meta.concrete_fields
+        if field.editable and not field.is_relation
+    ]
+
+
+def get_columns():
+    """The (name, model field) of each column, "event" has no field."""
+    columns = [("event", None)]
+    for prefix, model in EVENTS.items():
+        columns += [(f"{prefix}_{f.name}", f) for f in _exported_fields(model)]
+    for prefix, (model, _lookup) in PARENTS.items():
+        columns += [(f"{prefix}_{f.name}", f) for f in _exported_fields(model)]
+    return columns
+
+
+def get_querysets():
+    """The events of the current scope, by prefix."""
+    return {prefix: model.objects.all() for prefix, model in EVENTS.items()}
+
+
+def iter_rows(querysets=None, chunk_size=None):
+    """Yield the headers, then a row per event, as they are read.
+
+    Each queryset is read with a server-side cursor, `chunk_size` rows at a
+    time. Columns of the other kinds of events are None.
+    """
+    if querysets is None:
+        querysets = get_querysets()
+    if chunk_size is None:
+        chunk_size = getattr(settings, "EXPORT_CHUNK_SIZE", 2000)
+    columns = get_columns()
+    names = [name for name, _field in columns]
+    yield names
+
+    for prefix, queryset in querysets.items():
+        lookups = {
+            f"{prefix}_{f.name}": f.name for f in _exported_fields(queryset.model)
+        }
+        for parent, (model, lookup) in PARENTS.items():
+            lookups.update(
+                (f"{parent}_{f.name}", lookup + f.name) for f in _exported_fields(model)
+            )
+        positions = [names.index(name) for name in lookups]
+        empty_row = [prefix] + [None] * (len(names) - 1)
+
+        for values in queryset.values_list(*lookups.values()).iterator(
+            chunk_size=chunk_size
+        ):
+            row = list(empty_row)
+            for position, value in zip(positions, values):
+                row[position] = value
+            yield row
+
+
+def _arrow_schema(columns):
+    types = {
+        "BooleanField": pyarrow.bool_(),
+        "DateField": pyarrow.date32(),
+        "DateTimeField": pyarrow.timestamp("us", tz="UTC"),
+        "FloatField": pyarrow.float64(),
+        "IntegerField": pyarrow.int64(),
+        "PositiveIntegerField": pyarrow.int64(),
+        "PositiveSmallIntegerField": pyarrow.int64(),
+        "SmallIntegerField": pyarrow.int64(),
+    }
+    return pyarrow.schema(
+        (name, types.get(field.get_internal_type() if field else "", pyarrow.string()))
+        for name, field in columns
+    )
+
+
+def _record_batches(rows, schema, size):
+    rows = iter(rows)
+    next(rows)  # The schema has the headers.
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield pyarrow.RecordBatch.from_arrays(
+            [
+                pyarrow.array(values, type=column.type)
+                for values, column in zip(zip(*chunk), schema)
+            ],
+            schema=schema,
+        )
+
+
+def stream_arrow(rows, batch_size=None):
+    """Yield an Arrow IPC stream of the rows, a record batch at a time."""
+    schema = _arrow_schema(get_columns())
+    buffer = io.BytesIO()
+    with pyarrow.ipc.new_stream(buffer, schema) as writer:
+        for batch in _record_batches(rows, schema, batch_size or 10000):
+            writer.write_batch(batch)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def stream_parquet(rows, batch_size=None):
+    """Yield a Parquet file of the rows, once all of them are written.
+
+    Rows are written a row group at a time, but the file ends with its
+    metadata, so it can only be sent once complete.
+    """
+    schema = _arrow_schema(get_columns())
+    with tempfile.TemporaryFile() as file:
+        with pyarrow.parquet.ParquetWriter(file, schema) as writer:
+            for batch in _record_batches(rows, schema, batch_size or 10000):
+                writer.write_batch(batch)
+        file.seek(0)
+        yield from iter(lambda: file.read(STREAM_BUFFER_SIZE), b"")
+
+
+def stream(rows, file_format):
+    """Yield the rows in one of FORMATS."""
+    if file_format == "csv":
+        return stream_csv(rows)
+    if file_format == "arrow":
+        return stream_arrow(rows)
+    if file_format == "parquet":
+        return stream_parquet(rows)
+    raise ValueError(f"Unknown format {file_format}.")
@@ -31,6 +31,19 @@ class FileUploadBatchAdminForm(forms.ModelForm):
             FileUpload(batch=batch, file_path=upload, file_ref=upload.name).save()
 
 
+class SubmissionImportForm(forms.Form):
+    import_file = forms.FileField(
+        label=_("Workbook to import"),
+        widget=forms.ClearableFileInput(attrs={"accept": ".xlsx"}),
+    )
+
+    def clean_import_file(self):
+        import_file = self.cleaned_data["import_file"]
+        if not import_file.name.lower().endswith(".xlsx"):
+            raise ValidationError(_("Submissions are XLSX workbooks."))
+        return import_file
+
+
 class FileUploadInlineFormSet(NonrelatedInlineFormSet):
     def _has_changed_forms(self):
         for i, form in enumerate(self.forms):
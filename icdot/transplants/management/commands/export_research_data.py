@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_scopes import scopes_disabled
+
+from icdot.transplants import exports
+
+
+class Command(BaseCommand):
+    help = (
+        "Export every histology and sequencing event, with its biopsy and transplant."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="File to write the export to.")
+        parser.add_argument(
+            "--format",
+            choices=exports.FORMATS,
+            help="Format of the export, guessed from the file extension by default.",
+        )
+
+    def handle(self, *args, output, format, **options):
+        file_format = format or output.rsplit(".", 1)[-1]
+        if file_format not in exports.FORMATS:
+            raise CommandError(f"Unknown format {file_format}.")
+
+        # The whole registry, not only what some user can see.
+        with scopes_disabled(), open(output, "wb") as file:
+            for chunk in exports.stream(exports.iter_rows(), file_format):
+                file.write(chunk)
+        self.stdout.write(f"Exported to {output}")
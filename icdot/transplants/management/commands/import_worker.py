@@ -0,0 +1,48 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection
+
+from icdot.transplants.models import ImportJob
+
+
+class Command(BaseCommand):
+    help = "Validate and save the imports uploaded from the admin."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once there are no more imports waiting.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=1.0,
+            help="Seconds to wait before looking for imports again.",
+        )
+        parser.add_argument(
+            "--stale-after",
+            type=float,
+            default=600.0,
+            help="Seconds without progress after which an import is assumed to be lost.",
+        )
+
+    def handle(self, *args, once, poll_interval, stale_after, **options):
+        if connection.vendor != "postgresql":
+            # Progress is reported from a second connection, see ImportJob.
+            raise CommandError("The import worker needs PostgreSQL.")
+        stale_after = datetime.timedelta(seconds=stale_after)
+        while True:
+            job = ImportJob.claim(stale_after=stale_after)
+            if job is None:
+                if once:
+                    return
+                time.sleep(poll_interval)
+                # This runs for ever, unlike the requests Django usually serves.
+                close_old_connections()
+                continue
+
+            job.run()
+            self.stdout.write(f"Import {job.id} of {job.file_name}: {job.status}")
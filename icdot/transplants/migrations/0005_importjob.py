@@ -0,0 +1,58 @@
+# Generated by Django 3.2.10 on 2026-10-18 16:18
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('transplants', '0004_auto_20230713_1554'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('validating', 'Validating'), ('valid', 'Valid'), ('invalid', 'Invalid'), ('confirmed', 'Confirmed'), ('importing', 'Importing'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('progress_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('resource', models.CharField(max_length=100)),
+                ('input_format', models.CharField(max_length=10)),
+                ('encoding', models.CharField(blank=True, max_length=20)),
+                ('file_name', models.CharField(max_length=256)),
+                ('file_data', models.BinaryField()),
+                ('rows_done', models.PositiveIntegerField(default=0)),
+                ('totals', models.JSONField(default=dict)),
+                ('error_count', models.PositiveIntegerField(default=0)),
+                ('errors', models.JSONField(default=list)),
+                ('error', models.TextField(blank=True)),
+                ('created_by', models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='importjob_created', to=settings.AUTH_USER_MODEL)),
+                ('modified_by', models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='importjob_modified', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ImportJobChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('rows', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='transplants.importjob')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='importjobchunk',
+            constraint=models.UniqueConstraint(fields=('job', 'number'), name='unique_import_job_chunk'),
+        ),
+        migrations.AddIndex(
+            model_name='importjob',
+            index=models.Index(fields=['status', 'created_at'], name='transplants_status_58b5a2_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.10 on 2026-10-18 16:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transplants', '0005_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='biopsy',
+            name='import_digest',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='histology',
+            name='import_digest',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='sequencingdata',
+            name='import_digest',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='transplant',
+            name='import_digest',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.2.10 on 2026-10-18 16:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def split_file_data(apps, schema_editor):
+    ImportJob = apps.get_model("transplants", "ImportJob")
+    ImportJobFilePart = apps.get_model("transplants", "ImportJobFilePart")
+    part_size = 1024 * 1024
+    for job in ImportJob.objects.iterator(chunk_size=1):
+        data = bytes(job.file_data)
+        for number, start in enumerate(range(0, len(data), part_size)):
+            ImportJobFilePart.objects.create(
+                job=job, number=number, data=data[start : start + part_size]
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transplants', '0006_import_digest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJobFilePart',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='file_parts', to='transplants.importjob')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='importjobfilepart',
+            constraint=models.UniqueConstraint(fields=('job', 'number'), name='unique_import_job_file_part'),
+        ),
+        migrations.RunPython(split_file_data, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='importjob',
+            name='file_data',
+        ),
+    ]
@@ -1,6 +1,7 @@
 from .biopsy import Biopsy
 from .file_upload import FileUpload, FileUploadBatch
 from .histology import Histology
+from .import_job import ImportJob, ImportJobChunk, ImportJobFilePart
 from .sequencing import SequencingData
 from .transplant import Transplant
 
@@ -11,4 +12,7 @@ __all__ = [
     "SequencingData",
     "FileUpload",
     "FileUploadBatch",
+    "ImportJob",
+    "ImportJobChunk",
+    "ImportJobFilePart",
 ]
@@ -6,9 +6,10 @@ from django.utils.translation import gettext_lazy as _
 
 from icdot.transplants.models.transplant import Transplant
 from icdot.users.models import UserScopedModel
+from icdot.utils.import_export import ImportDigestModel
 
 
-class Biopsy(UserScopedModel):
+class Biopsy(UserScopedModel, ImportDigestModel):
     class Meta:
         verbose_name_plural = "biopsies"
 
@@ -3,6 +3,7 @@ import uuid
 
 from django.core import exceptions
 from django.db import models
+from django.dispatch import Signal
 from django.utils.deconstruct import deconstructible
 from django.utils.translation import gettext_lazy as _
 
@@ -44,6 +45,11 @@ class FileUpload(UserScopedModel):
         return self.file_ref
 
 
+# Sent when tracking models get a file path, with the `queryset` of the
+# instances concerned. It is only evaluated by the receivers interested.
+file_path_attached = Signal()
+
+
 class ModelBaseTrackingFileUpload(models.base.ModelBase):
     def __new__(cls, clsname, bases, attrs):
         newcls = super().__new__(cls, clsname, bases, attrs)
@@ -64,6 +70,10 @@ class TrackFileUploadModel(models.Model, metaclass=ModelBaseTrackingFileUpload):
     # When file_ref changes we want to get the new file_path.
     # Remember the original value so we only do this when it changes.
     __original_file_refs = None
+    # Whether a file path was set since the last save, clean() sets it too.
+    __file_path_attached = False
+    # FileUploads by file_ref, when they were looked up for many instances.
+    file_uploads = None
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -82,9 +92,27 @@ class TrackFileUploadModel(models.Model, metaclass=ModelBaseTrackingFileUpload):
     def _update_file_paths(cls, sender, instance, **kwargs):
         """Update file paths when uploads matching file refs occur."""
         for refattr, pathattr in cls.TRACK_FILE_UPLOAD.items():
-            cls.objects.filter(**{refattr: instance.file_ref}).update(
-                **{pathattr: instance.file_path}
-            )
+            queryset = cls.objects.filter(**{refattr: instance.file_ref})
+            if queryset.update(**{pathattr: instance.file_path}) and instance.file_path:
+                file_path_attached.send(sender=cls, queryset=queryset)
+
+    @staticmethod
+    def find_file_uploads(refs):
+        """Look up the uploads of many file refs at once, for `file_uploads`."""
+        file_uploads = {}
+        for file_upload in FileUpload.objects.filter(file_ref__in=refs):
+            file_uploads.setdefault(file_upload.file_ref, []).append(file_upload)
+        return file_uploads
+
+    def _get_file_upload(self, ref):
+        if self.file_uploads is None:
+            return FileUpload.objects.get(file_ref=ref)
+        file_uploads = self.file_uploads.get(ref, [])
+        if not file_uploads:
+            raise FileUpload.DoesNotExist()
+        if len(file_uploads) > 1:
+            raise FileUpload.MultipleObjectsReturned()
+        return file_uploads[0]
 
     def _set_file_path(self, refattr, pathattr):
         """Save and update file path if necessary."""
@@ -92,13 +120,15 @@ class TrackFileUploadModel(models.Model, metaclass=ModelBaseTrackingFileUpload):
         if not self._state.adding and ref == self.__original_file_refs[refattr]:
             return
         try:
-            file_upload = FileUpload.objects.get(file_ref=ref)
+            file_upload = self._get_file_upload(ref)
         except FileUpload.DoesNotExist:
             setattr(self, pathattr, None)
 
         else:
             setattr(self, pathattr, file_upload.file_path)
         self.__original_file_refs[refattr] = ref
+        if getattr(self, pathattr):
+            self.__file_path_attached = True
 
     def clean(self, *args, **kwargs):
         super().clean(*args, **kwargs)
@@ -113,7 +143,24 @@ class TrackFileUploadModel(models.Model, metaclass=ModelBaseTrackingFileUpload):
         if errors:
             raise exceptions.ValidationError(errors)
 
-    def save(self, *args, **kwargs):
+    def set_file_paths(self):
         for refattr, pathattr in self.TRACK_FILE_UPLOAD.items():
             self._set_file_path(refattr, pathattr)
+
+    @classmethod
+    def file_paths_saved(cls, instances):
+        """Send file_path_attached for the saved instances which got a file."""
+        attached = []
+        for instance in instances:
+            if instance.__file_path_attached:
+                instance.__file_path_attached = False
+                attached.append(instance.pk)
+        if attached:
+            file_path_attached.send(
+                sender=cls, queryset=cls.objects.filter(pk__in=attached)
+            )
+
+    def save(self, *args, **kwargs):
+        self.set_file_paths()
         super().save(*args, **kwargs)
+        type(self).file_paths_saved([self])
@@ -6,9 +6,10 @@ from django.utils.translation import gettext_lazy as _
 
 from icdot.transplants.models.biopsy import Biopsy
 from icdot.users.models import UserScopedModel
+from icdot.utils.import_export import ImportDigestModel
 
 
-class Histology(UserScopedModel):
+class Histology(UserScopedModel, ImportDigestModel):
     class Meta:
         verbose_name_plural = "histology"
 
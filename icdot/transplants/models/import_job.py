@@ -0,0 +1,555 @@
+import datetime
+import hashlib
+import io
+import json
+import logging
+import tempfile
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.admin.models import ADDITION, CHANGE, LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, connections, models, transaction
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from django_scopes import scopes_disabled
+from import_export.formats import base_formats
+from import_export.signals import post_import
+
+from icdot.transplants.models.file_upload import (
+    TrackFileUploadModel,
+    file_path_attached,
+)
+from icdot.users.models import UserScopedModel
+from icdot.utils.import_export import import_workbook, read_rows
+from icdot.utils.middleware import current_user_and_scope
+
+logger = logging.getLogger(__name__)
+
+
+class _Outside:
+    """Run ORM calls on another connection, committed whatever ours becomes.
+
+    Connections are per thread, so the calls are made from a thread of
+    their own.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def __call__(self, func, *args, **kwargs):
+        return self._executor.submit(func, *args, **kwargs).result()
+
+    def close(self):
+        self(connections.close_all)
+        self._executor.shutdown()
+
+
+class StaleImport(Exception):
+    """Rows an import would save changed since it was validated."""
+
+
+def _row_digests(model, pks, lock=False):
+    """Digest of the saved values of the rows of pks, by str(pk)."""
+    rows = model._base_manager.filter(pk__in=pks)
+    if lock:
+        rows = rows.select_for_update()
+    attnames = [field.attname for field in model._meta.concrete_fields]
+    return {
+        str(values[0]): hashlib.sha256(
+            json.dumps(values, cls=DjangoJSONEncoder).encode()
+        ).hexdigest()
+        for values in rows.values_list("pk", *attnames).iterator()
+    }
+
+
+class ImportJob(UserScopedModel):
+    """An import from the admin, validated then saved in the background.
+
+    The import worker validates the file by importing it for real, in a
+    transaction it rolls back. Meanwhile it keeps the instances of the valid
+    rows, as they would have been saved, and reports its progress from
+    another connection. Only new rows are written then, existing ones are
+    left unlocked for the others, see `defer_updates`. Once the user confirmed the import, these instances
+    are saved as they are, without reading or validating the file again.
+    Unless the rows they would update or create changed in the meantime: the
+    job is then queued to be validated again, and confirmed again.
+
+    That other connection writes while the import's transaction is open,
+    which PostgreSQL allows but SQLite does not: the worker needs the former.
+
+    A submission is a workbook with a sheet per resource, its sheets are
+    validated one after the other in the same transaction.
+    """
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "created_at"])]
+
+    class Status(models.TextChoices):
+        QUEUED = "queued", _("Queued")
+        VALIDATING = "validating", _("Validating")
+        VALID = "valid", _("Valid")
+        INVALID = "invalid", _("Invalid")
+        CONFIRMED = "confirmed", _("Confirmed")
+        IMPORTING = "importing", _("Importing")
+        DONE = "done", _("Done")
+        FAILED = "failed", _("Failed")
+
+    # Statuses in which a worker is busy with the job.
+    RUNNING = (Status.VALIDATING, Status.IMPORTING)
+    # Errors kept to be shown, the others are only counted.
+    MAX_ERRORS = 100
+    # The resource of submissions, see SUBMISSION_SHEETS.
+    SUBMISSION = "submission"
+    # Size of the parts files are stored in, see ImportJobFilePart.
+    FILE_PART_SIZE = 1024 * 1024
+    # PostgreSQL advisory lock held by the job saving its import, one at a time.
+    SAVE_LOCK = 0x1CD07
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(
+        max_length=10, choices=Status.choices, default=Status.QUEUED
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    progress_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    # Name of a resource class of icdot.transplants.resources, or SUBMISSION.
+    resource = models.CharField(max_length=100)
+    # Name of a format class of import_export.formats.base_formats.
+    input_format = models.CharField(max_length=10)
+    encoding = models.CharField(max_length=20, blank=True)
+    file_name = models.CharField(max_length=256)
+
+    rows_done = models.PositiveIntegerField(default=0)
+    totals = models.JSONField(default=dict)
+    error_count = models.PositiveIntegerField(default=0)
+    # The first MAX_ERRORS errors, as [line, message].
+    errors = models.JSONField(default=list)
+    error = models.TextField(blank=True)
+
+    @property
+    def is_running(self):
+        return self.status in self.RUNNING
+
+    @property
+    def is_finished(self):
+        return self.status in (
+            self.Status.VALID,
+            self.Status.INVALID,
+            self.Status.DONE,
+            self.Status.FAILED,
+        )
+
+    @property
+    def rows_per_second(self):
+        if not self.rows_done or not self.started_at or not self.progress_at:
+            return None
+        seconds = (self.progress_at - self.started_at).total_seconds()
+        return self.rows_done / seconds if seconds else None
+
+    @property
+    def is_submission(self):
+        return self.resource == self.SUBMISSION
+
+    def get_resources(self):
+        """The resource of each sheet, by title, "" when there are no sheets."""
+        from icdot.transplants import resources
+
+        if self.is_submission:
+            return {
+                title: resource_class()
+                for title, resource_class in resources.SUBMISSION_SHEETS.items()
+            }
+        return {"": getattr(resources, self.resource)()}
+
+    def get_input_format(self):
+        return getattr(base_formats, self.input_format)()
+
+    def save_file(self, file):
+        """Store an uploaded file, a part at a time."""
+        file.seek(0)
+        parts = iter(lambda: file.read(self.FILE_PART_SIZE), b"")
+        for number, data in enumerate(parts):
+            ImportJobFilePart.objects.create(job=self, number=number, data=data)
+
+    def open_file(self):
+        """Return a temporary copy of the file, written a part at a time."""
+        file = tempfile.TemporaryFile()
+        parts = self.file_parts.order_by("number").values_list("data", flat=True)
+        for data in parts.iterator(chunk_size=1):
+            file.write(data)
+        file.seek(0)
+        return file
+
+    @classmethod
+    def claim(cls, stale_after: datetime.timedelta):
+        """Mark the oldest job waiting for a worker as running, return it or None.
+
+        Running jobs which made no progress for `stale_after` are claimed
+        again, their worker probably died and their transaction with it.
+        """
+        now = timezone.now()
+        with transaction.atomic(), scopes_disabled():
+            job = (
+                cls.objects.filter(
+                    models.Q(status__in=[cls.Status.QUEUED, cls.Status.CONFIRMED])
+                    | models.Q(
+                        status__in=cls.RUNNING, progress_at__lt=now - stale_after
+                    )
+                )
+                .select_for_update(skip_locked=True)
+                .order_by("created_at")
+                .first()
+            )
+            if job is not None:
+                if job.status == cls.Status.QUEUED:
+                    job.status = cls.Status.VALIDATING
+                elif job.status == cls.Status.CONFIRMED:
+                    job.status = cls.Status.IMPORTING
+                job.started_at = job.progress_at = now
+                job.rows_done = 0
+                job.save(
+                    update_fields=["status", "started_at", "progress_at", "rows_done"]
+                )
+        return job
+
+    def confirm(self):
+        """Queue a valid import to be saved, return whether it was valid."""
+        with scopes_disabled():
+            confirmed = ImportJob.objects.filter(
+                pk=self.pk, status=self.Status.VALID
+            ).update(status=self.Status.CONFIRMED, error="")
+        if confirmed:
+            self.status = self.Status.CONFIRMED
+            self.error = ""
+        return bool(confirmed)
+
+    def run(self):
+        outside = _Outside()
+        try:
+            with current_user_and_scope(self.created_by):
+                if self.status == self.Status.VALIDATING:
+                    self._validate(outside)
+                else:
+                    self._import(outside)
+        except Exception as e:
+            # Unreadable files mostly, keep the worker going.
+            logger.exception("Import job %s failed.", self.pk)
+            self.status = self.Status.FAILED
+            self.error = str(e)
+            self.finished_at = timezone.now()
+            outside(self.save, update_fields=["status", "error", "finished_at"])
+        finally:
+            outside.close()
+
+    def _report_progress(self, outside, rows_done, result=None, offset=0, sheet=""):
+        self.rows_done = rows_done
+        self.progress_at = timezone.now()
+        update_fields = ["rows_done", "progress_at"]
+        if result is not None:
+            self.totals = {
+                import_type: self.totals.get(import_type, 0) + count
+                for import_type, count in result.totals.items()
+            }
+            errors = (
+                [
+                    [offset + line, str(error.error)]
+                    for line, row_errors in result.row_errors()
+                    for error in row_errors
+                ]
+                + [
+                    [offset + row.number, "; ".join(row.error.messages)]
+                    for row in result.invalid_rows
+                ]
+                + [[None, str(error.error)] for error in result.base_errors]
+            )
+            if sheet:
+                errors = [[line, f"{sheet}: {message}"] for line, message in errors]
+            self.error_count += len(errors)
+            self.errors += errors[: max(0, self.MAX_ERRORS - len(self.errors))]
+            update_fields += ["totals", "error_count", "errors"]
+        outside(self.save, update_fields=update_fields)
+
+    def _validate(self, outside):
+        outside(ImportJobChunk.objects.filter(job=self).delete)
+        self.totals, self.error_count, self.errors = {}, 0, []
+
+        with self.open_file() as file:
+            self._validate_file(outside, file)
+
+    def _validate_file(self, outside, file):
+        input_format = self.get_input_format()
+        if not input_format.is_binary():
+            file = io.TextIOWrapper(file, encoding=self.encoding or None, newline="")
+
+        import_kwargs = dict(
+            dry_run=False,
+            raise_errors=False,
+            use_transactions=True,
+            file_name=self.file_name,
+            user=self.created_by,
+        )
+        resources = self.get_resources()
+        if self.is_submission:
+            chunks = import_workbook(file, resources, **import_kwargs)
+        else:
+            resource = resources[""]
+            # Later chunks find what earlier ones saved without a query.
+            resource.instance_memo = {}
+            chunks = (
+                ("", offset, result)
+                for offset, result in resource.import_chunks(
+                    read_rows(file, input_format), **import_kwargs
+                )
+            )
+        for resource in resources.values():
+            resource.saved_instances = []
+            resource.defer_updates = True
+
+        rows_done = 0
+        with transaction.atomic():
+            for number, (sheet, offset, result) in enumerate(chunks):
+                resource = resources[sheet]
+                saved, resource.saved_instances = resource.saved_instances, []
+                if not (result.has_errors() or result.has_validation_errors()):
+                    # The rows to update as committed, to tell if they change.
+                    digests = (
+                        outside(
+                            _row_digests,
+                            type(saved[0][0]),
+                            [obj.pk for obj, is_create in saved if not is_create],
+                        )
+                        if saved
+                        else {}
+                    )
+                    outside(
+                        ImportJobChunk.objects.create,
+                        job=self,
+                        number=number,
+                        rows=result.total_rows,
+                        data=ImportJobChunk.pack(saved, digests),
+                    )
+                rows_done += result.total_rows
+                self._report_progress(outside, rows_done, result, offset, sheet)
+            # Later chunks saw the rows of earlier ones, now undo them all.
+            transaction.set_rollback(True)
+
+        self.status = self.Status.INVALID if self.error_count else self.Status.VALID
+        self.finished_at = timezone.now()
+        outside(self.save, update_fields=["status", "finished_at"])
+
+    def _import(self, outside):
+        try:
+            imported = self._save_chunks(outside)
+        except StaleImport as e:
+            # Nothing was saved, validate it against what the rows are now.
+            self.status = self.Status.QUEUED
+            self.error = str(e)
+            outside(self.save, update_fields=["status", "error"])
+            return
+
+        self.status = self.Status.DONE
+        self.finished_at = timezone.now()
+        outside(self.save, update_fields=["status", "finished_at"])
+        for model in imported:
+            post_import.send(sender=None, model=model)
+
+    def _save_chunks(self, outside):
+        resources = {
+            resource._meta.model: resource for resource in self.get_resources().values()
+        }
+        imported = []
+        saved = set()
+        rows_done = 0
+        with transaction.atomic():
+            # Each job sees what the jobs saved before it created or changed.
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", [self.SAVE_LOCK])
+            for chunk in self.chunks.order_by("number").iterator(chunk_size=1):
+                creates, updates, digests = chunk.unpack()
+                if creates or updates:
+                    # A chunk is part of a sheet, imported with one resource.
+                    model = type((creates + updates)[0][0])
+                    self._check_unchanged(
+                        resources[model], creates, updates, digests, saved
+                    )
+                    self._save_instances(model, creates, updates)
+                    saved.update((model, obj.pk) for obj, _repr in creates + updates)
+                    if model not in imported:
+                        imported.append(model)
+                rows_done += chunk.rows
+                self._report_progress(outside, rows_done)
+        return imported
+
+    def _check_unchanged(self, resource, creates, updates, digests, saved):
+        """Raise StaleImport unless the rows are still as they were validated.
+
+        Rows saved by earlier chunks of the job were checked with them.
+        """
+        model = resource._meta.model
+        pks = [obj.pk for obj, _repr in updates if (model, obj.pk) not in saved]
+        current = _row_digests(model, pks, lock=True)
+        changed = [pk for pk in pks if current.get(str(pk)) != digests.get(str(pk))]
+        if changed:
+            raise StaleImport(
+                _("%(count)d %(model)s changed since the import was validated.")
+                % dict(count=len(changed), model=model._meta.verbose_name_plural)
+            )
+
+        keys = {resource.get_instance_key(obj) for obj, _repr in creates}
+        if not keys:
+            return
+        opts = model._meta
+        attnames = [
+            opts.get_field(resource.fields[name].attribute).attname
+            for name in resource.get_import_id_fields()
+        ]
+        existing = model._base_manager.filter(
+            **{
+                f"{attname}__in": {key[i] for key in keys}
+                for i, attname in enumerate(attnames)
+            }
+        )
+        created = [
+            obj for obj in existing.iterator() if resource.get_instance_key(obj) in keys
+        ]
+        if created:
+            raise StaleImport(
+                _("%(count)d %(model)s were created since the import was validated.")
+                % dict(count=len(created), model=model._meta.verbose_name_plural)
+            )
+
+    def _save_instances(self, model, creates, updates):
+        tracked = issubclass(model, TrackFileUploadModel)
+        if tracked:
+            paths = list(model.TRACK_FILE_UPLOAD.values())
+            previous_paths = {
+                pk: dict(zip(paths, values))
+                for pk, *values in model._base_manager.filter(
+                    pk__in=[obj.pk for obj, _repr in updates]
+                ).values_list("pk", *paths)
+            }
+
+        # Unlike Model.save(), bulk_update() does not refresh them.
+        auto_now = [
+            field
+            for field in model._meta.concrete_fields
+            if getattr(field, "auto_now", False)
+        ]
+        for obj, _repr in updates:
+            for field in auto_now:
+                field.pre_save(obj, add=False)
+        model._base_manager.bulk_create([obj for obj, _repr in creates])
+        model._base_manager.bulk_update(
+            [obj for obj, _repr in updates],
+            [f.name for f in model._meta.concrete_fields if not f.primary_key],
+        )
+        content_type = ContentType.objects.get_for_model(model)
+        LogEntry.objects.bulk_create(
+            LogEntry(
+                user_id=self.created_by_id,
+                content_type_id=content_type.pk,
+                object_id=str(obj.pk),
+                object_repr=object_repr[:200],
+                action_flag=action_flag,
+                change_message=_("%s through import_export") % import_type,
+            )
+            for action_flag, import_type, objs in [
+                (ADDITION, "new", creates),
+                (CHANGE, "update", updates),
+            ]
+            for obj, object_repr in objs
+        )
+        if tracked:
+            # Like Model.save() would have, see TrackFileUploadModel.
+            attached = [
+                obj.pk
+                for obj, _repr in creates + updates
+                if any(
+                    getattr(obj, path)
+                    and getattr(obj, path) != previous_paths.get(obj.pk, {}).get(path)
+                    for path in paths
+                )
+            ]
+            if attached:
+                file_path_attached.send(
+                    sender=model, queryset=model.objects.filter(pk__in=attached)
+                )
+
+
+class ImportJobFilePart(models.Model):
+    """A part of the file of an ImportJob, so that it is never loaded whole."""
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["job", "number"], name="unique_import_job_file_part"
+            )
+        ]
+
+    job = models.ForeignKey(
+        ImportJob, on_delete=models.CASCADE, related_name="file_parts"
+    )
+    number = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+
+class ImportJobChunk(models.Model):
+    """The instances of valid rows of an ImportJob, for a chunk of its rows."""
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["job", "number"], name="unique_import_job_chunk"
+            )
+        ]
+
+    job = models.ForeignKey(ImportJob, on_delete=models.CASCADE, related_name="chunks")
+    number = models.PositiveIntegerField()
+    # Rows of the file in the chunk, instances of repeated rows are merged.
+    rows = models.PositiveIntegerField()
+    # Compressed JSON of the serialized instances.
+    data = models.BinaryField()
+
+    @staticmethod
+    def pack(saved_instances, digests):
+        """Serialize instances saved by an import, once each, in order.
+
+        `digests` are those of the rows they update, see _row_digests.
+        """
+        instances = {}
+        for instance, is_create in saved_instances:
+            # Another row might have created or changed it already.
+            created = is_create or instances.get(instance.pk, (None, False))[1]
+            instances[instance.pk] = (instance, created)
+        entries = [
+            dict(
+                created=created,
+                repr=str(instance),
+                object=serializers.serialize("python", [instance])[0],
+                digest=None if created else digests.get(str(instance.pk)),
+            )
+            for instance, created in instances.values()
+        ]
+        return zlib.compress(json.dumps(entries, cls=DjangoJSONEncoder).encode())
+
+    def unpack(self):
+        """Return the (instance, repr) to create, those to update, and digests.
+
+        Digests are those of the rows to update when the import was validated.
+        """
+        entries = json.loads(zlib.decompress(bytes(self.data)))
+        creates, updates, digests = [], [], {}
+        for entry in entries:
+            (deserialized,) = serializers.deserialize("python", [entry["object"]])
+            (creates if entry["created"] else updates).append(
+                (deserialized.object, entry["repr"])
+            )
+            if not entry["created"]:
+                digests[str(deserialized.object.pk)] = entry.get("digest")
+        return creates, updates, digests
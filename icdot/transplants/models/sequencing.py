@@ -7,9 +7,10 @@ from django.utils.translation import gettext_lazy as _
 from icdot.transplants.models.biopsy import Biopsy
 from icdot.transplants.models.file_upload import TrackFileUploadModel
 from icdot.users.models import UserScopedModel
+from icdot.utils.import_export import ImportDigestModel
 
 
-class SequencingData(UserScopedModel, TrackFileUploadModel):
+class SequencingData(UserScopedModel, TrackFileUploadModel, ImportDigestModel):
     class Meta:
         verbose_name_plural = "sequencing data"
 
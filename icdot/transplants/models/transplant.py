@@ -5,9 +5,10 @@ from django.db import models
 from django.utils.translation import gettext_lazy as _
 
 from icdot.users.models import UserScopedModel
+from icdot.utils.import_export import ImportDigestModel
 
 
-class Transplant(UserScopedModel):
+class Transplant(UserScopedModel, ImportDigestModel):
     # WARNING: We use views/forms with fields='__all__'.
     # Please make sure when adding fields here that it is okay for users to both
     # see and edit them without it being a security problem for the app!
@@ -59,3 +59,13 @@ class SequencingDataResource(ModelResourceWithMultiFieldImport):
     )
     transplant, biopsy_date = biopsy.get_id_fields()
     transplant_date, donor_ref, recipient_ref = transplant.get_id_fields()
+
+
+# Sheets of a submission workbook, in the order they are imported: a sheet's
+# rows refer to those of the sheets before it.
+SUBMISSION_SHEETS = {
+    "transplant": TransplantResource,
+    "biopsy": BiopsyResource,
+    "histology": HistologyResource,
+    "sequencing": SequencingDataResource,
+}
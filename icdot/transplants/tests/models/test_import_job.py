@@ -0,0 +1,292 @@
+import datetime
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import django_scopes
+import openpyxl
+import pytest
+from django.contrib.admin.models import ADDITION, CHANGE, LogEntry
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, connections, transaction
+from django.urls import reverse
+from import_export.formats.base_formats import CSV
+
+from icdot.transplants.admin import TransplantAdmin
+from icdot.transplants.models import (
+    Biopsy,
+    Histology,
+    ImportJob,
+    SequencingData,
+    Transplant,
+)
+from icdot.utils.middleware import current_user_and_scope
+
+# The worker reports progress from another connection, which must see the job.
+pytestmark = [
+    pytest.mark.django_db(transaction=True),
+    pytest.mark.skipif(
+        connection.vendor != "postgresql", reason="The import worker needs PostgreSQL."
+    ),
+]
+
+STALE_AFTER = datetime.timedelta(minutes=10)
+
+
+def upload(client, rows):
+    input_format = [
+        i
+        for i, format_class in enumerate(TransplantAdmin.formats)
+        if format_class is CSV
+    ][0]
+    import_file = SimpleUploadedFile(
+        "transplants.csv",
+        (
+            "transplant_date,donor_ref,recipient_ref,recipient_age\n" + "".join(rows)
+        ).encode(),
+    )
+    response = client.post(
+        reverse("admin:transplants_transplant_import"),
+        data=dict(input_format=input_format, import_file=import_file),
+    )
+    assert response.status_code == 302
+    return response.url
+
+
+def run_worker():
+    job = ImportJob.claim(stale_after=STALE_AFTER)
+    job.run()
+    with django_scopes.scopes_disabled():
+        return ImportJob.objects.get(pk=job.pk)
+
+
+def test_import_job(admin_client, settings, monkeypatch):
+    settings.IMPORT_CHUNK_SIZE = 2
+    # The file is stored and read a part at a time.
+    monkeypatch.setattr(ImportJob, "FILE_PART_SIZE", 64)
+    rows = [f"2022-01-0{i},donor {i},recipient {i},40\n" for i in range(1, 5)]
+    # Changed in a later chunk, updates what the first chunk created.
+    rows.append("2022-01-01,donor 1,recipient 1,41\n")
+    url = upload(admin_client, rows)
+    job = admin_client.get(url).context["job"]
+    assert job.status == ImportJob.Status.QUEUED
+    assert job.file_parts.count() == 4
+
+    job = run_worker()
+    assert job.status == ImportJob.Status.VALID
+    assert job.rows_done == 5
+    assert job.rows_per_second
+    assert job.totals["new"] == 4
+    assert job.totals["update"] == 1
+    assert job.error_count == 0
+    assert job.chunks.count() == 3
+    with django_scopes.scopes_disabled():
+        assert not Transplant.objects.exists()
+    assert b"Confirm import" in admin_client.get(url).content
+
+    response = admin_client.post(url)
+    assert response.status_code == 302
+    job.refresh_from_db()
+    assert job.status == ImportJob.Status.CONFIRMED
+
+    job = run_worker()
+    assert job.status == ImportJob.Status.DONE
+    assert job.rows_done == 5
+    with django_scopes.scopes_disabled():
+        assert Transplant.objects.count() == 4
+        transplant = Transplant.objects.get(donor_ref="donor 1")
+    assert transplant.created_by == job.created_by
+    # Like an import in the request, it's logged by each chunk saving it.
+    assert sorted(
+        LogEntry.objects.filter(object_id=str(transplant.pk)).values_list(
+            "action_flag", flat=True
+        )
+    ) == [ADDITION, CHANGE]
+    assert LogEntry.objects.count() == 5
+
+    # Only once.
+    assert not job.confirm()
+    assert ImportJob.claim(stale_after=STALE_AFTER) is None
+
+
+def test_stale_import_job(admin_client, admin_user):
+    with current_user_and_scope(user=admin_user):
+        Transplant.objects.create(
+            transplant_date=datetime.date(2022, 1, 1),
+            donor_ref="donor 1",
+            recipient_ref="recipient 1",
+            recipient_age=40,
+        )
+    rows = [
+        "2022-01-01,donor 1,recipient 1,41\n",
+        "2022-01-02,donor 2,recipient 2,40\n",
+    ]
+    url = upload(admin_client, rows)
+    job = run_worker()
+    other_url = upload(admin_client, rows[1:])
+    other_job = run_worker()
+    assert job.status == other_job.status == ImportJob.Status.VALID
+
+    # Changed meanwhile.
+    with current_user_and_scope(user=admin_user):
+        Transplant.objects.filter(donor_ref="donor 1").update(recipient_age=42)
+    admin_client.post(url)
+    job = run_worker()
+    assert job.status == ImportJob.Status.QUEUED
+    assert "changed" in job.error
+    with django_scopes.scopes_disabled():
+        assert Transplant.objects.get(donor_ref="donor 1").recipient_age == 42
+        assert not Transplant.objects.filter(donor_ref="donor 2").exists()
+
+    job = run_worker()
+    assert job.status == ImportJob.Status.VALID
+    assert job.error.encode() in admin_client.get(url).content
+    assert job.confirm()
+    assert not job.error
+    job = run_worker()
+    assert job.status == ImportJob.Status.DONE
+    with django_scopes.scopes_disabled():
+        assert Transplant.objects.get(donor_ref="donor 1").recipient_age == 41
+
+    # Validated before the first import created its row.
+    admin_client.post(other_url)
+    other_job = run_worker()
+    assert other_job.status == ImportJob.Status.QUEUED
+    assert "created" in other_job.error
+    with django_scopes.scopes_disabled():
+        assert Transplant.objects.filter(donor_ref="donor 2").count() == 1
+
+
+def test_validation_leaves_rows_unlocked(admin_client, admin_user, monkeypatch):
+    with current_user_and_scope(user=admin_user):
+        transplant = Transplant.objects.create(
+            transplant_date=datetime.date(2022, 1, 1),
+            donor_ref="donor 1",
+            recipient_ref="recipient 1",
+            recipient_age=40,
+        )
+
+    def lock_transplant():
+        try:
+            with transaction.atomic():
+                return Transplant._base_manager.select_for_update(nowait=True).get(
+                    pk=transplant.pk
+                )
+        finally:
+            connections.close_all()
+
+    locked = []
+    report_progress = ImportJob._report_progress
+
+    def _report_progress(job, *args, **kwargs):
+        # Still in the validation's transaction.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            found = executor.submit(lock_transplant).result()
+        locked.append(found.recipient_age)
+        return report_progress(job, *args, **kwargs)
+
+    monkeypatch.setattr(ImportJob, "_report_progress", _report_progress)
+    upload(admin_client, ["2022-01-01,donor 1,recipient 1,41\n"])
+    job = run_worker()
+    assert job.status == ImportJob.Status.VALID
+    assert job.totals["update"] == 1
+    assert locked == [40]
+
+    # Saving it locks the row, rightly.
+    monkeypatch.undo()
+    job.confirm()
+    run_worker()
+    transplant.refresh_from_db()
+    assert transplant.recipient_age == 41
+
+
+def test_invalid_import_job(admin_client, settings):
+    settings.IMPORT_CHUNK_SIZE = 2
+    rows = [
+        "2022-01-01,donor 1,recipient 1\n",
+        "2022-01-02,donor 2,recipient 2\n",
+        "not a date,donor 3,recipient 3\n",
+    ]
+    url = upload(admin_client, rows)
+
+    job = run_worker()
+    assert job.status == ImportJob.Status.INVALID
+    assert job.error_count == 1
+    ((line, message),) = job.errors
+    assert line == 3
+    assert "date" in message
+    with django_scopes.scopes_disabled():
+        assert not Transplant.objects.exists()
+    assert b"Confirm import" not in admin_client.get(url).content
+
+    assert admin_client.post(url).status_code == 302
+    job.refresh_from_db()
+    assert job.status == ImportJob.Status.INVALID
+
+
+def submission(sheets):
+    workbook = openpyxl.Workbook()
+    workbook.remove(workbook.active)
+    for title, rows in sheets.items():
+        sheet = workbook.create_sheet(title)
+        for row in rows:
+            sheet.append(row)
+    file = io.BytesIO()
+    workbook.save(file)
+    return SimpleUploadedFile("submission.xlsx", file.getvalue())
+
+
+def test_submission(admin_client, settings):
+    settings.IMPORT_CHUNK_SIZE = 2
+    transplant = ["transplant_date", "donor_ref", "recipient_ref"]
+    transplants = [
+        [datetime.date(2022, 1, i), f"donor {i}", "recipient"] for i in [1, 2]
+    ]
+    biopsies = [[*t, datetime.date(2022, 2, 1)] for t in transplants]
+    sheets = {
+        # Any order, parents are imported first.
+        "Sequencing": [
+            transplant + ["biopsy_date", "sequencing_date", "file_ref"],
+            *[[*b, datetime.date(2022, 3, 1), "rcc"] for b in biopsies],
+        ],
+        "Histology": [
+            transplant + ["biopsy_date", "histology_date"],
+            *[[*b, datetime.date(2022, 3, 1)] for b in biopsies],
+        ],
+        "Biopsy": [transplant + ["biopsy_date"], *biopsies],
+        "Transplant": [transplant, *transplants],
+    }
+
+    response = admin_client.get(reverse("admin:transplants_transplant_changelist"))
+    url = reverse("admin:transplants_transplant_import_submission")
+    assert url.encode() in response.content
+    assert admin_client.get(url).status_code == 200
+    response = admin_client.post(url, data=dict(import_file=submission(sheets)))
+    assert response.status_code == 302
+
+    job = run_worker()
+    assert job.status == ImportJob.Status.VALID, job.errors
+    assert job.rows_done == 8
+    assert job.totals["new"] == 8
+    with django_scopes.scopes_disabled():
+        assert not Transplant.objects.exists()
+
+    job.confirm()
+    job = run_worker()
+    assert job.status == ImportJob.Status.DONE
+    with django_scopes.scopes_disabled():
+        for model in [Transplant, Biopsy, Histology, SequencingData]:
+            assert model.objects.count() == 2
+
+    # XLSX dates are read as datetimes, they still match what was imported.
+    # Nothing changed, every row is skipped.
+    response = admin_client.post(url, data=dict(import_file=submission(sheets)))
+    job = run_worker()
+    assert job.status == ImportJob.Status.VALID, job.errors
+    assert job.totals["skip"] == 8
+    assert job.totals["new"] == job.totals["update"] == 0
+
+    sheets["Biopsies"] = sheets.pop("Biopsy")
+    response = admin_client.post(url, data=dict(import_file=submission(sheets)))
+    job = run_worker()
+    assert job.status == ImportJob.Status.FAILED
+    assert "biopsies" in job.error
@@ -1,9 +1,28 @@
+import datetime
+
 import django_scopes
 import pytest
+from django.conf import settings
+from django.contrib.auth.models import Permission
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
 from django.urls import reverse
+from import_export import forms
+from import_export.formats.base_formats import CSV
+from import_export.signals import post_export
+from model_bakery import baker
 
-from icdot.transplants.models import FileUpload, FileUploadBatch
+from icdot.histomx.models import HistomxReport, HistomxReportJob
+from icdot.transplants.admin import TransplantAdmin
+from icdot.transplants.models import (
+    FileUpload,
+    FileUploadBatch,
+    SequencingData,
+    Transplant,
+)
+from icdot.utils.middleware import current_user_and_scope
 
 pytestmark = pytest.mark.django_db
 
@@ -31,3 +50,172 @@ def test_save_related(admin_client):
     with django_scopes.scopes_disabled():
         assert FileUploadBatch.objects.all().count() == 1
         assert FileUpload.objects.all().count() == 5
+
+
+def _sequencing_data_with_rcc(file_ref):
+    file_upload = baker.make(FileUpload, file_ref=file_ref)
+    file_upload.file_path.save(f"{file_ref}.RCC", ContentFile(b"rcc data"))
+    return baker.make(SequencingData, file_ref=file_ref)
+
+
+def test_generate_histomx_reports(admin_client, admin_user, requests_mock):
+    histomx = requests_mock.post(
+        settings.HISTOMX_SERVICE_URL + "histomx_report/upload/pdf",
+        content=b"%PDF report",
+        headers={"content-type": "application/pdf"},
+    )
+    with current_user_and_scope(user=admin_user):
+        one = _sequencing_data_with_rcc("ref-one")
+        two = _sequencing_data_with_rcc("ref-two")
+        without_rcc = baker.make(SequencingData)
+
+    url = reverse("admin:transplants_sequencingdata_changelist")
+    response = admin_client.post(
+        url,
+        data={
+            "action": "generate_histomx_reports",
+            "_selected_action": [one.pk, two.pk, without_rcc.pk],
+        },
+        follow=True,
+    )
+
+    # Queued for the worker, the request does not wait for histomx.
+    assert response.status_code == 200
+    assert histomx.call_count == 0
+    assert len(response.context["jobs"]) == 2
+    messages = [str(message) for message in response.context["messages"]]
+    assert "1 sequencing data has no RCC file." in messages
+    assert b"this page will refresh" in response.content.lower()
+
+    (jobs_url, _status), *_ = response.redirect_chain
+    with current_user_and_scope(user=admin_user):
+        assert set(response.context["jobs"]) == set(HistomxReportJob.objects.all())
+
+    call_command("histomx_worker", "--once")
+    assert histomx.call_count == 2
+    assert HistomxReport.objects.count() == 2
+    response = admin_client.get(jobs_url)
+    assert response.content.count(b"is ready") == 2
+
+    # Served from storage.
+    response = admin_client.get(
+        reverse("histomx:sequencing_data_report_view", kwargs=dict(pk=one.pk))
+    )
+    assert response["Content-Type"] == "application/pdf"
+    assert b"".join(response.streaming_content) == b"%PDF report"
+    assert histomx.call_count == 2
+
+
+def test_generate_histomx_reports_needs_change(client, user):
+    user.is_staff = True
+    user.save()
+    user.user_permissions.add(Permission.objects.get(codename="view_sequencingdata"))
+    client.force_login(user)
+    with current_user_and_scope(user=user):
+        sequencing_data = _sequencing_data_with_rcc("ref-one")
+
+    url = reverse("admin:transplants_sequencingdata_changelist")
+    response = client.get(url)
+    assert response.status_code == 200
+    assert b"generate_histomx_reports" not in response.content
+
+    client.post(
+        url,
+        data={
+            "action": "generate_histomx_reports",
+            "_selected_action": [sequencing_data.pk],
+        },
+    )
+    with current_user_and_scope(user=user):
+        assert not HistomxReportJob.objects.exists()
+
+
+@pytest.mark.parametrize("ambiguous", [False, True])
+def test_chunked_import(admin_client, admin_user, settings, ambiguous):
+    settings.IMPORT_IN_BACKGROUND = False
+    settings.IMPORT_CHUNK_SIZE = 2
+    rows = [f"2022-01-0{i},donor {i},recipient {i}\n" for i in range(1, 6)]
+    import_file = SimpleUploadedFile(
+        "transplants.csv",
+        ("transplant_date,donor_ref,recipient_ref\n" + ",,\n".join(rows)).encode(),
+    )
+    input_format = [
+        i
+        for i, format_class in enumerate(TransplantAdmin.formats)
+        if format_class is CSV
+    ][0]
+
+    response = admin_client.post(
+        reverse("admin:transplants_transplant_import"),
+        data=dict(input_format=input_format, import_file=import_file),
+    )
+    assert response.status_code == 200
+    confirm_data = response.context["confirm_form"].initial
+
+    if ambiguous:
+        # Changed since the dry run, the fourth row matches two transplants.
+        with current_user_and_scope(user=admin_user):
+            baker.make(
+                Transplant,
+                transplant_date=datetime.date(2022, 1, 4),
+                donor_ref="donor 4",
+                recipient_ref="recipient 4",
+                _quantity=2,
+            )
+
+    response = admin_client.post(
+        reverse("admin:transplants_transplant_process_import"), data=confirm_data
+    )
+    assert response.status_code == 302
+    with django_scopes.scopes_disabled():
+        if ambiguous:
+            assert response.url == reverse("admin:transplants_transplant_import")
+            # The chunks imported before the failing one are rolled back.
+            assert Transplant.objects.count() == 2
+        else:
+            assert Transplant.objects.count() == 5
+
+
+def test_streaming_export(admin_client, admin_user, monkeypatch):
+    with current_user_and_scope(user=admin_user):
+        baker.make(Transplant, _quantity=3)
+    input_format = [
+        i
+        for i, format_class in enumerate(TransplantAdmin.formats)
+        if format_class is CSV
+    ][0]
+    exported = []
+
+    def on_post_export(model, **kwargs):
+        exported.append(model)
+
+    post_export.connect(on_post_export)
+    try:
+        response = admin_client.post(
+            reverse("admin:transplants_transplant_export"),
+            data=dict(file_format=input_format),
+        )
+        assert response.status_code == 200
+        assert response.streaming
+        assert response["Content-Type"] == "text/csv"
+        # Once the rows were sent.
+        assert exported == []
+        content = b"".join(response.streaming_content).decode()
+        assert exported == [Transplant]
+    finally:
+        post_export.disconnect(on_post_export)
+    assert len(content.splitlines()) == 4
+
+    # A form customised by the admin is used.
+    class ExportForm(forms.ExportForm):
+        def clean(self):
+            raise ValidationError("Not today.")
+
+    monkeypatch.setattr(TransplantAdmin, "get_export_form", lambda self: ExportForm)
+    response = admin_client.post(
+        reverse("admin:transplants_transplant_export"),
+        data=dict(file_format=input_format),
+    )
+    assert not response.streaming
+    assert isinstance(response.context["form"], ExportForm)
+    assert response.context["form"].non_field_errors() == ["Not today."]
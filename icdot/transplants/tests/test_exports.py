@@ -0,0 +1,89 @@
+import csv
+import io
+
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+import pytest
+from django.core.management import call_command
+from django.urls import reverse
+from model_bakery import baker
+
+from icdot.transplants import exports
+from icdot.transplants.models import Biopsy, Histology, SequencingData, Transplant
+from icdot.utils.middleware import current_user_and_scope
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def events(user):
+    with current_user_and_scope(user=user):
+        transplant = baker.make(Transplant, donor_ref="donor", recipient_ref="patient")
+        biopsy = baker.make(Biopsy, transplant=transplant)
+        baker.make(Histology, biopsy=biopsy, _quantity=2)
+        baker.make(SequencingData, biopsy=biopsy, file_ref="some.RCC")
+        # Orphans are exported too, without parent columns.
+        baker.make(SequencingData, biopsy=None, file_ref="orphan.RCC")
+        yield
+
+
+def test_iter_rows(user, events, django_assert_num_queries):
+    with current_user_and_scope(user=user), django_assert_num_queries(2):
+        headers, *rows = exports.iter_rows()
+
+    assert headers == [name for name, _field in exports.get_columns()]
+    rows = [dict(zip(headers, row)) for row in rows]
+    assert [row["event"] for row in rows] == ["histology"] * 2 + ["sequencing"] * 2
+    for row in rows[:3]:
+        assert row["transplant_donor_ref"] == "donor"
+        assert row["transplant_recipient_ref"] == "patient"
+    assert rows[0]["sequencing_file_ref"] is None
+    assert {row["sequencing_file_ref"] for row in rows[2:]} == {
+        "some.RCC",
+        "orphan.RCC",
+    }
+    orphan = [row for row in rows if row["sequencing_file_ref"] == "orphan.RCC"][0]
+    assert orphan["biopsy_biopsy_date"] is None
+
+
+def test_csv_view(client, user, events):
+    client.force_login(user)
+    url = reverse("transplants:research_export_view", kwargs=dict(file_format="csv"))
+    assert client.get(url).status_code == 403
+
+    user.is_superuser = True
+    user.save()
+    response = client.get(url)
+    assert response.status_code == 200
+    content = b"".join(response.streaming_content).decode()
+    assert len(list(csv.DictReader(io.StringIO(content)))) == 4
+
+
+def test_arrow(user, events):
+    with current_user_and_scope(user=user):
+        rows = list(exports.iter_rows())
+
+    stream = b"".join(exports.stream(rows, "arrow"))
+    table = pyarrow.ipc.open_stream(stream).read_all()
+    assert table.column_names == rows[0]
+    assert table.num_rows == 4
+    schema = table.schema
+    assert schema.field("event").type == pyarrow.string()
+    assert schema.field("histology_histology_date").type == pyarrow.date32()
+    assert schema.field("histology_num_cores").type == pyarrow.int64()
+    assert schema.field("histology_ati_status").type == pyarrow.bool_()
+    assert schema.field("sequencing_rna_concentration").type == pyarrow.float64()
+    assert schema.field("transplant_donor_ref").type == pyarrow.string()
+    assert table.column("transplant_donor_ref").to_pylist()[0] == "donor"
+
+    parquet = b"".join(exports.stream(rows, "parquet"))
+    table = pyarrow.parquet.read_table(pyarrow.BufferReader(parquet))
+    assert table.num_rows == 4
+
+
+def test_export_research_data(events, tmp_path):
+    output = tmp_path / "events.csv"
+    # Not scoped, the whole registry is exported.
+    call_command("export_research_data", str(output))
+    assert len(output.read_text().splitlines()) == 5
@@ -3,6 +3,8 @@ import datetime
 import import_export
 import pytest
 import tablib
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from model_bakery import baker
 
 from icdot.transplants import resources
@@ -81,3 +83,153 @@ def test_confusing_dates(user, input_date, expected_date):
         assert resources.Transplant.objects.count() == 1
         transplant = resources.Transplant.objects.first()
         assert transplant.transplant_date == expected_date
+
+
+def test_reimport_with_datetimes(user):
+    headers = ["transplant_date", "donor_ref", "recipient_ref", "biopsy_date"]
+    dataset = tablib.Dataset(
+        ["2022-01-01", "donor", "recipient", "2022-02-01"], headers=headers
+    )
+    # XLSX files are read with datetimes, even in date columns.
+    xlsx_dataset = tablib.Dataset(
+        [
+            datetime.datetime(2022, 1, 1),
+            "donor",
+            "recipient",
+            datetime.datetime(2022, 2, 1),
+        ],
+        headers=headers,
+    )
+
+    with current_user_and_scope(user=user):
+        resources.TransplantResource().import_data(dataset, dry_run=False)
+        resources.BiopsyResource().import_data(dataset, dry_run=False)
+
+        for resource in [resources.TransplantResource(), resources.BiopsyResource()]:
+            result = resource.import_data(xlsx_dataset, dry_run=False)
+            assert not result.has_validation_errors()
+            assert result.totals["new"] == 0
+        assert resources.Transplant.objects.count() == 1
+        assert resources.Biopsy.objects.count() == 1
+
+
+@pytest.mark.parametrize("bulk", [False, True])
+def test_bulk_import(user, bulk):
+    class SequencingDataResource(resources.SequencingDataResource):
+        class Meta(resources.SequencingDataResource.Meta):
+            use_bulk = bulk
+            batch_size = 2
+
+    with current_user_and_scope(user=user):
+        transplant = baker.make(
+            "transplants.Transplant",
+            transplant_date=datetime.date(2020, 1, 1),
+            donor_ref="donor",
+            recipient_ref="recipient",
+        )
+        biopsy = baker.make(
+            "transplants.Biopsy",
+            transplant=transplant,
+            biopsy_date=datetime.date(2021, 1, 1),
+        )
+        for ref in ["rcc-1", "rcc-2"]:
+            baker.make("transplants.FileUpload", file_ref=ref, file_path=f"{ref}.RCC")
+        dataset = tablib.Dataset(
+            *[
+                ["2020-01-01", "donor", "recipient", "2021-01-01", date, ref]
+                for date, ref in [
+                    ("2021-02-01", "rcc-1"),
+                    ("2021-02-02", "rcc-2"),
+                    ("2021-02-03", "rcc-3"),
+                    # Updates the first row, before or after it is saved.
+                    ("2021-02-01", "rcc-2"),
+                ]
+            ],
+            headers=[
+                "transplant_date",
+                "donor_ref",
+                "recipient_ref",
+                "biopsy_date",
+                "sequencing_date",
+                "file_ref",
+            ],
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            result = SequencingDataResource().import_data(dataset, dry_run=False)
+        assert not result.has_errors()
+        assert not result.has_validation_errors()
+
+        sequencing_data = resources.SequencingData.objects.order_by("sequencing_date")
+        assert [(s.file_ref, s.file_path.name) for s in sequencing_data] == [
+            ("rcc-2", "rcc-2.RCC"),
+            ("rcc-2", "rcc-2.RCC"),
+            ("rcc-3", ""),
+        ]
+        assert all(s.biopsy == biopsy for s in sequencing_data)
+        assert all(s.created_by == s.modified_by == user for s in sequencing_data)
+
+    if bulk:
+        # A query per batch of file refs, rather than one or two per row.
+        file_upload_lookups = [
+            query
+            for query in queries
+            if 'FROM "transplants_fileupload"' in query["sql"]
+        ]
+        assert len(file_upload_lookups) == 2
+
+
+def test_unchanged_rows_are_skipped(user):
+    dataset = tablib.Dataset(
+        *[[f"2022-01-0{i}", f"donor {i}", "recipient", 40] for i in range(1, 4)],
+        headers=["transplant_date", "donor_ref", "recipient_ref", "recipient_age"],
+    )
+    with current_user_and_scope(user=user):
+        resources.TransplantResource().import_data(dataset, dry_run=False)
+
+        with CaptureQueriesContext(connection) as queries:
+            result = resources.TransplantResource().import_data(dataset, dry_run=False)
+        assert result.totals["skip"] == 3
+        # The lookup of the transplants, they are neither validated nor saved.
+        assert [
+            query["sql"].split()[0]
+            for query in queries
+            if "SAVEPOINT" not in query["sql"]
+        ] == ["SELECT"]
+
+        dataset[0] = ["2022-01-01", "donor 1", "recipient", 41]
+        result = resources.TransplantResource().import_data(dataset, dry_run=False)
+        assert result.totals["update"] == 1
+        assert result.totals["skip"] == 2
+        transplant = resources.Transplant.objects.get(donor_ref="donor 1")
+        assert transplant.recipient_age == 41
+
+        # Changed otherwise, it's imported again.
+        transplant.recipient_age = 50
+        transplant.save()
+        assert not transplant.import_digest
+        result = resources.TransplantResource().import_data(dataset, dry_run=False)
+        assert result.totals["update"] == 1
+        transplant.refresh_from_db()
+        assert transplant.recipient_age == 41
+
+
+def test_import_digest_is_not_loaded_when_deferred(user, django_assert_num_queries):
+    dataset = tablib.Dataset(
+        ["2022-01-01", "donor", "recipient"],
+        headers=["transplant_date", "donor_ref", "recipient_ref"],
+    )
+    with current_user_and_scope(user=user):
+        resources.TransplantResource().import_data(dataset, dry_run=False)
+
+        with django_assert_num_queries(1):
+            transplant = resources.Transplant.objects.defer("import_digest").get()
+        assert transplant.saved_import_digest is None
+
+        # Saved otherwise than by an import, the next import is not skipped.
+        transplant.recipient_age = 50
+        transplant.save()
+        transplant = resources.Transplant.objects.get()
+        assert transplant.saved_import_digest == ""
+        result = resources.TransplantResource().import_data(dataset, dry_run=False)
+        assert result.totals["update"] == 1
@@ -0,0 +1,12 @@
+from django.urls import path
+
+from icdot.transplants.views import research_export_view
+
+app_name = "transplants"
+urlpatterns = [
+    path(
+        "research-export.<str:file_format>",
+        research_export_view,
+        name="research_export_view",
+    ),
+]
@@ -0,0 +1,34 @@
+from django.contrib.auth.mixins import PermissionRequiredMixin
+from django.http import Http404, StreamingHttpResponse
+from django.utils.timezone import now
+from django.views.generic import View
+
+from icdot.transplants import exports
+
+
+class ResearchExportView(PermissionRequiredMixin, View):
+    """Stream the flat export of the events one can see, see exports."""
+
+    permission_required = (
+        "transplants.view_transplant",
+        "transplants.view_biopsy",
+        "transplants.view_histology",
+        "transplants.view_sequencingdata",
+    )
+
+    def get(self, request, file_format):
+        if file_format not in exports.FORMATS:
+            raise Http404(f"Unknown format {file_format}.")
+
+        # Built now, the rows are read once the scope of the request is gone.
+        rows = exports.iter_rows(exports.get_querysets())
+        response = StreamingHttpResponse(
+            exports.stream(rows, file_format),
+            content_type=exports.CONTENT_TYPES[file_format],
+        )
+        filename = f"icdot-events-{now():%Y-%m-%d}.{file_format}"
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response
+
+
+research_export_view = ResearchExportView.as_view()
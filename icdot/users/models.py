@@ -41,12 +41,16 @@ class UserRecordingModel(models.Model):
         on_delete=models.SET_NULL,
     )
 
-    def save(self, *args, **kwargs):
+    def record_user(self):
+        """Record the current user as the creator or last modifier."""
         user = get_current_user()
         if user and user.is_authenticated:
             self.modified_by = user
             if self._state.adding:
                 self.created_by = user
+
+    def save(self, *args, **kwargs):
+        self.record_user()
         super(UserRecordingModel, self).save(*args, **kwargs)
 
     class Meta:
@@ -1,7 +1,63 @@
+import csv
+import hashlib
+import io
+import itertools
+import json
+import tempfile
+
 import tablib
-from django.core.exceptions import ValidationError
+from django.conf import settings
+from django.contrib import messages
+from django.core.exceptions import FieldDoesNotExist, PermissionDenied, ValidationError
+from django.db import models, transaction
+from django.db.models import QuerySet
+from django.http import HttpResponseRedirect, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.decorators import method_decorator
 from django.utils.encoding import force_str
-from import_export import fields, instance_loaders, resources
+from django.utils.translation import gettext_lazy as _
+from django.views.decorators.http import require_POST
+from import_export import fields, instance_loaders, resources, results
+from import_export.signals import post_export
+from import_export.tmp_storages import TempFolderStorage
+
+from icdot.users.models import UserRecordingModel
+
+
+class ImportDigestModel(models.Model):
+    """Remember a digest of the imported row a record was last saved from.
+
+    Imports skip rows whose digest did not change, see
+    ModelResourceWithMultiFieldImport. Saving the record otherwise clears
+    the digest, so that its next import is not skipped.
+    """
+
+    class Meta:
+        abstract = True
+
+    import_digest = models.CharField(max_length=64, blank=True, editable=False)
+
+    # The digest as saved, imports set another one. None when it was
+    # deferred, it is not worth a query per instance.
+    saved_import_digest = ""
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.saved_import_digest = instance.__dict__.get("import_digest")
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using, fields)
+        if fields is None or "import_digest" in fields:
+            self.saved_import_digest = self.import_digest
+
+    def save(self, *args, **kwargs):
+        # Unless an import set it, whether it was loaded or not.
+        if self.__dict__.get("import_digest") in (None, self.saved_import_digest):
+            self.import_digest = ""
+        super().save(*args, **kwargs)
+        self.saved_import_digest = self.import_digest
 
 
 class ValidatingModelInstanceLoader(instance_loaders.ModelInstanceLoader):
@@ -9,14 +65,117 @@ class ValidatingModelInstanceLoader(instance_loaders.ModelInstanceLoader):
     Instance loader for Django model.
 
     Lookup for model instance by `import_id_fields`.
+
+    Given a dataset, the instances its rows could match are loaded up front,
+    along with their parents, in one query per level. Rows are then matched
+    against that index instead of being looked up one by one.
+
+    Instances found are memoized by model and identifying values, in a
+    `memo` shared with the loaders of the nested MultiFieldImportFields,
+    and with other imports when the resource has an `instance_memo`. Rows
+    whose instance is memoized are not looked up again.
     """
 
+    def __init__(self, resource, dataset=None, memo=None):
+        super().__init__(resource, dataset)
+        if memo is None:
+            memo = getattr(resource, "instance_memo", None)
+        self.memo = {} if memo is None else memo
+        for field in resource.fields.values():
+            if isinstance(field, MultiFieldImportField):
+                field.reset(self.memo)
+        # Identifying values -> matching instances, once preloaded.
+        self.index = None
+        # Instances created meanwhile, indexed once saved.
+        self._created = []
+        if dataset is not None and dataset.height:
+            self.preload(dataset.dict)
+
+    def _get_id_fields(self):
+        return [
+            self.resource.fields[key] for key in self.resource.get_import_id_fields()
+        ]
+
+    def preload(self, rows):
+        """Index the instances any of the rows could match.
+
+        Return whether it was possible, it is not when identifying columns
+        are missing.
+        """
+        parents = {}
+        for field in self._get_id_fields():
+            if isinstance(field, MultiFieldImportField):
+                parent_loader = field.preload(rows)
+                if parent_loader is None:
+                    return False
+                parents[field.attribute] = {
+                    parent.pk: parent for parent in parent_loader.instances()
+                }
+            elif field.column_name not in rows[0]:
+                return False
+
+        model = self.resource._meta.model
+        self.index = {}
+        missing = set()
+        for row in rows:
+            try:
+                key = self._params_key(self._get_params(row))
+            except (ValueError, ValidationError):
+                continue  # This row will be reported invalid.
+            if (model, key) in self.memo:
+                self.index[key] = [self.memo[model, key]]
+            else:
+                missing.add(key)
+        if not missing:
+            return True
+
+        opts = model._meta
+        lookups = {
+            f"{opts.get_field(field.attribute).attname}__in": {
+                key[i] for key in missing
+            }
+            for i, field in enumerate(self._get_id_fields())
+        }
+        for instance in self.get_queryset().filter(**lookups):
+            key = self._instance_key(instance)
+            if (model, key) in self.memo:
+                continue  # Possibly changed by an earlier import, keep that.
+            # Spare a query when the row is diffed or validated.
+            for attribute, by_pk in parents.items():
+                parent_pk = getattr(instance, opts.get_field(attribute).attname)
+                if parent_pk in by_pk:
+                    setattr(instance, attribute, by_pk[parent_pk])
+            self.index.setdefault(key, []).append(instance)
+        return True
+
+    def instances(self):
+        return [instance for matches in self.index.values() for instance in matches]
+
+    def _instance_key(self, instance):
+        return self.resource.get_instance_key(instance)
+
+    def _params_key(self, params):
+        return self.resource.get_params_key(params)
+
+    def add(self, instance):
+        """Remember a new instance, for later rows to match once it is saved."""
+        if self.index is not None:
+            self._created.append(instance)
+
+    def _get_indexed(self, params):
+        pending = self.resource.create_instances
+        for instance in self._created:
+            # Saved, or waiting to be saved in bulk: its row was valid.
+            if not instance._state.adding or instance in pending:
+                self.index.setdefault(self._instance_key(instance), []).append(instance)
+        self._created.clear()
+        return self.index.get(self._params_key(params), [])
+
     def _get_params(self, row):
         params = {}
         errors = {}
 
-        for key in self.resource.get_import_id_fields():
-            field = self.resource.fields[key]
+        for field in self._get_id_fields():
             try:
                 params[field.attribute] = field.clean(row)
             except ValueError as e:
@@ -28,19 +187,28 @@ class ValidatingModelInstanceLoader(instance_loaders.ModelInstanceLoader):
         return params
 
     def _get_instance(self, params, raise_on_does_not_exist=False):
-        try:
-            return self.get_queryset().get(**params)
-        except self.resource._meta.model.MultipleObjectsReturned:
+        key = (self.resource._meta.model, self._params_key(params))
+        if key in self.memo:
+            return self.memo[key]
+
+        if self.index is None:
+            matches = list(self.get_queryset().filter(**params)[:2])
+        else:
+            matches = self._get_indexed(params)
+
+        if len(matches) > 1:
             raise ValidationError(
                 f"More than one {self.resource._meta.model.__name__} match this row."
             )
-        except self.resource._meta.model.DoesNotExist:
+        if not matches:
             if not raise_on_does_not_exist:
                 return None
             raise ValidationError(
                 f"No {self.resource._meta.model.__name__} matched this row."
                 f" We searched using {params}."
             )
+        self.memo[key] = matches[0]
+        return matches[0]
 
     def get_instance(self, row, raise_on_does_not_exist=False):
         """Return a mathing instance or None."""
@@ -61,9 +229,37 @@ class MultiFieldImportField(fields.Field):
             self.attribute_prefix = ""
         super().__init__(attribute=attribute, **kwargs)
 
+    # Made once per import, see reset().
+    instance_loader = None
+    memo = None
+
+    def reset(self, memo):
+        """Start over for a new import, sharing the memo of the import."""
+        self.instance_loader = None
+        self.memo = memo
+
+    def get_instance_loader(self):
+        if self.instance_loader is None:
+            resource = self.resource_class()
+            loader_class = resource._meta.instance_loader_class
+            if issubclass(loader_class, ValidatingModelInstanceLoader):
+                self.instance_loader = loader_class(resource, memo=self.memo)
+            else:
+                self.instance_loader = loader_class(resource)
+        return self.instance_loader
+
+    def preload(self, rows):
+        """Load the instances rows refer to, return the loader holding them."""
+        instance_loader = self.get_instance_loader()
+        if isinstance(
+            instance_loader, ValidatingModelInstanceLoader
+        ) and instance_loader.preload(rows):
+            return instance_loader
+        return None
+
     def clean(self, data, **kwargs):
-        resource = self.resource_class()
-        instance_loader = resource._meta.instance_loader_class(resource, dataset=None)
+        instance_loader = self.get_instance_loader()
+        resource = instance_loader.resource
         if isinstance(resource, ModelResourceWithMultiFieldImport):
             return resource.get_instance(
                 instance_loader, row=data, raise_on_does_not_exist=True
@@ -109,7 +305,12 @@ class ModelResourceSanityCheck(resources.ModelDeclarativeMetaclass):
 
         attrs["Meta"] = meta_with_default_attributes(
             base=attrs.get("Meta", object),
-            defaults={"instance_loader_class": ValidatingModelInstanceLoader},
+            defaults={
+                "instance_loader_class": ValidatingModelInstanceLoader,
+                "use_bulk": getattr(settings, "IMPORT_USE_BULK", False),
+                "batch_size": getattr(settings, "IMPORT_BATCH_SIZE", 500),
+                "chunk_size": getattr(settings, "EXPORT_CHUNK_SIZE", 2000),
+            },
         )
 
         return super().__new__(cls, clsname, bases, attrs)
@@ -118,7 +319,30 @@ class ModelResourceSanityCheck(resources.ModelDeclarativeMetaclass):
 class ModelResourceWithMultiFieldImport(
     resources.ModelResource, metaclass=ModelResourceSanityCheck
 ):
-    """This ignores MultiFieldImportField in some of ModelResource's methods."""
+    """This ignores MultiFieldImportField in some of ModelResource's methods.
+
+    With `use_bulk`, rows are saved `batch_size` at a time with bulk queries.
+    Model.save() is not called then, so what it does is done here instead:
+    recording the current user and looking up the paths of tracked file
+    refs, with a query per batch of refs.
+
+    For ImportDigestModel subclasses, rows are skipped when they have the
+    digest of the row their record was saved from: their fields are not
+    imported, the record is neither cleaned nor saved.
+
+    With `defer_updates`, records changed by rows are not saved: they are
+    changed as Model.save() would, then left to be saved from
+    `saved_instances`. Their database rows are neither written nor locked.
+    """
+
+    file_uploads = None
+    # When a list, (instance, is_create) are appended as rows are saved.
+    saved_instances = None
+    # When a dict, shared by the instance loaders of several imports, see
+    # import_workbook(). Instances created are added to it.
+    instance_memo = None
+    # When True, changes to existing records are only kept in saved_instances.
+    defer_updates = False
 
     @staticmethod
     def _skip_multi_fields(fields):
@@ -130,17 +354,229 @@ class ModelResourceWithMultiFieldImport(
     def get_user_visible_fields(self):
         return self._skip_multi_fields(super().get_user_visible_fields())
 
+    def get_export_select_related(self):
+        """The relations exported fields follow, to be fetched with the rows."""
+        related = set()
+        for field in self.get_export_fields():
+            model, path = self._meta.model, []
+            for name in (field.attribute or "").split("__"):
+                try:
+                    model_field = model._meta.get_field(name)
+                except FieldDoesNotExist:
+                    break
+                if not (model_field.many_to_one or model_field.one_to_one):
+                    break
+                path.append(name)
+                model = model_field.related_model
+            if path:
+                related.add("__".join(path))
+        # Following "a__b" fetches "a" too.
+        return sorted(
+            path
+            for path in related
+            if not any(other.startswith(path + "__") for other in related)
+        )
+
+    def iter_queryset(self, queryset):
+        if isinstance(queryset, QuerySet):
+            queryset = queryset.select_related(*self.get_export_select_related())
+        return super().iter_queryset(queryset)
+
+    def export_rows(self, queryset=None):
+        """Yield the export headers, then a row per instance, as they are read.
+
+        Unlike export() no dataset is built, after_export() is not called.
+        Without prefetches, the queryset is read with a server-side cursor,
+        `chunk_size` rows at a time.
+        """
+        self.before_export(queryset)
+        if queryset is None:
+            queryset = self.get_queryset()
+        yield self.get_export_headers()
+        for obj in self.iter_queryset(queryset):
+            yield self.export_resource(obj)
+
     def import_data(self, dataset, **kwargs):
         clean_dataset = tablib.Dataset(
-            headers=dataset.headers,
-            *[
-                [v if v is not None else "" for v in row.values()]
-                for row in dataset.dict
-                if any(v is not None and v != "" for v in row.values())
-            ],
+            *skip_blank_rows(dataset, width=dataset.width), headers=dataset.headers
         )
         return super().import_data(dataset=clean_dataset, **kwargs)
 
+    def import_chunks(self, rows, chunk_size=None, **kwargs):
+        """Import rows from an iterable, `chunk_size` at a time.
+
+        The first row holds the headers, blank rows are skipped as they come.
+        Each chunk is imported, and committed unless `dry_run`, on its own.
+        Yield the number of rows before each chunk and the chunk's result.
+
+        With `dry_run`, later chunks do not see the rows of earlier ones.
+        """
+        if chunk_size is None:
+            chunk_size = getattr(settings, "IMPORT_CHUNK_SIZE", 5000)
+        rows = iter(rows)
+        headers = list(next(rows, None) or [])
+        rows = skip_blank_rows(rows, width=len(headers))
+        offset = 0
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            dataset = tablib.Dataset(*chunk, headers=headers)
+            yield offset, self.import_data(dataset, **kwargs)
+            offset += len(chunk)
+
+    def import_stream(self, rows, chunk_size=None, **kwargs):
+        """Import rows from an iterable, see import_chunks().
+
+        Only the totals and errors are kept, in a ChunkedResult.
+        """
+        result = ChunkedResult()
+        for offset, chunk_result in self.import_chunks(rows, chunk_size, **kwargs):
+            result.add(chunk_result, offset)
+        return result
+
+    def before_import(self, dataset, using_transactions, dry_run, **kwargs):
+        super().before_import(dataset, using_transactions, dry_run, **kwargs)
+        self.file_uploads = None
+        track_file_upload = getattr(self._meta.model, "TRACK_FILE_UPLOAD", None)
+        if self._meta.use_bulk and track_file_upload:
+            refs = set()
+            for field in self.get_import_fields():
+                if (
+                    field.attribute in track_file_upload
+                    and field.column_name in dataset.headers
+                ):
+                    refs.update(
+                        field.clean({field.column_name: value})
+                        for value in dataset[field.column_name]
+                    )
+            self.file_uploads = {}
+            refs, size = sorted(refs), self._meta.batch_size
+            for start in range(0, len(refs), size):
+                end = start + size
+                self.file_uploads.update(
+                    self._meta.model.find_file_uploads(refs[start:end])
+                )
+
+    def before_save_instance(self, instance, using_transactions, dry_run):
+        super().before_save_instance(instance, using_transactions, dry_run)
+        if self._meta.use_bulk:
+            # Model.save() will not be called to do it.
+            if isinstance(instance, UserRecordingModel):
+                instance.record_user()
+            if self.file_uploads is not None:
+                instance.set_file_paths()
+
+    def save_instance(
+        self, instance, is_create, using_transactions=True, dry_run=False
+    ):
+        if self._meta.use_bulk and not is_create and instance._state.adding:
+            # An earlier row is creating it, these changes will be saved too.
+            self.before_save_instance(instance, using_transactions, dry_run)
+            self.after_save_instance(instance, using_transactions, dry_run)
+        elif self.defer_updates and not is_create:
+            self.before_save_instance(instance, using_transactions, dry_run)
+            if not self._meta.use_bulk:
+                # Otherwise before_save_instance() did.
+                if isinstance(instance, UserRecordingModel):
+                    instance.record_user()
+                if hasattr(instance, "set_file_paths"):
+                    instance.set_file_paths()
+            self.after_save_instance(instance, using_transactions, dry_run)
+        else:
+            super().save_instance(instance, is_create, using_transactions, dry_run)
+        if self.saved_instances is not None:
+            self.saved_instances.append((instance, is_create))
+        if self.instance_memo is not None and is_create:
+            key = (self._meta.model, self.get_instance_key(instance))
+            self.instance_memo[key] = instance
+
+    def get_instance_key(self, instance):
+        """The identifying values of an instance, as instance loaders index it."""
+        opts = self._meta.model._meta
+        model_fields = [
+            opts.get_field(self.fields[key].attribute)
+            for key in self.get_import_id_fields()
+        ]
+        return tuple(
+            field.to_python(getattr(instance, field.attname)) for field in model_fields
+        )
+
+    def get_params_key(self, params):
+        """The identifying values of a row, comparable to get_instance_key."""
+        opts = self._meta.model._meta
+        key = []
+        for name in self.get_import_id_fields():
+            field = self.fields[name]
+            value = params[field.attribute]
+            if isinstance(field, MultiFieldImportField):
+                key.append(getattr(value, "pk", value))
+            else:
+                # As saved, eg: dates of XLSX files are read as datetimes.
+                key.append(opts.get_field(field.attribute).to_python(value))
+        return tuple(key)
+
+    def get_bulk_update_fields(self):
+        # Everything Model.save() would update.
+        return [
+            field.name
+            for field in self._meta.model._meta.concrete_fields
+            if not field.primary_key
+        ]
+
+    def _after_bulk_save(self, instances, using_transactions, dry_run):
+        if dry_run and not using_transactions:
+            return  # Nothing was saved.
+        if self.file_uploads is not None:
+            self._meta.model.file_paths_saved(instances)
+
+    def bulk_create(
+        self, using_transactions, dry_run, raise_errors, batch_size=None, result=None
+    ):
+        instances = list(self.create_instances)
+        super().bulk_create(
+            using_transactions, dry_run, raise_errors, batch_size, result
+        )
+        self._after_bulk_save(instances, using_transactions, dry_run)
+
+    def bulk_update(
+        self, using_transactions, dry_run, raise_errors, batch_size=None, result=None
+    ):
+        instances = list(self.update_instances)
+        super().bulk_update(
+            using_transactions, dry_run, raise_errors, batch_size, result
+        )
+        self._after_bulk_save(instances, using_transactions, dry_run)
+
+    def get_row_digest(self, row):
+        """A digest of the imported columns of a row, None without ImportDigestModel."""
+        if not issubclass(self._meta.model, ImportDigestModel):
+            return None
+        values = [
+            (
+                field.column_name,
+                "" if row[field.column_name] is None else row[field.column_name],
+            )
+            for field in self.get_import_fields()
+            if field.column_name in row
+        ]
+        content = json.dumps([type(self).__name__, values], default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def import_obj(self, obj, data, dry_run, **kwargs):
+        digest = self.get_row_digest(data)
+        if digest is not None and digest == obj.saved_import_digest:
+            return  # Unchanged, skip_row() skips it.
+        super().import_obj(obj, data, dry_run, **kwargs)
+        if digest is not None:
+            obj.import_digest = digest
+
+    def skip_row(self, instance, original, row, import_validation_errors=None):
+        digest = self.get_row_digest(row)
+        if digest is not None and digest == instance.saved_import_digest:
+            return True
+        return super().skip_row(instance, original, row, import_validation_errors)
+
     def import_field(self, field, obj, data, is_m2m=False, **kwargs):
         if not field.attribute:
             return  # Nowhere to save the data to.
@@ -150,6 +586,15 @@ class ModelResourceWithMultiFieldImport(
             return  # Nowhere to get the data from.
         field.save(obj, data, is_m2m, **kwargs)
 
+    def get_or_init_instance(self, instance_loader, row):
+        instance, new = super().get_or_init_instance(instance_loader, row)
+        if self.file_uploads is not None:
+            # Also spares a query per row when the instance is cleaned.
+            instance.file_uploads = self.file_uploads
+        if new and isinstance(instance_loader, ValidatingModelInstanceLoader):
+            instance_loader.add(instance)
+        return instance, new
+
     def get_instance(self, instance_loader, row, raise_on_does_not_exist=False):
         import_id_fields = [self.fields[f] for f in self.get_import_id_fields()]
         for field in self._skip_multi_fields(import_id_fields):
@@ -162,3 +607,314 @@ class ModelResourceWithMultiFieldImport(
             )
         else:
             return instance_loader.get_instance(row)
+
+
+def _is_blank(value):
+    return value is None or value == ""
+
+
+def skip_blank_rows(rows, width):
+    """Yield the rows which are not blank, padded to `width` with ""."""
+    for row in rows:
+        if all(_is_blank(v) for v in row):
+            continue
+        row = ["" if v is None else v for v in row]
+        yield row + [""] * (width - len(row))
+
+
+def read_rows(file, input_format):
+    """Yield the headers, then the rows of a file, as they are read.
+
+    XLSX files are read with openpyxl in read-only mode, CSV files line by
+    line. Other formats are loaded whole by tablib.
+    """
+    title = input_format.get_title()
+    if title == "xlsx":
+        import openpyxl
+
+        # 'data_only' means values are read from formula cells.
+        book = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        try:
+            yield from book.active.iter_rows(values_only=True)
+        finally:
+            book.close()
+    elif title == "csv":
+        yield from csv.reader(file)
+    else:
+        dataset = input_format.create_dataset(file.read())
+        yield dataset.headers
+        yield from dataset
+
+
+def import_workbook(file, resources, chunk_size=None, **kwargs):
+    """Import the sheets of a XLSX file, in chunks, each with its resource.
+
+    `resources` maps lowercase sheet titles to resources, in the order the
+    sheets are imported, parents first. Sheets may be missing, but not
+    unknown. The resources share an `instance_memo`: rows find the parents
+    which earlier sheets and chunks created or looked up without a query.
+    This only holds when all the chunks are imported in one transaction
+    and none is rolled back on its own.
+
+    Yield the title of each sheet, the number of rows before each chunk and
+    the chunk's result.
+    """
+    import openpyxl
+
+    book = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        sheets = {title.strip().lower(): title for title in book.sheetnames}
+        unknown = set(sheets) - set(resources)
+        if unknown:
+            raise ValueError(
+                _("Unknown sheets %(titles)s, expected %(expected)s.")
+                % dict(
+                    titles=", ".join(sorted(unknown)),
+                    expected=", ".join(resources),
+                )
+            )
+
+        memo = {}
+        for title, resource in resources.items():
+            if title not in sheets:
+                continue
+            resource.instance_memo = memo
+            rows = book[sheets[title]].iter_rows(values_only=True)
+            for offset, result in resource.import_chunks(rows, chunk_size, **kwargs):
+                yield title, offset, result
+    finally:
+        book.close()
+
+
+# Bytes buffered before they are sent, when streaming an export.
+STREAM_BUFFER_SIZE = 64 * 1024
+
+
+def stream_csv(rows, encoding="utf-8"):
+    """Yield a CSV file of the rows, as they come.
+
+    The headers are sent right away, then the rows by about STREAM_BUFFER_SIZE.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for i, row in enumerate(rows):
+        writer.writerow(row)
+        if i == 0 or buffer.tell() >= STREAM_BUFFER_SIZE:
+            yield buffer.getvalue().encode(encoding)
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode(encoding)
+
+
+def stream_xlsx(rows):
+    """Yield a XLSX file of the rows, once all of them are written.
+
+    openpyxl's write-only mode keeps rows on disk rather than in memory, but
+    a XLSX file is a zip archive, it can only be sent once complete.
+    """
+    import openpyxl
+
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet()
+    for row in rows:
+        sheet.append(row)
+    with tempfile.TemporaryFile() as file:
+        book.save(file)
+        file.seek(0)
+        yield from iter(lambda: file.read(STREAM_BUFFER_SIZE), b"")
+
+
+def stream_rows(rows, file_format, encoding=None):
+    """Yield the rows in the file format, or None if it can not be streamed."""
+    title = file_format.get_title()
+    if title == "csv":
+        return stream_csv(rows, encoding=encoding or "utf-8")
+    if title == "xlsx":
+        return stream_xlsx(rows)
+    return None
+
+
+class ChunkedResult(results.Result):
+    """Totals and errors of an import made in chunks.
+
+    Rows imported without error are only counted, so that the result does
+    not grow with the file. Errors are numbered by row in the whole file.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.error_rows = []
+
+    def add(self, result, offset):
+        self.base_errors += result.base_errors
+        self.diff_headers = result.diff_headers
+        for number, errors in result.row_errors():
+            self.error_rows.append((offset + number, errors))
+        for row in result.invalid_rows:
+            row.number += offset
+            self.invalid_rows.append(row)
+        if result.failed_dataset.headers:
+            self.failed_dataset.headers = result.failed_dataset.headers
+            self.failed_dataset.extend(result.failed_dataset)
+        for import_type, count in result.totals.items():
+            self.totals[import_type] += count
+        self.total_rows += result.total_rows
+
+    def row_errors(self):
+        return self.error_rows
+
+
+class ChunkedImportMixin:
+    """Commit confirmed imports in chunks, reading the file as it goes.
+
+    Meant for ImportMixin subclasses, the file is not loaded whole and
+    only one chunk of rows is held in memory at a time. When a chunk fails,
+    the import stops and what was imported is rolled back with the request
+    transaction, when there is one (see ATOMIC_REQUESTS.)
+    """
+
+    # Errors shown to the user, the others are only counted.
+    max_error_messages = 10
+
+    def open_tmp_storage(self, tmp_storage, input_format):
+        if isinstance(tmp_storage, TempFolderStorage):
+            if input_format.is_binary():
+                return open(tmp_storage.get_full_path(), "rb")
+            return open(
+                tmp_storage.get_full_path(),
+                encoding=tmp_storage.encoding,
+                newline="",
+            )
+        data = tmp_storage.read()
+        if isinstance(data, bytes):
+            return io.BytesIO(data)
+        return io.StringIO(data)
+
+    @method_decorator(require_POST)
+    def process_import(self, request, *args, **kwargs):
+        if not self.has_import_permission(request):
+            raise PermissionDenied
+
+        confirm_form = self.create_confirm_form(request)
+        if not confirm_form.is_valid():
+            return None
+
+        import_formats = self.get_import_formats()
+        input_format = import_formats[int(confirm_form.cleaned_data["input_format"])](
+            encoding=self.from_encoding
+        )
+        encoding = None if input_format.is_binary() else self.from_encoding
+        tmp_storage = self.get_tmp_storage_class()(
+            name=confirm_form.cleaned_data["import_file_name"],
+            encoding=encoding,
+            read_mode=input_format.get_read_mode(),
+        )
+
+        with self.open_tmp_storage(tmp_storage, input_format) as file:
+            result = self.process_rows(
+                read_rows(file, input_format), confirm_form, request, *args, **kwargs
+            )
+        tmp_storage.remove()
+
+        if result.has_errors() or result.has_validation_errors():
+            if transaction.get_connection().in_atomic_block:
+                transaction.set_rollback(True)
+            self.add_error_messages(result, request)
+            url = reverse(
+                "admin:%s_%s_import" % self.get_model_info(),
+                current_app=self.admin_site.name,
+            )
+            return HttpResponseRedirect(url)
+        return self.process_result(result, request)
+
+    def process_rows(self, rows, confirm_form, request, *args, **kwargs):
+        res_kwargs = self.get_import_resource_kwargs(
+            request, form=confirm_form, *args, **kwargs
+        )
+        resource = self.choose_import_resource_class(confirm_form)(**res_kwargs)
+        imp_kwargs = self.get_import_data_kwargs(
+            request, form=confirm_form, *args, **kwargs
+        )
+
+        result = ChunkedResult()
+        for offset, chunk_result in resource.import_chunks(
+            rows,
+            dry_run=False,
+            file_name=confirm_form.cleaned_data.get("original_file_name"),
+            user=request.user,
+            rollback_on_validation_errors=True,
+            **imp_kwargs,
+        ):
+            result.add(chunk_result, offset)
+            if result.has_errors() or result.has_validation_errors():
+                break
+            # The result does not keep the rows, log them as they come.
+            self.generate_log_entries(chunk_result, request)
+        return result
+
+    def add_error_messages(self, result, request):
+        errors = [
+            _("Line %(number)s: %(error)s") % dict(number=number, error=error.error)
+            for number, row_errors in result.row_errors()
+            for error in row_errors
+        ] + [
+            _("Line %(number)s: %(error)s")
+            % dict(number=row.number, error="; ".join(row.error.messages))
+            for row in result.invalid_rows
+        ]
+        messages.error(
+            request,
+            _("Nothing was imported, %(count)d rows have errors.")
+            % dict(count=len(result.row_errors()) + len(result.invalid_rows)),
+        )
+        for error in errors[: self.max_error_messages]:
+            messages.error(request, error)
+
+
+class StreamingExportMixin:
+    """Stream CSV and XLSX exports, reading the rows as they are sent.
+
+    Meant for ExportMixin subclasses, other formats are exported as usual.
+    The rows are read once the view returned, outside of the request
+    transaction, with a server-side cursor. post_export is sent once they
+    all were.
+    """
+
+    def export_action(self, request, *args, **kwargs):
+        if not self.has_export_permission(request):
+            raise PermissionDenied
+
+        # Like ExportMixin, which still honours the deprecated get_export_form().
+        if getattr(self.get_export_form, "is_original", False):
+            form_type = self.get_export_form_class()
+        else:
+            form_type = self.get_export_form()
+        formats = self.get_export_formats()
+        form = form_type(
+            formats, self.get_export_resource_classes(), request.POST or None
+        )
+        if not form.is_valid():
+            return super().export_action(request, *args, **kwargs)
+
+        file_format = formats[int(form.cleaned_data["file_format"])]()
+        queryset = self.get_export_queryset(request)
+        resource = self.choose_export_resource_class(form)(
+            **self.get_export_resource_kwargs(request, *args, **kwargs)
+        )
+        content = stream_rows(
+            resource.export_rows(queryset), file_format, encoding=self.to_encoding
+        )
+        if content is None:
+            return super().export_action(request, *args, **kwargs)
+
+        response = StreamingHttpResponse(
+            self._stream_export(content), content_type=file_format.get_content_type()
+        )
+        response["Content-Disposition"] = 'attachment; filename="%s"' % (
+            self.get_export_filename(request, queryset, file_format),
+        )
+        return response
+
+    def _stream_export(self, content):
+        yield from content
+        post_export.send(sender=None, model=self.model)
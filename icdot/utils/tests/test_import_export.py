@@ -1,10 +1,21 @@
+import io
+
+import openpyxl
 import pytest
+import tablib
 from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from import_export.formats.base_formats import CSV, XLSX
 
 from icdot.utils.import_export import (
     ModelResourceWithMultiFieldImport,
     MultiFieldImportField,
     ValidatingModelInstanceLoader,
+    import_workbook,
+    read_rows,
+    stream_csv,
+    stream_xlsx,
 )
 from icdot.utils.tests.utils_demo.models import Author, Book, Review
 
@@ -110,6 +121,22 @@ def test_export(setup_models, review_resource):
         assert any(expected == dict(r) for r in dataset.dict)
 
 
+def test_export_rows(setup_models, review_resource, django_assert_num_queries):
+    assert review_resource.get_export_select_related() == ["book__author"]
+    dataset = review_resource.export()
+
+    # Books and authors are fetched along with the reviews.
+    with django_assert_num_queries(1):
+        rows = list(review_resource.export_rows(Review.objects.all()))
+    assert rows == [dataset.headers, *map(list, dataset)]
+
+    content = b"".join(stream_csv(rows)).decode()
+    assert content == dataset.export("csv")
+
+    book = openpyxl.load_workbook(io.BytesIO(b"".join(stream_xlsx(rows))))
+    assert list(book.active.iter_rows(values_only=True)) == [tuple(row) for row in rows]
+
+
 def test_import(setup_models, review_resource):
     dataset = review_resource.export()
     # Change one cell.
@@ -163,6 +190,155 @@ def test_import_with_no_matching_reference(setup_models, review_resource):
         review_resource.import_data(dataset, raise_errors=True, dry_run=False)
 
 
+def test_import_preloads_parents(setup_models, review_resource):
+    dataset = review_resource.export()
+    for i in range(20):
+        author = Author.objects.create(first_name=f"author {i}", last_name="")
+        book = Book.objects.create(author=author, title="title", desc="desc")
+        row = dict(content="content", title="title", first_name=author.first_name)
+        dataset.append([row.get(header, "") for header in dataset.headers])
+    Review.objects.create(book=book, content="already reviewed")
+
+    with CaptureQueriesContext(connection) as queries:
+        result = review_resource.import_data(dataset, raise_errors=True, dry_run=False)
+    assert result.totals["new"] == 19
+    assert result.totals["update"] == 3
+
+    # Each model is looked up once, not once per row.
+    for model in [Author, Book, Review]:
+        lookup = f'SELECT "{model._meta.db_table}".'
+        assert sum(query["sql"].startswith(lookup) for query in queries) == 1
+
+
+def test_parents_are_memoized(setup_models, review_resource, django_assert_num_queries):
+    rows = review_resource.export().dict
+    # Without a dataset nothing is preloaded, rows are resolved one by one.
+    instance_loader = ValidatingModelInstanceLoader(review_resource)
+
+    # An author, a book and a review for each row.
+    with django_assert_num_queries(3 * len(rows)):
+        reviews = [instance_loader.get_instance(row) for row in rows]
+    with django_assert_num_queries(0):
+        assert [instance_loader.get_instance(row) for row in rows] == reviews
+
+    # Rows matching nothing are not memoized, they fail every time.
+    row = dict(rows[0], title="unknown title")
+    for _ in range(2):
+        with pytest.raises(ValidationError), django_assert_num_queries(1):
+            instance_loader.get_instance(row)
+
+
+def test_import_with_repeated_rows(review_resource):
+    class AuthorResource(ModelResourceWithMultiFieldImport):
+        class Meta:
+            model = Author
+            exclude = ["id"]
+            import_id_fields = ["first_name", "last_name"]
+
+    dataset = tablib.Dataset(
+        ["foo", "bar"], ["foo", "bar"], headers=["first_name", "last_name"]
+    )
+    result = AuthorResource().import_data(dataset, raise_errors=True, dry_run=False)
+    # The second row updates what the first one created.
+    assert result.totals["new"] == 1
+    assert result.totals["update"] == 1
+    assert Author.objects.count() == 1
+
+
+def _author_file(input_format, rows):
+    if input_format.get_title() == "csv":
+        return io.StringIO("".join(",".join(row) + "\n" for row in rows))
+    book = openpyxl.Workbook()
+    for row in rows:
+        book.active.append([value or None for value in row])
+    file = io.BytesIO()
+    book.save(file)
+    file.seek(0)
+    return file
+
+
+@pytest.mark.parametrize("input_format", [CSV(), XLSX()], ids=["csv", "xlsx"])
+def test_import_stream(input_format):
+    class AuthorResource(ModelResourceWithMultiFieldImport):
+        class Meta:
+            model = Author
+            exclude = ["id"]
+            import_id_fields = ["first_name", "last_name"]
+
+    rows = [["first_name", "last_name"]]
+    for i in range(7):
+        rows += [[f"author {i}", "bar"], ["", ""]]
+    rows += [["", "no first name"]]
+    file = _author_file(input_format, rows)
+
+    resource = AuthorResource()
+    chunks = list(resource.import_chunks(read_rows(file, input_format), chunk_size=3))
+    # Blank rows are skipped before rows are split in chunks.
+    assert [offset for offset, _result in chunks] == [0, 3, 6]
+    assert Author.objects.count() == 8
+
+    # Rows are numbered in the whole file, without the blank ones.
+    file = _author_file(input_format, rows + [["author 0", "bar"], ["author 0", "bar"]])
+    result = resource.import_stream(read_rows(file, input_format), chunk_size=3)
+    assert result.totals["update"] == 10
+    assert result.totals["new"] == 0
+    assert not result.rows
+    assert not result.has_errors()
+
+    Author.objects.create(first_name="author 4", last_name="bar")
+    file = _author_file(input_format, rows)
+    result = resource.import_stream(read_rows(file, input_format), chunk_size=3)
+    assert [row.number for row in result.invalid_rows] == [5]
+
+
+def test_import_workbook(review_resource):
+    book_resource_class = review_resource.fields["book"].resource_class
+    author_resource_class = book_resource_class.fields["author"].resource_class
+    resources = {
+        "author": author_resource_class(),
+        "book": book_resource_class(),
+        "review": review_resource,
+    }
+    authors = [[f"author {i}", "bar"] for i in range(6)]
+    books = [[*author, f"book {i}", "desc"] for i, author in enumerate(authors)]
+    reviews = [[*book[:3], "content"] for book in books]
+
+    workbook = openpyxl.Workbook()
+    # Children first, the sheets are imported in the order of the resources.
+    for title, headers, rows in [
+        ("Review", ["first_name", "last_name", "title", "content"], reviews),
+        ("Book", ["first_name", "last_name", "title", "desc"], books),
+        ("Author", ["first_name", "last_name"], authors),
+    ]:
+        sheet = workbook.create_sheet(title)
+        for row in [headers] + rows:
+            sheet.append(row)
+    workbook.remove(workbook.worksheets[0])
+    file = io.BytesIO()
+    workbook.save(file)
+
+    file.seek(0)
+    with CaptureQueriesContext(connection) as queries:
+        chunks = list(import_workbook(file, resources, chunk_size=2, dry_run=False))
+    assert [(title, offset) for title, offset, _result in chunks] == [
+        (title, offset) for title in resources for offset in [0, 2, 4]
+    ]
+    assert not any(result.has_errors() for _title, _offset, result in chunks)
+    assert Review.objects.count() == 6
+
+    # Each chunk looks up its own rows, parents were created by earlier sheets.
+    for model in [Author, Book, Review]:
+        lookup = f'SELECT "{model._meta.db_table}".'
+        assert sum(query["sql"].startswith(lookup) for query in queries) == 3
+
+    workbook.create_sheet("Comments")
+    file = io.BytesIO()
+    workbook.save(file)
+    file.seek(0)
+    with pytest.raises(ValueError, match="comments"):
+        list(import_workbook(file, resources))
+
+
 def test_prefix():
     field = MultiFieldImportField(Author)
     assert field.attribute_prefix == ""